@@ -0,0 +1,24 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+Raspberry Pi Beam Profiler
+
+The GUI is beamprofiler_gui1.0.py, and the headless scan runner beamprofiler_cli.py.
+The analysis can be used without either of them through beamprofiler.core.
+"""
+
+__version__ = '1.0'
@@ -0,0 +1,152 @@
+"""
+Accuracy and speed regression check of the beam width engines.
+
+Synthetic frames of beams with known widths - round, elliptical, clipped (saturated),
+off-centre (cut off by the ROI) and dim/noisy - are dark-subtracted, projected and
+measured by each width engine:
+	accurate - weighted least-squares Gaussian fit (fit_profiles, 'accurate')
+	fast     - closed-form log-parabola estimate (fit_profiles, 'fast')
+	batch    - batched Levenberg-Marquardt fit of all frames at once (fit_gaussians)
+	moments  - second-moment (D4sigma) width
+The bias and scatter of the relative width error and the time per frame are
+tabulated for each engine and beam. The exit status is 1 if any engine leaves its
+accuracy or speed envelope (ACCURACY_ENVELOPES, TIME_ENVELOPES), so this can gate 
+a change of default engine or a speed optimisation.
+
+Usage: python accuracy_check.py [--frames N] [--sensor 1|2] [--time-scale F]
+(--time-scale multiplies the time envelopes, e.g. 4 on a Raspberry Pi)
+"""
+
+import numpy as np
+
+import argparse, sys
+
+from libs.imageproc import roi_slices, project
+from libs.noise_model import SensorNoiseModel
+from libs.fitting import fit_profiles
+from libs.batchfit import fit_gaussians
+from libs.estimators import second_moment_width
+from libs.synthetic import SENSORS, CCD_XSIZE, CCD_YSIZE, synthetic_plane, dark_frame
+from libs.timing import monotonic
+from benchmark import quiet
+
+ENGINES = ('accurate', 'fast', 'batch', 'moments')
+
+# region of interest for all beams (mm) - [xmin, xmax, ymin, ymax]
+ROI = [0.9, 2.7, 0.7, 2.1]
+
+# test beams: centre (mm), 1/e^2 radii (mm), peak (counts above the dark level)
+BEAMS = [
+	('round',       dict(centre=(1.8, 1.4), width=(0.2, 0.2), amplitude=800.)),
+	('elliptical',  dict(centre=(1.8, 1.4), width=(0.3, 0.1), amplitude=800.)),
+	('clipped',     dict(centre=(1.8, 1.4), width=(0.2, 0.2), amplitude=2000.)),
+	('off-centre',  dict(centre=(2.6, 0.85), width=(0.15, 0.15), amplitude=800.)),
+	('noisy',       dict(centre=(1.8, 1.4), width=(0.2, 0.2), amplitude=40.)),
+	]
+
+# envelopes: (max |bias|, max scatter) of the relative width error, for each engine and
+# beam (None - not checked, e.g. the moments of a clipped beam are meaningless), and the
+# maximum time per frame (ms, both axes) for each engine. Saturation flattens the top of
+# the beam, so all the fits over-estimate the width of clipped beams - the envelopes
+# for those just catch the bias getting worse.
+ACCURACY_ENVELOPES = {
+	'accurate': dict(round=(0.01, 0.01), elliptical=(0.01, 0.01), clipped=(0.12, 0.02),
+					 **{'off-centre': (0.02, 0.02), 'noisy': (0.03, 0.05)}),
+	'fast':     dict(round=(0.01, 0.01), elliptical=(0.01, 0.01), clipped=(0.25, 0.02),
+					 **{'off-centre': (0.03, 0.03), 'noisy': (0.05, 0.08)}),
+	'batch':    dict(round=(0.01, 0.01), elliptical=(0.01, 0.01), clipped=(0.12, 0.02),
+					 **{'off-centre': (0.02, 0.02), 'noisy': (0.03, 0.05)}),
+	'moments':  dict(round=(0.03, 0.02), elliptical=(0.05, 0.02), clipped=None,
+					 **{'off-centre': None, 'noisy': None}),
+	}
+TIME_ENVELOPES = dict(accurate=20., fast=2., batch=5., moments=1.)
+
+def make_frames(version, beam, n_frames, rng):
+	""" x and y profiles (with variances) of n_frames noisy frames of a beam, ready for the width engines """
+	noise_model = SensorNoiseModel.for_sensor(version)
+	h, w = SENSORS[version]['shape']
+	dark = dark_frame((h//2, w//2), rng=rng)
+	hot = dark > 100
+	profiles = []
+	for i in range(n_frames):
+		frame, dark = synthetic_plane(version, beam['centre'], beam['width'], beam['amplitude'], dark, rng=rng)
+		image = frame.astype(np.float32) - dark
+		image[hot] = 0
+		slices = roi_slices(image.shape, ROI, CCD_XSIZE, CCD_YSIZE)
+		cropped = image[slices]
+		imageX, imageY, varX, varY = project(cropped, noise_model.variance(cropped, 1000))
+		ch, cw = cropped.shape
+		profiles.append((np.linspace(ROI[0], ROI[1], cw), imageX, np.linspace(ROI[3], ROI[2], ch), imageY, varX, varY))
+	return profiles
+
+def measure(engine, profiles):
+	""" x and y widths of each frame (arrays), and the time per frame (s) """
+	st = monotonic()
+	if engine in ('accurate', 'fast'):
+		xw, yw = [], []
+		with quiet():
+			for Xs, imageX, Ys, imageY, varX, varY in profiles:
+				xpopt, xerrs, ypopt, yerrs = fit_profiles(Xs, imageX, Ys, imageY, varX, varY, engine)
+				xw.append(xpopt[2])
+				yw.append(ypopt[2])
+	elif engine == 'batch':
+		Xs, Ys = profiles[0][0], profiles[0][2]
+		xw = fit_gaussians(Xs, np.array([p[1] for p in profiles]), sigma=np.sqrt([p[4] for p in profiles]))[0][:,2]
+		yw = fit_gaussians(Ys, np.array([p[3] for p in profiles]), sigma=np.sqrt([p[5] for p in profiles]))[0][:,2]
+	elif engine == 'moments':
+		xw = [second_moment_width(p[0], p[1])[1] for p in profiles]
+		yw = [second_moment_width(p[2], p[3])[1] for p in profiles]
+	else:
+		raise ValueError('Unknown width engine: '+engine)
+	return np.abs(np.asarray(xw, dtype=float)), np.abs(np.asarray(yw, dtype=float)), (monotonic() - st) / len(profiles)
+
+def check(version=2, n_frames=20, time_scale=1., seed=1):
+	""" Run all engines on all beams, print the table, and return the list of envelope failures """
+	rng = np.random.RandomState(seed)
+	failures = []
+	print '%-12s %-10s %9s %9s %9s %10s' % ('beam', 'engine', 'bias', 'scatter', 'failed', 'ms/frame')
+	for name, beam in BEAMS:
+		profiles = make_frames(version, beam, n_frames, rng)
+		for engine in ENGINES:
+			xw, yw, dt = measure(engine, profiles)
+			rel = np.concatenate((xw/beam['width'][0], yw/beam['width'][1])) - 1
+			ok = np.isfinite(rel)
+			bias = rel[ok].mean() if ok.any() else np.nan
+			scatter = rel[ok].std() if ok.any() else np.nan
+			n_failed = np.count_nonzero(~ok)
+
+			problems = []
+			envelope = ACCURACY_ENVELOPES[engine][name]
+			if envelope is not None:
+				max_bias, max_scatter = envelope
+				if n_failed or not abs(bias) <= max_bias:
+					problems.append('bias %.4f (%d failed), limit %g' % (bias, n_failed, max_bias))
+				if not scatter <= max_scatter:
+					problems.append('scatter %.4f, limit %g' % (scatter, max_scatter))
+			if 1e3*dt > time_scale*TIME_ENVELOPES[engine]:
+				problems.append('%.2f ms/frame, limit %g' % (1e3*dt, time_scale*TIME_ENVELOPES[engine]))
+
+			flag = '' if envelope is not None else '  (not checked)'
+			if problems:
+				flag = '  << OUTSIDE ENVELOPE: ' + '; '.join(problems)
+				failures.append((name, engine, problems))
+			print '%-12s %-10s %9.4f %9.4f %9d %10.3f%s' % (name, engine, bias, scatter, n_failed, 1e3*dt, flag)
+	return failures
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Check the accuracy and speed of the beam width engines')
+	parser.add_argument('--sensor', type=int, default=2, choices=[1, 2], help='camera version to simulate')
+	parser.add_argument('--frames', type=int, default=20, help='frames per beam')
+	parser.add_argument('--time-scale', type=float, default=1., help='multiply the time envelopes by this')
+	parser.add_argument('--seed', type=int, default=1, help='random seed for the synthetic data')
+	args = parser.parse_args(argv)
+
+	failures = check(args.sensor, args.frames, args.time_scale, args.seed)
+	if failures:
+		print '\n', len(failures), 'engine/beam combinations outside their envelopes'
+		return 1
+	print '\nAll engines within their envelopes'
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,198 @@
+"""
+Headless beam profiler scan runner - no GUI (wx) or matplotlib, so it starts quickly
+and can be run from cron or scripts.
+
+Reads the camera, scan and output settings from a config file (see scan_example.cfg),
+then runs: translation stage calibration -> scan -> caustic fit and M-squared -> export.
+Progress is written to stdout as JSON lines, one object per event, e.g.
+	{"event": "point", "index": 3, "position": 0.45, "wx": 210.3, "wx_err": 0.8, ...}
+Everything else (diagnostic messages) goes to stderr. With stream_port set in the
+[output] section, the points are also streamed to the local network (see 
+libs/streaming.py).
+
+With --monitor, the beam's pointing and width stability is logged at a fixed position
+instead of scanning (see the [monitor] section of the config file): a 'sample' event
+for each capture, and the rolling statistics (RMS jitter, Allan deviation) at the end.
+
+With --serve, no scan is run straight away: after calibration the profiler is 
+controlled through the remote control API (libs/control.py) on the given port, starting 
+from the config file's settings - e.g. for running many scans back to back from a script. 
+The API has no authentication, so it only listens on localhost unless --host is given 
+(--host 0.0.0.0 for all network interfaces), and it only writes files in the directory of 
+the output file. Stop it with Ctrl-C.
+
+Usage: sudo python beamprofiler_cli.py <config file> [--output <csv file>] 
+						[--serve [PORT] [--host HOST] | --monitor]
+"""
+
+import argparse, ConfigParser, json, os, sys, time
+
+# JSON lines go to the real stdout; the libraries' progress prints go to stderr
+json_out = sys.stdout
+sys.stdout = sys.stderr
+
+import RPi.GPIO as GPIO
+
+# the core library is imported as a package from the directory above this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from beamprofiler.core.acquisition import open_camera, open_stage
+from beamprofiler.core.export import run_report, write_run_report, MetricsPublisher
+from beamprofiler.core.scan import ScanRunner, ScanController, ControlServer, ProfilerSettings, \
+							BeamMonitor, scan_positions, DEFAULT_CONTROL_PORT
+from beamprofiler import __version__ as SOFTWARE_VERSION
+
+# settings used if they are not in the config file
+DEFAULTS = {
+	'camera': dict(colour='Red', exposure='auto', acquisition='single', roi='0, 3.67, 0, 2.74',
+					dark_subtract='yes', fit_engine='accurate'),
+	'scan': dict(calibrate='yes', start='0', stop='25', step='0.15', wavelength='632.8',
+					uncertainty='covariance'),
+	'monitor': dict(position='12.5', rate='1', duration='0', filename='beamprofiler_monitor.bpts'),
+	'output': dict(filename='beamprofiler_output.csv', save_images='no', report='yes', stream_port=''),
+	}
+
+def emit(event, details=None):
+	""" Write one progress event as a JSON line """
+	record = dict(event=event, time=time.time())
+	if details:
+		record.update(details)
+	json_out.write(json.dumps(record, default=float) + '\n')
+	json_out.flush()
+
+def read_config(filename):
+	""" Read the settings, falling back to DEFAULTS """
+	config = ConfigParser.SafeConfigParser()
+	for section, options in DEFAULTS.items():
+		config.add_section(section)
+		for option, value in options.items():
+			config.set(section, option, value)
+	if not config.read(filename):
+		raise IOError('Could not read config file: ' + filename)
+	return config
+
+def read_settings(config):
+	""" ProfilerSettings from the [camera] and [scan] settings (ValueError if any is invalid) """
+	settings = ProfilerSettings()
+	# exposure time in ms, as in the GUI
+	exposure = config.get('camera', 'exposure').strip().lower()
+	if exposure != 'auto':
+		settings.update(auto_exposure=False, exposure_ms=exposure)
+	settings.update(colour=config.get('camera', 'colour'), acq_mode=config.get('camera', 'acquisition'),
+					fit_engine=config.get('camera', 'fit_engine'),
+					roi=config.get('camera', 'roi').split(','),
+					scan_start=config.getfloat('scan', 'start'), scan_stop=config.getfloat('scan', 'stop'),
+					step_size=config.getfloat('scan', 'step'), wavelength_nm=config.getfloat('scan', 'wavelength'),
+					uncertainty=config.get('scan', 'uncertainty'))
+	return settings
+	
+def monitor(camera, stepper, settings, config, progress):
+	""" Log the beam stability at the [monitor] position - returns the statistics """
+	position = config.getfloat('monitor', 'position')
+	duration = config.getfloat('monitor', 'duration')
+	stepper.set_position(position)
+	beam_monitor = BeamMonitor(camera, config.get('monitor', 'filename'), settings.monitor_rate, 
+								stepper.get_position(), progress=progress)
+	emit('monitor_start', dict(position=stepper.get_position(), rate=settings.monitor_rate,
+								filename=beam_monitor.writer.filename))
+	try:
+		return beam_monitor.run(duration if duration > 0 else None)
+	except KeyboardInterrupt:
+		return beam_monitor.summary()
+	finally:
+		beam_monitor.close()
+	
+def serve(controller, port, host, output_dir):
+	""" Serve the remote control API until interrupted """
+	server = ControlServer(controller, port, host, output_dir)
+	emit('serving', dict(port=server.start()[1]))
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		controller.stop_scan()
+		server.stop()
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Run a beam profiler scan without the GUI')
+	parser.add_argument('config', help='config file with the camera, scan and output settings')
+	parser.add_argument('--output', help='csv file for the widths (overrides [output] filename)')
+	parser.add_argument('--serve', nargs='?', type=int, const=DEFAULT_CONTROL_PORT, metavar='PORT',
+						help='wait for remote control requests on PORT (default %d) instead of scanning' % DEFAULT_CONTROL_PORT)
+	parser.add_argument('--host', default='localhost',
+						help='address to serve the remote control on (default localhost; 0.0.0.0 for all interfaces)')
+	parser.add_argument('--monitor', action='store_true', help='log the beam stability at a fixed position instead of scanning')
+	args = parser.parse_args(argv)
+
+	try:
+		config = read_config(args.config)
+		output_filename = args.output or config.get('output', 'filename')
+		settings = read_settings(config)
+		if args.monitor:
+			settings.update(fit_engine='fast', monitor_rate=config.getfloat('monitor', 'rate'))
+		positions = scan_positions(settings.scan_start, settings.scan_stop, settings.step_size)
+		stream_port = config.get('output', 'stream_port').strip()
+		stream_port = int(stream_port) if stream_port else None
+	except (IOError, ValueError, ConfigParser.Error) as e:
+		emit('error', dict(message=str(e)))
+		return 2
+
+	emit('start', dict(config=args.config, output=output_filename, positions=len(positions),
+					version=SOFTWARE_VERSION))
+	camera = open_camera()
+	publisher = None
+	try:
+		settings.apply_to_camera(camera)
+		camera.bg_subtract = config.getboolean('camera', 'dark_subtract')
+		stepper = open_stage()
+		progress = emit
+		if stream_port is not None:
+			publisher = MetricsPublisher(stream_port)
+			emit('streaming', dict(port=publisher.start()[1]))
+			def progress(event, details):
+				emit(event, details)
+				if event in ('point', 'sample'):
+					publisher.publish(details, camera.image)
+		save_prefix = output_filename[:-4] + '_image_' if config.getboolean('output', 'save_images') else None
+		runner = ScanRunner(camera, stepper, positions, settings.fit_engine, save_prefix, progress=progress,
+							wavelength_nm=settings.wavelength_nm, uncertainty=settings.uncertainty)
+
+		if config.getboolean('scan', 'calibrate') and not runner.calibrate():
+			emit('error', dict(message='Translation stage calibration failed - check for hardware errors'))
+			return 1
+
+		if args.monitor:
+			emit('monitor_end', monitor(camera, stepper, settings, config, progress))
+			emit('done')
+			return 0
+		if args.serve is not None:
+			settings.update(save_each_image=save_prefix is not None, image_prefix=save_prefix or '')
+			serve(ScanController(camera, stepper, settings, progress, SOFTWARE_VERSION), args.serve, args.host,
+					os.path.dirname(os.path.abspath(output_filename)))
+			emit('done')
+			return 0
+		runner.run()
+		runner.fit_caustics()
+		files = runner.export(output_filename)
+		if config.getboolean('output', 'report'):
+			report_filename = output_filename[:-4] + '_runreport.json'
+			write_run_report(run_report(runner.stats, SOFTWARE_VERSION), report_filename)
+			files.append(report_filename)
+		emit('export', dict(files=files))
+	except KeyboardInterrupt:
+		emit('error', dict(message='Interrupted'))
+		return 1
+	except Exception as e:
+		emit('error', dict(message='%s: %s' % (type(e).__name__, e)))
+		raise
+	finally:
+		if publisher is not None:
+			publisher.stop()
+		camera.cleanup()
+		GPIO.cleanup()
+	emit('done')
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -21,6 +21,10 @@ Version 1.0
 January 2018, JK 
 
 """
+# start up is timed from here - see MainWin.OnHardwareReady
+import time
+_t_start = time.time()
+
 import matplotlib
 matplotlib.use('WxAgg')
 import matplotlib.pyplot as plt
@@ -31,36 +35,50 @@ plt.ioff()
 #rc('font',**{'family':'serif'})
 
 import cPickle as pickle
-import os, sys, csv, time
+import os, sys, csv, socket, threading
 
 import numpy as np
-from matplotlib import cm
-from mpl_toolkits.axes_grid.anchored_artists import AnchoredText
 
 #GUI
 import wx
 from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg, NavigationToolbar2WxAgg as Toolbar
 
-#camera
-import picamera
-import picamera.array as camarray
+# picamera and RPi.GPIO are imported when the camera and stage are opened (in the
+# background, after the window is shown), scipy when the first fit is made and the 
+# colormap data just after the window is shown
+# local modules - the core library (beamprofiler.core) is imported as a package 
+# from the directory above this one
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from beamprofiler.core.acquisition import open_camera, open_stage, LiveAnalyser, live_annotation
+from beamprofiler.core.processing import gaussian, focussed_gaussian, fit_profiles, fit_stats, \
+							add_fit_stats, FitWorkerPool, PipelineTimers, STARTUP_STAGES, timers, monotonic
+from beamprofiler.core.scan import scan_positions, fit_scan_caustics, export_order, caustic_summary, \
+							caustic_beam_quality, resample_caustic, ProfilerSettings, ControlServer, BeamMonitor
+from beamprofiler.core.export import write_widths, write_outliers, write_fit_params, write_beam_quality, \
+							write_csv, write_pkl, run_report, write_run_report, MetricsPublisher
+from beamprofiler.libs.blurb import fullpath, about_message
+from beamprofiler.libs.durhamcolours import *		
+from beamprofiler import __version__ as SOFTWARE_VERSION
 
-#gpio
-import RPi.GPIO as GPIO
-GPIO.setmode(GPIO.BCM)
+# use relative file paths
+bp_dir = os.path.dirname(__file__)
 
-#fitting
-from scipy.optimize import curve_fit
+# sensor area (mm) - [xmin, xmax, ymin, ymax], for the image axes before the camera is open
+SENSOR_EXTENT = [0.0, 3.67, 0.0, 2.74]
 
-# local modules
-from libs.stepper_control import StepMotorControl
-from libs.camera_control import MyCamera
-from libs.blurb import fullpath, about_message
-from libs.durhamcolours import *		
-import libs.colormaps as cm_new # the matplotlib 2.0 colourmaps aren't available on RPi yet...
+# TCP ports for streaming results to the local network, and for remote control
+STREAM_PORT = 8765
+CONTROL_PORT = 8766
+# longest wait (s) for the GUI to carry out a remote control request
+CONTROL_TIMEOUT = 30.
+# shortest time (s) between display updates in monitoring mode
+MONITOR_DRAW_INTERVAL = 0.5
+# shortest time (s) between status bar updates from the live view
+LIVE_STATUS_INTERVAL = 0.25
 
-# use relative file paths
-bp_dir = os.path.dirname(__file__)
+# where the start up time goes
+startup_timers = PipelineTimers(stages=STARTUP_STAGES)
+startup_timers.add('imports', time.time() - _t_start)
 	
 class CameraSettings(wx.Dialog):
 	"""
@@ -72,13 +90,13 @@ class CameraSettings(wx.Dialog):
 		self.parent = parent
 		
 		#default exposure settings
+		settings = parent.settings
 		self.ExpTime = float(parent.camera.shutter_speed/1e3)
-		self.Col = DialogOptions.Col
-		self.ExpAuto = DialogOptions.ExpAuto
-		self.ROIxminval = DialogOptions.ROIxminval
-		self.ROIxmaxval = DialogOptions.ROIxmaxval
-		self.ROIyminval = DialogOptions.ROIyminval
-		self.ROIymaxval = DialogOptions.ROIymaxval
+		self.Col = settings.colour
+		self.AcqMode = AcqModeNames[settings.acq_mode]
+		self.FitEngine = FitEngineNames[settings.fit_engine]
+		self.ExpAuto = settings.auto_exposure
+		self.ROIxminval, self.ROIxmaxval, self.ROIyminval, self.ROIymaxval = settings.roi
 		
 				
 		##init UI
@@ -88,7 +106,7 @@ class CameraSettings(wx.Dialog):
 		#init plot
 		self.nBins = 64
 		self.line, = self.ax_hist.plot(np.linspace(0,1023,self.nBins),np.zeros(self.nBins), \
-							color=DialogOptions.linecol,lw=2)
+							color=d_purple,lw=2)
 		self.HistPanel.draw()		
 	
 	def initUI(self):
@@ -135,6 +153,39 @@ class CameraSettings(wx.Dialog):
 		Colbox.Add(self.ColCtrl,0,wx.EXPAND)
 		Colbox.Add((20,-1),0,wx.EXPAND)
 		vbox.Add(Colbox,0,wx.EXPAND)
+		
+		# Acquisition mode (single frame / exposure-bracketed HDR)
+		AcqLabel = wx.StaticText(self,label="Acquisition")
+		self.AcqCtrl = wx.ComboBox(self,value=self.AcqMode, 
+			choices=AcqModeChoices,style=wx.CB_READONLY, size=(120,-1))
+		self.Bind(wx.EVT_COMBOBOX,self.OnAcqCtrl,self.AcqCtrl)
+		self.AcqCtrl.SetToolTip(wx.ToolTip("HDR: merge several exposures, each "+str(int(parent.camera.hdr_ratio))+ \
+				"x longer than the last, to measure the wings of the beam above the noise. "
+				"Stack: average "+str(parent.camera.stack_frames)+" frames, rejecting outliers"))
+		Acqbox = wx.BoxSizer(wx.HORIZONTAL)
+		Acqbox.Add((20,-1),0,wx.EXPAND)
+		Acqbox.Add(AcqLabel,0,wx.EXPAND)
+		Acqbox.Add((10,-1),1,wx.EXPAND)
+		Acqbox.Add(self.AcqCtrl,0,wx.EXPAND)
+		Acqbox.Add((20,-1),0,wx.EXPAND)
+		vbox.Add((-1,5),0,wx.EXPAND)
+		vbox.Add(Acqbox,0,wx.EXPAND)
+		
+		# Fitting engine
+		FitLabel = wx.StaticText(self,label="Fitting")
+		self.FitCtrl = wx.ComboBox(self,value=self.FitEngine, 
+			choices=FitEngineChoices,style=wx.CB_READONLY, size=(120,-1))
+		self.Bind(wx.EVT_COMBOBOX,self.OnFitCtrl,self.FitCtrl)
+		self.FitCtrl.SetToolTip(wx.ToolTip("Fast: closed-form Gaussian estimate from a parabola fit "
+				"to the log of the profile, without error bars"))
+		Fitbox = wx.BoxSizer(wx.HORIZONTAL)
+		Fitbox.Add((20,-1),0,wx.EXPAND)
+		Fitbox.Add(FitLabel,0,wx.EXPAND)
+		Fitbox.Add((10,-1),1,wx.EXPAND)
+		Fitbox.Add(self.FitCtrl,0,wx.EXPAND)
+		Fitbox.Add((20,-1),0,wx.EXPAND)
+		vbox.Add((-1,5),0,wx.EXPAND)
+		vbox.Add(Fitbox,0,wx.EXPAND)
 				
 		# Region-of-Interest select
 		ROILabel = wx.StaticText(self,label="Region of Interest (fraction of image)")
@@ -238,6 +289,27 @@ class CameraSettings(wx.Dialog):
 		self.Col = self.ColCtrl.GetValue()
 		self.parent.camera.col = self.Col
 		
+	def OnAcqCtrl(self,event):
+		""" When acquisition mode drop-down box is selected """
+		self.AcqMode = self.AcqCtrl.GetValue()
+		self.parent.camera.acq_mode = AcqModes[self.AcqMode]
+		
+	def OnFitCtrl(self,event):
+		""" When fitting engine drop-down box is selected """
+		self.FitEngine = self.FitCtrl.GetValue()
+		
+	def store_settings(self):
+		""" Copy the dialog's values to the profiler settings - returns False if they are invalid """
+		try:
+			self.parent.settings.update(colour=self.Col, acq_mode=AcqModes[self.AcqMode], 
+							fit_engine=FitEngines[self.FitEngine], auto_exposure=self.ExpAuto,
+							exposure_ms=float(self.parent.camera.shutter_speed)/1e3,
+							roi=[self.ROIxminval,self.ROIxmaxval,self.ROIyminval,self.ROIymaxval])
+		except ValueError as e:
+			print 'Camera settings not stored:', e
+			return False
+		return True
+		
 	def OnApply(self,event):
 		""" When 'Apply' button is clicked """
 		if self.ExpAuto:
@@ -247,14 +319,6 @@ class CameraSettings(wx.Dialog):
 			time.sleep(0.05)
 			self.ExpCtrl.ChangeValue(str(round(exp_time,3)))
 					
-		# Update dialog options
-		DialogOptions.ExpAuto = self.ExpAuto
-		DialogOptions.Col = self.Col
-		DialogOptions.ROIxminval = self.ROIxminval
-		DialogOptions.ROIxmaxval = self.ROIxmaxval
-		DialogOptions.ROIyminval = self.ROIyminval
-		DialogOptions.ROIymaxval = self.ROIymaxval
-		
 		self.parent.camera.roi = [self.ROIxminval,self.ROIxmaxval,self.ROIyminval,self.ROIymaxval]
 		
 		try:
@@ -262,6 +326,9 @@ class CameraSettings(wx.Dialog):
 		except ValueError:
 			print ' Shutter speed set incorrectly!! '
 		
+		# Update settings
+		self.store_settings()
+		
 		self.parent.camera.capture_image()
 		self.parent.update_main_imshow()
 			
@@ -357,31 +424,20 @@ class CameraSettings(wx.Dialog):
 		#			(self.ROIymaxval-self.ROIyminval)/cam.ccd_ysize)
 		cam.roi = [self.ROIxminval,self.ROIxmaxval,self.ROIyminval,self.ROIymaxval]
 
-class DialogDefaults:
-	""" Dummy class for holding default (and subsequently edited) values for the dialog boxes """
-	# Image
-	ExpAuto = True
-	ExpTime = '20.0'
-	Col = 'Red'
-	linecol = d_purple
-	ROIxminval = 0
-	ROIxmaxval = 3.67
-	ROIyminval = 0
-	ROIymaxval = 2.74 # full-range of the sensor
-	crop = (ROIxminval, ROIxmaxval-ROIxminval, \
-			ROIyminval, ROIymaxval-ROIyminval)
+# Acquisition mode names shown in the camera settings dialog, and the camera's name for them
+AcqModeChoices = ['Single frame', 'HDR (bracketed)', 'Stack (averaged)']
+AcqModes = dict(zip(AcqModeChoices, ['single', 'hdr', 'stack']))
+AcqModeNames = dict((mode, name) for name, mode in AcqModes.items())
 
-	# Scan - all dimensions in mm
-	set_pos = 12.5
-	scan_start_pos = 0
-	scan_stop_pos = 25
-	step_size = 0.15
-	
-	# save each image
-	SaveEachImage = False
+# Profile fitting engines
+FitEngineChoices = ['Accurate (least squares)', 'Fast (log-parabola)']
+FitEngines = dict(zip(FitEngineChoices, ['accurate', 'fast']))
+FitEngineNames = dict((engine, name) for name, engine in FitEngines.items())
 
-# Instantiate the defaults	
-DialogOptions = DialogDefaults()
+# Caustic fit / M-squared uncertainties
+UncertaintyChoices = ['Fit covariance', 'Bootstrap (1000 resamples)', 'Jackknife']
+Uncertainties = dict(zip(UncertaintyChoices, ['covariance', 'bootstrap', 'jackknife']))
+UncertaintyNames = dict((method, name) for name, method in Uncertainties.items())
 		
 class ScanSettings(wx.Dialog):
 	""" 
@@ -391,13 +447,15 @@ class ScanSettings(wx.Dialog):
 
 	def __init__(self, parent, id, title):
 		self.parent = parent
-		wx.Dialog.__init__(self,parent,id,title, size=(400, 500), pos=(0,0))
+		wx.Dialog.__init__(self,parent,id,title, size=(400, 560), pos=(0,0))
 			
 		#defaults
-		self.set_pos = DialogOptions.set_pos
-		self.scan_start_pos = DialogOptions.scan_start_pos
-		self.scan_stop_pos = DialogOptions.scan_stop_pos
-		self.step_size = DialogOptions.step_size
+		self.set_pos = parent.settings.set_pos
+		self.scan_start_pos = parent.settings.scan_start
+		self.scan_stop_pos = parent.settings.scan_stop
+		self.step_size = parent.settings.step_size
+		self.wavelength = parent.settings.wavelength_nm
+		self.uncertainty = UncertaintyNames[parent.settings.uncertainty]
 		
 		self.initUI()
 		
@@ -444,7 +502,7 @@ class ScanSettings(wx.Dialog):
 		
 		# Tick box to auto-save each image in a scan
 		SaveEachButton = wx.CheckBox(self,label = "Save each image?")
-		SaveEachButton.SetValue(DialogOptions.SaveEachImage)
+		SaveEachButton.SetValue(self.parent.settings.save_each_image)
 		self.Bind(wx.EVT_CHECKBOX,self.OnSaveEachImage,SaveEachButton)
 		
 		vbox.Add((-1,40),0,wx.EXPAND)
@@ -482,9 +540,42 @@ class ScanSettings(wx.Dialog):
 		vbox.Add(StepSizeSizer,0,wx.EXPAND)
 		vbox.Add((-1,5),0,wx.EXPAND)
 		
+		WavelengthText = wx.StaticText(self,label="Laser Wavelength (nm)")
+		WavelengthValue = wx.TextCtrl(self,value=str(self.wavelength), style=wx.TE_RIGHT,size=(80,-1))
+		WavelengthValue.SetToolTip(wx.ToolTip("Used for the M-squared of the beam, from the caustic fit"))
+		self.Bind(wx.EVT_TEXT,self.OnWavelength,WavelengthValue)
+		WavelengthSizer = wx.BoxSizer(wx.HORIZONTAL)
+		WavelengthSizer.Add(WavelengthText,0,wx.ALIGN_LEFT|wx.LEFT,border=40)
+		WavelengthSizer.Add((20,-1),1,wx.EXPAND)
+		WavelengthSizer.Add(WavelengthValue,0,wx.EXPAND|wx.RIGHT,border=50)
+		vbox.Add(WavelengthSizer,0,wx.EXPAND)
+		vbox.Add((-1,5),0,wx.EXPAND)
+		
+		UncertaintyText = wx.StaticText(self,label="Fit Errors")
+		self.UncertaintyCtrl = wx.ComboBox(self,value=self.uncertainty,
+			choices=UncertaintyChoices,style=wx.CB_READONLY, size=(180,-1))
+		self.UncertaintyCtrl.SetToolTip(wx.ToolTip("Bootstrap/jackknife: confidence intervals of the waist, "
+				"Rayleigh range, focus and M-squared from refitting resampled scan points, in the export"))
+		self.Bind(wx.EVT_COMBOBOX,self.OnUncertainty,self.UncertaintyCtrl)
+		UncertaintySizer = wx.BoxSizer(wx.HORIZONTAL)
+		UncertaintySizer.Add(UncertaintyText,0,wx.ALIGN_LEFT|wx.LEFT,border=40)
+		UncertaintySizer.Add((20,-1),1,wx.EXPAND)
+		UncertaintySizer.Add(self.UncertaintyCtrl,0,wx.EXPAND|wx.RIGHT,border=50)
+		vbox.Add(UncertaintySizer,0,wx.EXPAND)
+		vbox.Add((-1,5),0,wx.EXPAND)
+		
 		vbox.Add((-1,30),0,wx.EXPAND)
 		vbox.Add(SaveEachButton,0,wx.LEFT|wx.RIGHT,border=40)
 		vbox.Add((-1,5),0,wx.EXPAND)
+		
+		# Tick box to fit images in background processes during the scan
+		WorkerPoolButton = wx.CheckBox(self,label = "Fit images in background processes?")
+		WorkerPoolButton.SetValue(self.parent.settings.use_worker_pool)
+		WorkerPoolButton.SetToolTip(wx.ToolTip("Fit each image on the other processor cores while the "
+				"stage moves to the next position (single frame acquisition, without saving each image)"))
+		self.Bind(wx.EVT_CHECKBOX,self.OnUseWorkerPool,WorkerPoolButton)
+		vbox.Add(WorkerPoolButton,0,wx.LEFT|wx.RIGHT,border=40)
+		vbox.Add((-1,5),0,wx.EXPAND)
 
 				
 		#button bar - ok and cancel (standard buttons)
@@ -528,23 +619,109 @@ class ScanSettings(wx.Dialog):
 		except ValueError:
 			pass
 		
+	def OnWavelength(self,event):
+		try:
+			self.wavelength = float(event.GetString())
+		except ValueError:
+			pass
+		
+	def OnUncertainty(self,event):
+		self.uncertainty = self.UncertaintyCtrl.GetValue()
+		
 	def OnSaveEachImage(self,event):
-		self.parent.SaveEachImage = bool(event.Checked())
-		DialogOptions.SaveEachImage = self.parent.SaveEachImage
+		self.parent.settings.update(save_each_image=bool(event.Checked()))
+		
+	def OnUseWorkerPool(self,event):
+		self.parent.settings.update(use_worker_pool=bool(event.Checked()))
 		
 	def get_values(self):
-		return self.set_pos, self.scan_start_pos, self.scan_stop_pos, self.step_size
+		return self.set_pos, self.scan_start_pos, self.scan_stop_pos, self.step_size, self.wavelength, \
+				Uncertainties[self.uncertainty]
 
+
+class GuiController():
+	""" 
+	Controller for the remote control API (ControlServer): requests arrive on the 
+	server's threads, and are carried out in the GUI thread
+	"""
+	def __init__(self,win):
+		self.win = win
+		
+	def call(self,func,*args):
+		""" Call func(*args) in the GUI thread, and return its result (or raise its exception) """
+		done = threading.Event()
+		outcome = {}
+		def run():
+			try:
+				outcome['result'] = func(*args)
+			except Exception as e:
+				outcome['error'] = e
+			done.set()
+		wx.CallAfter(run)
+		if not done.wait(CONTROL_TIMEOUT):
+			raise RuntimeError('The profiler is busy - try again')
+		if 'error' in outcome:
+			raise outcome['error']
+		return outcome['result']
+		
+	def get_settings(self):
+		return self.call(self.win.settings.as_dict)
+		
+	def update_settings(self,changes):
+		return self.call(self.win.remote_update_settings,changes)
+		
+	def start_scan(self):
+		return self.call(self.win.remote_start_scan)
+		
+	def stop_scan(self):
+		return self.call(self.win.remote_stop_scan)
+		
+	def scan_status(self):
+		return self.call(self.win.scan_status)
+		
+	def scan_results(self):
+		return self.call(self.win.scan_results)
+		
+	def export(self,filename):
+		return self.call(self.win.remote_export,filename)
 		
 class MainWin(wx.Frame):
 	""" Class that contains the main frame of the application """
 	def __init__(self,parent,title):
+		st = monotonic()
 		wx.Frame.__init__(self,None,title=title,size=(1200,900))
 		
-		self.SaveEachImage = False
-		
-		## initialise camera
-		self.camera = MyCamera()
+		# camera and scan settings (the dialogs and remote control change these)
+		self.settings = ProfilerSettings()
+		self.scanning = False
+		# number of scans started, index of the first point of the last one in the scan data,
+		# its number of positions, and its caustic fit, the x and y outlier flags of the points, 
+		# M-squared and its confidence intervals (None until the scan has completed)
+		self.scans = 0
+		self.scan_first_point = 0
+		self.scan_n_positions = 0
+		self.caustic = None
+		self.outliers = None
+		self.beam_quality = None
+		self.intervals = None
+		# remote control server (started from the checkbox)
+		self.control_server = None
+		# beam stability monitoring (BeamMonitor) while the monitor button is on
+		self.monitor = None
+		
+		# worker processes for fitting during scans - started when first needed
+		self.fit_pool = None
+		# frame ring slot being displayed during a scan (read lease)
+		self.display_slot = None
+		# statistics of the last scan, for the run report
+		self.scan_stats = None
+		# live results on the network (started from the checkbox), and the latest results to send
+		self.streamer = None
+		self.frame_metrics = None
+		
+		## camera and translation stage - opened in the background once the window is shown
+		self.camera = None
+		self.Stepper = None
 
 		# if the window is closed, exit
 		self.Bind(wx.EVT_CLOSE,self.OnExit)
@@ -553,8 +730,10 @@ class MainWin(wx.Frame):
 		panel = wx.Panel(self)
 		panel.SetBackgroundColour(wx.Colour(230,230,230))
 
-		##  Statusbar at the bottom of the window
-		#self.CreateStatusBar() - not used in the end, but could add live plot coordinates, tooltips or something similar
+		##  Statusbar at the bottom of the window - shows where the time goes in each pipeline stage
+		self.CreateStatusBar()
+		self.GetStatusBar().Show(False)
+		self.ShowTimings = False
 		
 		# Plot panel - canvas and toolbar
 		self.fig = plt.figure(1,(4.5/2,3./2),80,facecolor=(230./255,230./255,230./255))
@@ -579,10 +758,10 @@ class MainWin(wx.Frame):
 		
 		## Create initial dummy image to be updated with camera data later.
 		## Take x and y partial sums and add these to the plot too
-		CM = cm_new.inferno #cm.PuOr_r #gist_heat #afmhot # binary_r
+		## (the colormap is set by load_colormap() once the window is shown)
 		im_array = np.zeros((300,400))
-		self.im_obj = self.ax_im.imshow(im_array,cmap=CM,aspect='auto',
-				extent=self.camera.extent, interpolation='none',
+		self.im_obj = self.ax_im.imshow(im_array,cmap='gray',aspect='auto',
+				extent=SENSOR_EXTENT, interpolation='none',
 				vmin = 0, vmax = 1023) #10-bit raw
 		self.xfitdata = [[],[]]
 		self.yfitdata = [[],[]]
@@ -608,6 +787,9 @@ class MainWin(wx.Frame):
 		
 		self.xwfit, = self.axXwidth.plot([0],[0],'k-',lw=2)		
 		self.ywfit, = self.axYwidth.plot([0],[0],'k-',lw=2)
+		# M-squared of the caustic fits
+		self.xm2_text = self.axXwidth.text(0.02,0.8,'',transform=self.axXwidth.transAxes)
+		self.ym2_text = self.axYwidth.text(0.02,0.8,'',transform=self.axYwidth.transAxes)
 			
 		self.xwline, self.xwcaplines, self.xwbarlines = \
 			self.axXwidth.errorbar([-1],[0],yerr=[0.1],linestyle='None',
@@ -615,6 +797,9 @@ class MainWin(wx.Frame):
 		self.ywline, self.ywcaplines, self.ywbarlines = \
 			self.axYwidth.errorbar([-1],[0],yerr=[0.1],linestyle='None',
 				ms=5,marker='o',mec=d_purple,mfc='w',mew=2,color='k',lw=1.5,capsize=0)		
+		# points left out of the caustic fits as outliers
+		self.xwoutliers, = self.axXwidth.plot([],[],'rx',ms=9,mew=2)
+		self.ywoutliers, = self.axYwidth.plot([],[],'rx',ms=9,mew=2)
 		
 		self.axXwidth.set_xlim(0,25)
 		self.axYwidth.set_xlim(0,25)
@@ -631,9 +816,9 @@ class MainWin(wx.Frame):
 		
 
 		self.im_min = self.fig.text(0.2,0.4,'Min pixel value:' \
-									+str(int(self.camera.image.min())))
+									+str(int(im_array.min())))
 		self.im_max = self.fig.text(0.5,0.4,'Max pixel value:'\
-									+str(int(self.camera.image.max())))
+									+str(int(im_array.max())))
 
 		# Plot panel sizer:
 		plotpanel = wx.BoxSizer(wx.VERTICAL)
@@ -649,6 +834,8 @@ class MainWin(wx.Frame):
 		ImageSettingsLabel.SetFont(font)
 		
 		self.LiveViewActive = False
+		self.live_view = None # LiveAnalyser while the live view is on
+		self.live_status_time = 0
 		self.LiveViewButton = wx.ToggleButton(panel,label="Live View (off)",size=(180,30))
 		self.Bind(wx.EVT_TOGGLEBUTTON, lambda event: self.OnToggleLiveView(event, self.camera),self.LiveViewButton)
 		#LiveViewRateText = wx.StaticText(panel,label="Update Delay")
@@ -704,12 +891,41 @@ class MainWin(wx.Frame):
 		ScanStartStop.Add((10,-1),0,wx.EXPAND)
 		ScanStartStop.Add(ScanStopButton,0,wx.EXPAND)
 		Scan_sizer.Add(ScanStartStop,0,wx.ALIGN_LEFT|wx.LEFT,border=60)
+		
+		Scan_sizer.Add((-1,10),0,wx.EXPAND)
+		self.MonitorButton = wx.ToggleButton(panel,label="Monitor Beam (off)",size=(180,30))
+		self.MonitorButton.SetToolTip(wx.ToolTip("Log the centroid and widths at the current stage position "
+			"at a fixed rate, with the pointing jitter and Allan deviation in the status bar"))
+		self.Bind(wx.EVT_TOGGLEBUTTON,self.OnToggleMonitor,self.MonitorButton)
+		Scan_sizer.Add(self.MonitorButton,0,wx.ALIGN_LEFT|wx.LEFT,border=60)
 
 		Scan_sizer.Add((-1,10),0,wx.EXPAND)
 		ClearDataButton = wx.Button(panel,label="Clear Previous Data",size=(180,30))
 		self.Bind(wx.EVT_BUTTON,self.OnClearDataButton,ClearDataButton)
 		Scan_sizer.Add(ClearDataButton,0,wx.ALIGN_LEFT|wx.LEFT,border=60)	
 		
+		Scan_sizer.Add((-1,10),0,wx.EXPAND)
+		TimingsButton = wx.CheckBox(panel,label="Show stage timings")
+		TimingsButton.SetToolTip(wx.ToolTip("Show the mean time taken by each stage (move, capture, "
+			"fit, draw, ...) and its share of the total in the status bar"))
+		self.Bind(wx.EVT_CHECKBOX,self.OnShowTimings,TimingsButton)
+		Scan_sizer.Add(TimingsButton,0,wx.ALIGN_LEFT|wx.LEFT,border=60)
+		
+		Scan_sizer.Add((-1,10),0,wx.EXPAND)
+		StreamButton = wx.CheckBox(panel,label="Stream results on the network")
+		StreamButton.SetToolTip(wx.ToolTip("Send the widths, centroid and a thumbnail of each image to "
+			"clients on the local network (TCP port "+str(STREAM_PORT)+" - see stream_client.py)"))
+		self.Bind(wx.EVT_CHECKBOX,self.OnStreamResults,StreamButton)
+		Scan_sizer.Add(StreamButton,0,wx.ALIGN_LEFT|wx.LEFT,border=60)
+		
+		Scan_sizer.Add((-1,10),0,wx.EXPAND)
+		ControlButton = wx.CheckBox(panel,label="Allow remote control")
+		ControlButton.SetToolTip(wx.ToolTip("Let scripts on this computer change the settings, "
+			"run scans and fetch the results (HTTP on localhost port "+str(CONTROL_PORT)+" - see libs/control.py). "
+			"Exported files are written in "+os.getcwd()))
+		self.Bind(wx.EVT_CHECKBOX,self.OnRemoteControl,ControlButton)
+		Scan_sizer.Add(ControlButton,0,wx.ALIGN_LEFT|wx.LEFT,border=60)
+		
 		## Post-acquisition - save fig, export data ...
 		self.save_image = False
 
@@ -805,14 +1021,60 @@ class MainWin(wx.Frame):
 		panel.Layout()
 		self.Center()
 
-		# Initialise stepper motor
-		self.Stepper = StepMotorControl(self)
-		# Call stepper calibration after a small delay
-		wx.FutureCall(500,self.TranslationStageCalibration)
-		
 		## Show main window
 		print 'Loading main window...'
 		self.Show(True)
+		startup_timers.add('window', monotonic() - st)
+		
+		# colormap, then the camera and stepper motor (calibration starts when they are ready)
+		wx.CallAfter(self.load_colormap)
+		hardware = threading.Thread(target=self.open_hardware)
+		hardware.daemon = True
+		hardware.start()
+
+	def load_colormap(self):
+		""" Set the image colormap (the colormap tables are loaded from disk) """
+		with startup_timers.stage('colormap'):
+			from beamprofiler.libs.colormaps import get_cmap # the matplotlib 2.0 colourmaps aren't available on RPi yet...
+			self.im_obj.set_cmap(get_cmap('inferno')) #cm.PuOr_r #gist_heat #afmhot # binary_r
+			self.canvas.draw()
+		
+	def open_hardware(self):
+		""" Open the camera and translation stage (runs in a background thread) """
+		try:
+			with startup_timers.stage('camera'):
+				camera = open_camera()
+			with startup_timers.stage('stage'):
+				stepper = open_stage(self)
+		except Exception as e:
+			wx.CallAfter(self.OnHardwareFailed, e)
+			return
+		wx.CallAfter(self.OnHardwareReady, camera, stepper)
+		
+	def OnHardwareReady(self,camera,stepper):
+		self.camera = camera
+		self.Stepper = stepper
+		self.settings.apply_to_camera(camera)
+		startup_timers.add('ready', time.time() - _t_start)
+		print 'Camera and translation stage ready - start up times (s):'
+		print startup_timers.report()
+		self.TranslationStageCalibration()
+		
+	def OnHardwareFailed(self,error):
+		dlg = wx.MessageDialog(self, "Could not open the camera and translation stage - please check for hardware errors...\n\n" \
+						+ '%s: %s' % (type(error).__name__, error), "Hardware Error", wx.OK|wx.ICON_ERROR)
+		dlg.ShowModal()
+		dlg.Destroy()
+		
+	def hardware_ready(self):
+		""" True once the camera and stage are open; otherwise tell the user to wait """
+		if self.camera is not None and self.Stepper is not None:
+			return True
+		dlg = wx.MessageDialog(self, "The camera and translation stage are still starting up - please wait a moment...", \
+						"Starting up", wx.OK|wx.ICON_INFORMATION)
+		dlg.ShowModal()
+		dlg.Destroy()
+		return False
 
 #
 ##
@@ -820,63 +1082,180 @@ class MainWin(wx.Frame):
 ##
 #		
 	def OnToggleLiveView(self,event,cam):
+		if not self.hardware_ready():
+			self.LiveViewButton.SetValue(self.LiveViewActive)
+			return
 		if not self.LiveViewActive:
-			cam.framerate = 30
-			cam.preview_fullscreen = False
-			cam.preview_window = (100,100,1000,750)
-			self.prev_exp_mode = cam.exposure_mode
-			cam.exposure_mode = 'auto'
-			cam.start_preview()
+			# preview with the beam widths and ellipse over it, at the capture exposure
+			self.live_view = LiveAnalyser(cam, on_frame=self.live_view_frame)
+			self.live_view.start()
 			self.LiveViewActive = True
 			self.LiveViewButton.SetLabel("LiveView (ON)")
+			self.GetStatusBar().Show(True)
+			self.SendSizeEvent()
 		else:
-			cam.stop_preview()
-			cam.framerate = 1
-			cam.exposure_mode = self.prev_exp_mode
+			self.live_view.stop()
+			print 'Live view analysed', self.live_view.frames, 'frames'
+			self.live_view = None
 			self.LiveViewActive = False
 			self.LiveViewButton.SetLabel("LiveView (off)")
+			self.GetStatusBar().Show(self.ShowTimings)
+			self.SendSizeEvent()
+			self.update_timing_status()
+			
+	def live_view_frame(self,metrics):
+		""" Called (from the camera's thread) with the analysis of each live view frame """
+		if self.streamer is not None:
+			self.streamer.publish(metrics)
+		now = monotonic()
+		if now - self.live_status_time >= LIVE_STATUS_INTERVAL:
+			self.live_status_time = now
+			wx.CallAfter(self.SetStatusText, live_annotation(metrics) + '  (%.0f fps)' % metrics['fps'])
 
 	def OnCamSet(self,event):
+		if not self.hardware_ready():
+			return
 		dlg = CameraSettings(self, wx.ID_ANY, 'Camera Settings')
 	
 		if dlg.ShowModal() == wx.ID_OK:
-			# UPDATE DEFAULT VALUES SO THE NEXT TIME THIS IS CALLED THE NUMBERS CHANGE
-			DialogOptions.ExpTime = str(dlg.ExpTime)
-			DialogOptions.Col = dlg.Col
-			DialogOptions.ExpAuto = dlg.ExpAuto
-			DialogOptions.ROIxminval = dlg.ROIxminval
-			DialogOptions.ROIxmaxval = dlg.ROIxmaxval
-			DialogOptions.ROIyminval = dlg.ROIyminval
-			DialogOptions.ROIymaxval = dlg.ROIymaxval
-			DialogOptions.crop = (dlg.ROIxminval, dlg.ROIxmaxval-dlg.ROIxminval, \
-									dlg.ROIyminval, dlg.ROIymaxval-dlg.ROIyminval)
+			# UPDATE SETTINGS SO THE NEXT TIME THIS IS CALLED THE NUMBERS CHANGE
+			dlg.store_settings()
 												
 		dlg.Destroy()
 	
 	def OnScanSet(self,event):
+		if not self.hardware_ready():
+			return
 		dlg = ScanSettings(self,wx.ID_ANY, "Translation Scan Settings")
 		
 		if dlg.ShowModal() == wx.ID_OK:
 			## update defaults on OK
-			setpos,startpos,stoppos,stepsize = dlg.get_values()
-			DialogOptions.set_pos = setpos
-			DialogOptions.scan_start_pos = startpos
-			DialogOptions.scan_stop_pos = stoppos
-			DialogOptions.step_size = stepsize
+			setpos,startpos,stoppos,stepsize,wavelength,uncertainty = dlg.get_values()
+			try:
+				self.settings.update(set_pos=setpos, scan_start=startpos, scan_stop=stoppos, step_size=stepsize,
+									wavelength_nm=wavelength, uncertainty=uncertainty)
+			except ValueError as e:
+				msg = wx.MessageDialog(self, "Scan settings not changed:\n\n"+str(e), "Scan Settings", wx.OK|wx.ICON_ERROR)
+				msg.ShowModal()
+				msg.Destroy()
 		
 		dlg.Destroy()
 		
 	def OnClearDataButton(self,event):
+		self.clear_data()
+		if self.camera is not None:
+			self.update_main_imshow()
+			
+	def clear_data(self):
+		""" Forget the widths measured in previous scans """
 		self.xposdata = []
 		self.xwidthdata = []
 		self.yposdata = []
 		self.ywidthdata = []
 		self.xwidtherr = []
 		self.ywidtherr = []	
-		
-		self.update_main_imshow()
+		self.scan_first_point = 0
+		self.outliers = None
+		self.xwoutliers.set_data([],[])
+		self.ywoutliers.set_data([],[])
+		
+	def OnShowTimings(self,event):
+		self.ShowTimings = bool(event.Checked())
+		self.GetStatusBar().Show(self.ShowTimings)
+		self.SendSizeEvent()
+		self.update_timing_status()
+		
+	def OnStreamResults(self,event):
+		if event.Checked():
+			self.streamer = MetricsPublisher(STREAM_PORT)
+			try:
+				print 'Streaming results on port', self.streamer.start()[1]
+			except socket.error as e:
+				self.streamer = None
+				event.GetEventObject().SetValue(False)
+				dlg = wx.MessageDialog(self, "Could not start streaming on port "+str(STREAM_PORT)+":\n\n"+str(e), \
+						"Streaming Error", wx.OK|wx.ICON_ERROR)
+				dlg.ShowModal()
+				dlg.Destroy()
+		elif self.streamer is not None:
+			self.streamer.stop()
+			self.streamer = None
+	
+	def OnRemoteControl(self,event):
+		if event.Checked():
+			self.control_server = ControlServer(GuiController(self), CONTROL_PORT)
+			try:
+				print 'Remote control on port', self.control_server.start()[1]
+			except socket.error as e:
+				self.control_server = None
+				event.GetEventObject().SetValue(False)
+				dlg = wx.MessageDialog(self, "Could not start remote control on port "+str(CONTROL_PORT)+":\n\n"+str(e), \
+						"Remote Control Error", wx.OK|wx.ICON_ERROR)
+				dlg.ShowModal()
+				dlg.Destroy()
+		elif self.control_server is not None:
+			self.control_server.stop()
+			self.control_server = None
+			
+	## remote control requests (see GuiController) - these run in the GUI thread
+	def remote_update_settings(self,changes):
+		if self.scanning:
+			raise RuntimeError('Settings cannot be changed during a scan')
+		self.settings.update(**changes)
+		if self.camera is not None:
+			self.settings.apply_to_camera(self.camera)
+		return self.settings.as_dict()
+		
+	def remote_start_scan(self):
+		""" Start a scan, from cleared data """
+		if self.camera is None or self.Stepper is None:
+			raise RuntimeError('The camera and translation stage are still starting up')
+		if self.scanning:
+			raise RuntimeError('A scan is already running')
+		if self.monitor is not None:
+			raise RuntimeError('Beam monitoring is running - stop it first')
+		if self.settings.save_each_image and not self.settings.image_prefix:
+			raise ValueError('image_prefix must be set to save each image')
+		self.clear_data()
+		self.scanning = True
+		wx.CallAfter(self.OnStartScan,None)
+		return dict(state='starting', scan=self.scans+1)
+		
+	def remote_stop_scan(self):
+		self.OnStopScan(None)
+		return self.scan_status()
+		
+	def scan_status(self):
+		return dict(state='scanning' if self.scanning else 'idle', scan=self.scans, positions=self.scan_n_positions,
+					positions_done=len(self.xposdata)-self.scan_first_point,
+					completed=self.scan_stats['completed'] if self.scan_stats and not self.scanning else None,
+					position=self.Stepper.get_position() if self.Stepper is not None else None)
+					
+	def scan_results(self):
+		if self.scans == 0:
+			raise RuntimeError('No scan has been run')
+		first = self.scan_first_point
+		points = [dict(position=p, wx=xw, wx_err=xe, wy=yw, wy_err=ye) for p, xw, xe, yw, ye in 
+					zip(self.xposdata[first:], self.xwidthdata[first:], self.xwidtherr[first:], 
+						self.ywidthdata[first:], self.ywidtherr[first:])]
+		return dict(scan=self.scans, points=points, caustic=self.caustic, beam_quality=self.beam_quality,
+					confidence_intervals=self.intervals, stats=self.scan_stats if not self.scanning else None)
+					
+	def remote_export(self,filename):
+		if self.scanning or self.caustic is None:
+			raise RuntimeError('No completed scan to export')
+		if not filename.endswith('.csv'):
+			raise ValueError('filename must end in .csv')
+		return dict(files=self.export_data(filename))
+	
+	def update_timing_status(self):
+		""" Update the stage timing summary in the status bar, if it is shown """
+		if self.ShowTimings:
+			self.SetStatusText(timers.status_text())
 		
 	def OnAcqSet(self,event):
+		if not self.hardware_ready():
+			return
 		print 'Acquiring image...'
 		self.camera.capture_image()
 		print 'Fitting image...'
@@ -902,7 +1281,7 @@ class MainWin(wx.Frame):
 		self.axY.set_xlim(min(0,1.1*self.xslice.get_ydata().min()),1.1*self.yslice.get_xdata().max())
 		
 		#update axes limits for bottom plots
-		self.axXwidth.set_xlim(DialogOptions.scan_start_pos,DialogOptions.scan_stop_pos)
+		self.axXwidth.set_xlim(self.settings.scan_start,self.settings.scan_stop)
 		if len(self.xposdata)>0:
 			self.axXwidth.set_ylim(self.xwline.get_data()[1].min()*0.8, \
 									self.xwline.get_data()[1].max()*1.1)
@@ -923,36 +1302,29 @@ class MainWin(wx.Frame):
 		self.im_min.set_text('Min pixel value:'+str(int(cam.image.min())))
 		self.im_max.set_text('Max pixel value:'+str(int(cam.image.max())))
 		
-		self.canvas.draw()
+		with timers.stage('draw'):
+			self.canvas.draw()
+		self.update_timing_status()
+		
+		if self.streamer is not None and self.frame_metrics is not None:
+			self.streamer.publish(self.frame_metrics,cam.image)
 				
-	def fit_image(self):
+	def fit_image(self,engine=None):
+		""" 
+		Fit Gaussians to the x and y projections of the image. engine is 'accurate' 
+		(weighted non-linear least squares) or 'fast' (closed-form log-parabola estimate only).
+		Defaults to the engine selected in the camera settings.
+		"""
 		img = self.camera
+		if engine is None:
+			engine = self.settings.fit_engine
 		## gaussian fitting routine here...
 		
 		# NOTE: img.Xs and img.Ys are taken from only the current region-of-interest
 		
-		try:
-			p0 = [img.imageX.max(),img.Xs[img.imageX.argmax()],0.1*(img.roi[1]-img.roi[0]),10]
-			print 'Initial params X:',p0
-			xpopt, xperr = curve_fit(gaussian,img.Xs,img.imageX,p0=p0)
-			xpopt[2] = abs(xpopt[2])
-			xerrs = np.sqrt(xperr.diagonal())
-		except RuntimeError:
-			print 'Runtime Error (X fit) - probably caused by fitting not converging. Using initial params'
-			xpopt = p0
-			xperr = np.ones((len(xpopt),len(xpopt)))*p0[0]
-			xerrs = np.sqrt(xperr.diagonal())
-		try:
-			p0 = [img.imageY.max(),img.Ys[img.imageY.argmax()],0.1*(img.roi[3]-img.roi[2]),0]
-			print 'Initial params Y:',p0
-			ypopt, yperr = curve_fit(gaussian,img.Ys,img.imageY,p0=p0)
-			ypopt[2] = abs(ypopt[2])
-			yerrs = np.sqrt(yperr.diagonal())
-		except RuntimeError:
-			print 'Runtime Error (Y fit) - probably caused by fitting not converging. Using initial params'
-			ypopt = p0
-			yperr = np.ones((len(xpopt),len(xpopt)))*p0[0]
-			yerrs = np.sqrt(yperr.diagonal())
+		with timers.stage('fit'):
+			xpopt, xerrs, ypopt, yerrs = fit_profiles(img.Xs,img.imageX,img.Ys,img.imageY, \
+											img.imageX_var,img.imageY_var,engine)
 		
 		#update plot data
 		self.xfitdata[0] = img.Xs
@@ -962,34 +1334,177 @@ class MainWin(wx.Frame):
 		
 		#update data for text strings
 		self.imagefitparams = xpopt[2]*1e3,xerrs[2]*1e3,ypopt[2]*1e3,yerrs[2]*1e3
+		self.frame_metrics = dict(position=self.Stepper.get_position(), x0=xpopt[1], y0=ypopt[1],
+							wx=xpopt[2]*1e3, wx_err=xerrs[2]*1e3, wy=ypopt[2]*1e3, wy_err=yerrs[2]*1e3,
+							shutter_speed=img.shutter_speed)
 		
 		#return widths
 		return xpopt[2]*1e3,xerrs[2]*1e3,ypopt[2]*1e3,yerrs[2]*1e3 # convert to microns
 		
+	def add_scan_point(self,pos,xw,xwerr,yw,ywerr):
+		""" Add the widths measured at stage position pos to the scan data and width plots """
+		#update fit arrays
+		self.xposdata.append(pos)
+		self.yposdata.append(pos)
+		self.xwidthdata.append(xw)
+		self.xwidtherr.append(xwerr)
+		self.ywidthdata.append(yw)
+		self.ywidtherr.append(ywerr)
+		
+		x = np.array(self.xposdata)
+		y = np.array(self.xwidthdata)
+		yerr = np.array(self.xwidtherr)
+		
+		#update fit plots - messy due to the errorbars!!
+		#update data
+		self.xwline.set_data(x,y)
+		#find end points of errorbars
+		error_positions = (x,y),(x,y),(x,y-yerr),(x,y+yerr)
+		#update caplines
+		#print self.xwcaplines[0]
+		#for i,pos in enumerate(error_positions):
+		#	self.xwcaplines[i].set_data(pos)
+		#update bars
+		self.xwbarlines[0].set_segments(np.array([[x,y-yerr],[x,y+yerr]]).transpose((2,0,1)))
+		
+		x = np.array(self.yposdata)
+		y = np.array(self.ywidthdata)
+		yerr = np.array(self.ywidtherr)
+		
+		#update fit plots - messy due to the errorbars!!
+		#update data
+		self.ywline.set_data(x,y)
+		#find end points of errorbars
+		#error_positions = (x,y),(x,y),(x,y-yerr),(x,y+yerr)
+		#update caplines
+		#for i,pos in enumerate(error_positions):
+		#	self.ywcaplines[i].set_data(pos)
+		#update bars
+		self.ywbarlines[0].set_segments(np.array([[x,y-yerr],[x,y+yerr]]).transpose((2,0,1)))
+	
+	def get_fit_pool(self,frame_shape):
+		""" Worker process pool for fitting frames of frame_shape (started when first needed) """
+		if self.fit_pool is None or self.fit_pool.frame_shape != tuple(frame_shape):
+			self.release_display_frame()
+			if self.fit_pool is not None:
+				self.fit_pool.close()
+			self.fit_pool = FitWorkerPool(frame_shape,darkframe_file=self.camera.darkframes.filename)
+		return self.fit_pool
+	
+	def capture_for_fitting(self,first=False):
+		""" 
+		Capture a frame and queue it for fitting in the worker pool. Frames are captured 
+		straight into a slot of the pool's frame ring, apart from the first frame of a 
+		scan, which sets the frame size.
+		"""
+		if first or self.fit_pool is None:
+			frame = self.camera.capture_raw()
+			self.get_fit_pool(frame.shape).submit(frame,self.fit_task())
+		else:
+			slot = self.fit_pool.acquire_slot()
+			self.camera.capture_raw(out=self.fit_pool.ring.frames[slot])
+			self.fit_pool.submit_slot(slot,self.fit_task())
+	
+	def show_latest_frame(self):
+		""" Display the newest frame in the worker pool's ring, holding a read lease on it """
+		ring = self.fit_pool.ring
+		if ring.latest is None or ring.latest == self.display_slot:
+			return
+		self.release_display_frame()
+		self.camera.image = ring.acquire_read(ring.latest)
+		self.display_slot = ring.latest
+		
+	def release_display_frame(self,keep=False):
+		""" Release the read lease on the displayed frame - with keep=True, keep a copy of it """
+		if self.display_slot is None:
+			return
+		if keep:
+			self.camera.image = self.camera.image.copy()
+		self.fit_pool.ring.release(self.display_slot)
+		self.display_slot = None
+	
+	def fit_task(self):
+		""" Settings for processing the frame just captured in the fitting worker pool """
+		cam = self.camera
+		nm = cam.noise_model
+		return dict(position=self.Stepper.get_position(), col=cam.col, shutter_speed=cam.shutter_speed,
+					bg_subtract=cam.bg_subtract, roi=list(cam.roi), ccd_xsize=cam.ccd_xsize, ccd_ysize=cam.ccd_ysize,
+					noise_model=(nm.gain,nm.read_noise,nm.dark_current), engine=self.settings.fit_engine)
+	
+	def apply_pool_results(self,block=False):
+		""" Add the results that have come back from the fitting worker pool to the scan data """
+		if self.fit_pool is None:
+			return
+		results = self.fit_pool.results(block)
+		for result in results:
+			for name, duration in result['timings'].items():
+				timers.add(name,duration)
+			add_fit_stats(result['fit_stats'])
+			cam = self.camera
+			cam.Xs, cam.imageX, cam.Ys, cam.imageY = result['Xs'], result['imageX'], result['Ys'], result['imageY']
+			self.xfitdata = [cam.Xs, gaussian(cam.Xs,*result['xparams'])]
+			self.yfitdata = [gaussian(cam.Ys,*result['yparams']), cam.Ys]
+			
+			# widths in microns
+			xw, xwerr = result['xparams'][2]*1e3, result['xerrs'][2]*1e3
+			yw, ywerr = result['yparams'][2]*1e3, result['yerrs'][2]*1e3
+			self.imagefitparams = xw, xwerr, yw, ywerr
+			self.frame_metrics = dict(position=result['position'], x0=result['xparams'][1], y0=result['yparams'][1],
+							wx=xw, wx_err=xwerr, wy=yw, wy_err=ywerr, shutter_speed=result['shutter_speed'])
+			self.add_scan_point(result['position'], xw, xwerr, yw, ywerr)
+		if results:
+			self.show_latest_frame()
+			self.update_main_imshow()
+		
 	def OnStartScan(self,event):
 		######## IMPLEMENT THREADING here ? ####
+		if not self.hardware_ready() or self.monitor is not None:
+			return
 		
-		
-		if self.SaveEachImage:
+		save_each_image = self.settings.save_each_image
+		image_prefix = self.settings.image_prefix
+		if save_each_image and not image_prefix:
 			# bring up dialog for save file names
 			SaveFileDialog = wx.FileDialog(self,"Autosave each image", "/media", "bp_scan_images_",
 					"Pickle files (*.pkl)|*.pkl", wx.FD_SAVE)
 
-			if SaveFileDialog.ShowModal() == wx.ID_OK:
-				output_filename_prefix = SaveFileDialog.GetPath()
+			if SaveFileDialog.ShowModal() != wx.ID_OK:
 				SaveFileDialog.Destroy()
+				return
+			image_prefix = SaveFileDialog.GetPath()[:-4]
+			SaveFileDialog.Destroy()
 			
 			
+		# hand frames over to the fitting worker processes, unless each processed image is needed here
+		use_pool = self.settings.use_worker_pool and self.camera.acq_mode == 'single' and not save_each_image
+		
 		self.scanning = True
-		positions_array = np.arange(DialogOptions.scan_start_pos,
-				DialogOptions.scan_stop_pos+DialogOptions.step_size,
-				DialogOptions.step_size)
+		self.scans += 1
+		self.scan_first_point = len(self.xposdata)
+		self.caustic = None
+		self.outliers = None
+		self.beam_quality = None
+		self.intervals = None
+		self.xm2_text.set_text('')
+		self.ym2_text.set_text('')
+		self.xwoutliers.set_data([],[])
+		self.ywoutliers.set_data([],[])
+		timers.reset()
+		if self.fit_pool is not None:
+			self.fit_pool.reset_counters()
+		scan_start = dict(time=monotonic(), started=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+						ae_iterations=self.camera.exposure.iterations,
+						steps=self.Stepper.steps_issued, fit_stats=dict(fit_stats))
+		positions_array = scan_positions(self.settings.scan_start,
+				self.settings.scan_stop, self.settings.step_size)
+		self.scan_n_positions = len(positions_array)
 		
 		#loop around positions
 		i=0
 		while i<len(positions_array):
 			#go to correct position
-			self.Stepper.set_position(positions_array[i])
+			with timers.stage('move'):
+				self.Stepper.set_position(positions_array[i])
 			print 'Testing - position:', self.Stepper.get_position()
 			
 			#yield to allow other buttons to process
@@ -999,12 +1514,23 @@ class MainWin(wx.Frame):
 				break
 			
 			#get image
+			if use_pool:
+				# queue the raw frame for fitting, and carry on to the next position straight away
+				self.capture_for_fitting(first=(i==0))
+				self.apply_pool_results()
+				i+=1
+				continue
+			
 			self.camera.capture_image()
 			
 			#save it if required
-			if self.SaveEachImage:
-				img_fn = output_filename_prefix[:-4]+str(i)+'.pkl'
-				pickle.dump(self.camera.image,open(img_fn,'wb'))
+			if save_each_image:
+				with timers.stage('save'):
+					img_fn = image_prefix+str(i)+'.pkl'
+					pickle.dump(self.camera.image,open(img_fn,'wb'))
+					# keep track of the position of each image, for reprocess_scan.py
+					with open(image_prefix+'positions.csv','a') as posfile:
+						posfile.write(str(i)+','+str(self.Stepper.get_position())+'\n')
 			
 			#yield to allow other buttons to process
 			wx.Yield()
@@ -1021,44 +1547,8 @@ class MainWin(wx.Frame):
 				print 'Quitting scan loop...'
 				break
 			
-			#update fit arrays
-			self.xposdata.append(self.Stepper.get_position())
-			self.yposdata.append(self.Stepper.get_position())
-			self.xwidthdata.append(xw)
-			self.xwidtherr.append(xwerr)
-			self.ywidthdata.append(yw)
-			self.ywidtherr.append(ywerr)
-			
-			x = np.array(self.xposdata)
-			y = np.array(self.xwidthdata)
-			yerr = np.array(self.xwidtherr)
-			
-			#update fit plots - messy due to the errorbars!!
-			#update data
-			self.xwline.set_data(x,y)
-			#find end points of errorbars
-			error_positions = (x,y),(x,y),(x,y-yerr),(x,y+yerr)
-			#update caplines
-			#print self.xwcaplines[0]
-			#for i,pos in enumerate(error_positions):
-			#	self.xwcaplines[i].set_data(pos)
-			#update bars
-			self.xwbarlines[0].set_segments(np.array([[x,y-yerr],[x,y+yerr]]).transpose((2,0,1)))
-			
-			x = np.array(self.yposdata)
-			y = np.array(self.ywidthdata)
-			yerr = np.array(self.ywidtherr)
-			
-			#update fit plots - messy due to the errorbars!!
-			#update data
-			self.ywline.set_data(x,y)
-			#find end points of errorbars
-			#error_positions = (x,y),(x,y),(x,y-yerr),(x,y+yerr)
-			#update caplines
-			#for i,pos in enumerate(error_positions):
-			#	self.ywcaplines[i].set_data(pos)
-			#update bars
-			self.ywbarlines[0].set_segments(np.array([[x,y-yerr],[x,y+yerr]]).transpose((2,0,1)))
+			#update fit arrays and plots
+			self.add_scan_point(self.Stepper.get_position(), xw, xwerr, yw, ywerr)
 			
 			self.update_main_imshow()
 			
@@ -1068,39 +1558,44 @@ class MainWin(wx.Frame):
 		else: ##   << else belongs to the while construct
 			print 'Scan completed without quitting...'
 			
-			#sort data with increasing position for fitting
-			ZXY = zip(self.xposdata, self.xwidthdata, self.xwidtherr, self.ywidthdata, self.ywidtherr)
-			ZXY = sorted(ZXY, key=lambda f: f[0])
-			pos, xw, xe, yw, ye = zip(*ZXY)
+			# wait for the last frames to be fitted
+			if use_pool:
+				self.apply_pool_results(block=True)
 			
-			#fit waist function to position/width data (x and y)
-			try:
-				xfocus, xfocuserr = curve_fit(focussed_gaussian,pos, xw, sigma=xe)
-			except:
-				print '!! Caution - some issue with X width fitting !!'
-				try: 
-					print 'Trying fitting without using errorbars...',
-					xfocus, xfocuserr = curve_fit(focussed_gaussian,pos, xw)#, sigma=xe)
-				except:
-					print "But that didn't work either \nContinuing without fitting"
-					xfocus, xfocuserr = np.array([1,1,1]),np.array([[0,0,0],[0,0,0],[0,0,0]])
-					
-			try:
-				yfocus, yfocuserr = curve_fit(focussed_gaussian,pos, yw, sigma=ye)
-			except:
-				print '!! Caution - some issue with Y width fitting !!'
-				try: 
-					print 'Trying fitting without using errorbars...',
-					yfocus, yfocuserr = curve_fit(focussed_gaussian,pos, yw)
-				except:
-					print "But that didn't work either \nContinuing without fitting"
-					yfocus, yfocuserr = np.array([1,1,1]),np.array([[0,0,0],[0,0,0],[0,0,0]])
+			#fit waist function to position/width data (x and y), leaving out bad points
+			xfocus, xfocuserr, yfocus, yfocuserr, self.outliers = fit_scan_caustics(self.xposdata, \
+											self.xwidthdata, self.xwidtherr, self.ywidthdata, self.ywidtherr)
+			
+			# store for export - in the order waist, Rayleigh range, focus position
+			self.xfitparams, self.xfiterrs = export_order(xfocus), export_order(xfocuserr)
+			self.yfitparams, self.yfiterrs = export_order(yfocus), export_order(yfocuserr)
+			self.caustic = caustic_summary(self.xfitparams, self.xfiterrs, self.yfitparams, self.yfiterrs, \
+											self.xposdata, self.outliers)
 			
-			xfocuserr = np.sqrt(xfocuserr.diagonal())
-			yfocuserr = np.sqrt(yfocuserr.diagonal())
+			# mark the outliers on the width plots
+			pos = np.array(self.xposdata)
+			self.xwoutliers.set_data(pos[self.outliers[0]], np.array(self.xwidthdata)[self.outliers[0]])
+			self.ywoutliers.set_data(pos[self.outliers[1]], np.array(self.ywidthdata)[self.outliers[1]])
+			
+			# M-squared (ISO 11146) from the same widths
+			self.beam_quality = caustic_beam_quality(self.xposdata, self.xwidthdata, self.xwidtherr, \
+											self.ywidthdata, self.ywidtherr, self.settings.wavelength_nm, self.outliers)
+			for axis, text in (('x', self.xm2_text), ('y', self.ym2_text)):
+				q = self.beam_quality[axis]
+				text.set_text(r'$M^2 =$ %.3g $\pm$ %.2g,  $\theta =$ %.3g mrad' % (q['m2'], q['m2_err'], q['divergence']))
+			print 'M-squared:', round(self.beam_quality['x']['m2'],3), '(x),', round(self.beam_quality['y']['m2'],3), \
+					'(y) - astigmatic distance', round(self.beam_quality['astigmatic_distance'],3), 'mm'
+			if self.settings.uncertainty != 'covariance':
+				self.intervals = resample_caustic(self.xposdata, self.xwidthdata, self.xwidtherr, \
+											self.ywidthdata, self.ywidtherr, self.settings.wavelength_nm, \
+											self.settings.uncertainty, outliers=self.outliers)
+				for axis in ('x', 'y'):
+					ci = self.intervals[axis]['m2']
+					print 'M-squared', axis, '%g%% interval:' % (100*self.intervals['confidence']), \
+							round(ci['low'],3), '-', round(ci['high'],3)
 			
 			#update plot lines
-			xx = np.linspace(DialogOptions.scan_start_pos,DialogOptions.scan_stop_pos,400)
+			xx = np.linspace(self.settings.scan_start,self.settings.scan_stop,400)
 			self.xwfit.set_data(xx, focussed_gaussian(xx,*xfocus))
 			self.ywfit.set_data(xx, focussed_gaussian(xx,*yfocus))
 			
@@ -1112,6 +1607,117 @@ class MainWin(wx.Frame):
 			
 			#finally, change 'scanning' back to false
 			self.scanning=False
+		
+		# keep any frames that were fitted before the scan was stopped
+		if use_pool:
+			self.apply_pool_results(block=True)
+			self.release_display_frame(keep=True)
+			print 'Frame ring:', self.fit_pool.ring.stats(), '- fit failures:', self.fit_pool.failures
+		
+		self.scan_stats = self.scan_statistics(scan_start, i, len(positions_array), use_pool)
+		print 'Scan stage timings:'
+		print timers.report()
+		self.update_timing_status()
+	
+	def scan_statistics(self,scan_start,n_done,n_positions,use_pool):
+		""" Statistics of the scan that has just finished, for the run report """
+		cam = self.camera
+		stats = dict(started=scan_start['started'], duration_s=monotonic()-scan_start['time'],
+					positions=n_positions, positions_done=n_done, completed=n_done>=n_positions,
+					acq_mode=cam.acq_mode, auto_exposure=(cam.auto_exp=='auto'),
+					fit_engine=self.settings.fit_engine, worker_pool=use_pool,
+					ae_iterations=cam.exposure.iterations-scan_start['ae_iterations'],
+					stage_steps=self.Stepper.steps_issued-scan_start['steps'],
+					frames=n_done, dropped_frames=0, fit_failures=0)
+		stats['fit_stats'] = dict((key, fit_stats[key]-scan_start['fit_stats'].get(key,0)) for key in fit_stats)
+		if use_pool and self.fit_pool is not None:
+			ring = self.fit_pool.ring.stats()
+			stats.update(frames=ring['frames'], dropped_frames=ring['dropped'], fit_failures=self.fit_pool.failures,
+						workers_peak_rss_kb=self.fit_pool.peak_rss_kb())
+		stats['fit_failures'] += stats['fit_stats']['profile_failures']
+		# stage timings of this scan only - later captures also add to timers
+		stats['stages'] = timers.summary()
+		return stats
+		
+	def OnToggleMonitor(self,event):
+		if self.monitor is not None:
+			# stops the loop in run_monitor()
+			self.monitor.stop()
+			return
+		self.MonitorButton.SetValue(False)
+		if not self.hardware_ready() or self.scanning:
+			return
+			
+		# captures per second, and the time series file
+		dlg = wx.TextEntryDialog(self, "Captures per second:", "Beam Monitoring", str(self.settings.monitor_rate))
+		ok = dlg.ShowModal() == wx.ID_OK
+		rate = dlg.GetValue()
+		dlg.Destroy()
+		if not ok:
+			return
+		try:
+			self.settings.update(monitor_rate=rate)
+		except ValueError as e:
+			msg = wx.MessageDialog(self, str(e), "Beam Monitoring", wx.OK|wx.ICON_ERROR)
+			msg.ShowModal()
+			msg.Destroy()
+			return
+		SaveFileDialog = wx.FileDialog(self,"Monitoring time series file", "/media", "beamprofiler_monitor",
+			"Time series (*.bpts)|*.bpts", wx.FD_SAVE)
+		ok = SaveFileDialog.ShowModal() == wx.ID_OK
+		filename = SaveFileDialog.GetPath()
+		SaveFileDialog.Destroy()
+		if not ok:
+			return
+			
+		self.monitor = BeamMonitor(self.camera, filename, self.settings.monitor_rate, self.Stepper.get_position())
+		self.MonitorButton.SetValue(True)
+		self.MonitorButton.SetLabel("Monitor Beam (ON)")
+		self.GetStatusBar().Show(True)
+		self.SendSizeEvent()
+		try:
+			self.run_monitor()
+		finally:
+			summary = self.monitor.summary()
+			self.monitor.close()
+			self.monitor = None
+			# the window may have been closed (OnExit) while monitoring
+			if not self.IsBeingDeleted():
+				self.MonitorButton.SetValue(False)
+				self.MonitorButton.SetLabel("Monitor Beam (off)")
+				self.GetStatusBar().Show(self.ShowTimings)
+				self.SendSizeEvent()
+		print 'Monitoring finished:', summary['samples'], 'samples, jitter', round(summary['jitter_rms_um'],2), \
+				'um RMS,', summary['missed_slots'], 'missed captures - written to', filename
+		
+	def run_monitor(self):
+		""" Capture on the monitor's schedule until it is stopped, keeping the GUI responsive """
+		monitor = self.monitor
+		monitor.running = True
+		last_draw = -np.inf
+		while monitor.running:
+			wx.Yield()
+			# stopped (or the application closed) while handling events
+			if not monitor.running:
+				break
+			wait = monitor.time_to_next()
+			if wait > 0:
+				time.sleep(min(wait, 0.05))
+				continue
+			record = monitor.sample()
+			if monotonic() - last_draw < MONITOR_DRAW_INTERVAL:
+				continue
+			# show the latest frame and fit
+			cam = self.camera
+			xpopt, ypopt = monitor.last_fit
+			self.xfitdata = [cam.Xs, gaussian(cam.Xs,*xpopt)]
+			self.yfitdata = [gaussian(cam.Ys,*ypopt), cam.Ys]
+			self.imagefitparams = record['wx'].item(), np.nan, record['wy'].item(), np.nan
+			self.frame_metrics = dict((name, record[name].item()) for name in record.dtype.names)
+			self.update_main_imshow()
+			self.SetStatusText(monitor.stats.status_text())
+			last_draw = monotonic()
+		monitor.writer.flush()
 	
 	def OnStopScan(self,event):
 		self.scanning = False
@@ -1139,35 +1745,62 @@ class MainWin(wx.Frame):
 				else:
 					OverwriteDialog.Destroy()
 					time.sleep(0.05)
-			z,x,xe,y,ye = self.xposdata, self.xwidthdata, self.xwidtherr, \
-						  self.ywidthdata, self.ywidtherr
-			dataout = zip(z,x,xe,y,ye)
-			dataout = sorted(dataout, key=lambda f: f[0]) #sort by position
-			write_csv(dataout,profile_filename) ## << should use numpy.writetxt instead...
-						
-			## profile fit data
-			fits_filename = output_filename[:-4] + "_profilefitparams.csv"
-			with open(fits_filename, 'wb') as csvfile:
-				csv_writer = csv.writer(csvfile,delimiter=',')
-				csv_writer.writerow(['X axis','','errors on line below'])
-				csv_writer.writerow(['1/e2 radius (micron)','Rayleigh range (mm)','Position of center (mm)'])
-				csv_writer.writerow(self.xfitparams)
-				csv_writer.writerow(self.xfiterrs)
-				csv_writer.writerow(['Y axis','','errors on line below'])
-				csv_writer.writerow(['1/e2 radius (micron)','Rayleigh range (mm)','Position of center (mm)'])
-				csv_writer.writerow(self.yfitparams)
-				csv_writer.writerow(self.yfiterrs)
+			files = self.export_data(output_filename)
+			fits_filename = files[1]
+			report_message = ''
+			for filename in files[2:]:
+				if filename.endswith('_outliers.csv'):
+					report_message += "\n -- Caustic fit outliers: "+filename
+				elif filename.endswith('_m2.csv'):
+					report_message += "\n -- M-squared: "+filename
+				else:
+					report_message += "\n -- Run report: "+filename
 			
 			SaveMessage = wx.MessageDialog(self, \
 				"Files created:\n\n  -- Beam profile data: "\
-				+profile_filename+"\n -- Profile fit parameters: "+fits_filename, \
+				+profile_filename+"\n -- Profile fit parameters: "+fits_filename+report_message, \
 				"Files created", wx.OK|wx.ICON_INFORMATION)
 			SaveMessage.ShowModal()
 			SaveMessage.Destroy()
 			print "Data Save finished"
 
+	def export_data(self,output_filename):
+		""" 
+		Write the widths to output_filename (csv), the caustic fit parameters and (after a scan) 
+		the outlier flags, M-squared and the run report next to it - returns the list of files written 
+		"""
+		write_widths(output_filename, self.xposdata, self.xwidthdata, self.xwidtherr, \
+					  self.ywidthdata, self.ywidtherr)
+		files = [output_filename]
+					
+		## profile fit data
+		fits_filename = output_filename[:-4] + "_profilefitparams.csv"
+		write_fit_params(fits_filename, self.xfitparams, self.xfiterrs, self.yfitparams, self.yfiterrs)
+		files.append(fits_filename)
+		
+		## points left out of the caustic fits
+		if self.outliers is not None:
+			outliers_filename = output_filename[:-4] + "_outliers.csv"
+			write_outliers(outliers_filename, self.xposdata, self.outliers)
+			files.append(outliers_filename)
+		
+		## M-squared
+		if self.beam_quality is not None:
+			m2_filename = output_filename[:-4] + "_m2.csv"
+			write_beam_quality(m2_filename, self.beam_quality, self.intervals)
+			files.append(m2_filename)
+		
+		## how the scan ran - timings, dropped frames, fit statistics etc.
+		if self.scan_stats is not None:
+			report_filename = output_filename[:-4] + "_runreport.json"
+			write_run_report(run_report(self.scan_stats,SOFTWARE_VERSION,startup_timers),report_filename)
+			files.append(report_filename)
+		return files
+
 	def OnExportImage(self,event):
 		""" Saves the image data to a pkl file """
+		if not self.hardware_ready():
+			return
 		SaveFileDialog = wx.FileDialog(self,"Save Output File", "/media", "beamprofiler_output",
 			"Pickle files (*.pkl)|*.pkl", wx.FD_SAVE|wx.FD_OVERWRITE_PROMPT)
 		
@@ -1202,7 +1835,13 @@ class MainWin(wx.Frame):
 	
 	def OnGetDarkFrame(self,event):
 		""" Get the background count level - block the laser beam first! """
-		self.camera.capture_background()
+		if not self.hardware_ready():
+			return
+		if self.camera.auto_exp == 'auto':
+			# exposure will change during the scan - need dark frames for all shutter speeds
+			self.camera.capture_background_library()
+		else:
+			self.camera.capture_background()
 	
 	def OnSaveFig(self,event):
 		""" Save figure panel as image file """
@@ -1226,10 +1865,24 @@ class MainWin(wx.Frame):
 	#exit button/menu item	
 	def OnExit(self,event):
 		print 'Closing application...'
-		self.camera.cleanup()
-		GPIO.cleanup()
+		if self.live_view is not None:
+			self.live_view.stop()
+			self.live_view = None
+		if self.monitor is not None:
+			self.monitor.stop()
+			self.monitor.writer.flush()
+		if self.camera is not None:
+			self.camera.cleanup()
+		if self.fit_pool is not None:
+			self.fit_pool.close()
+		if self.streamer is not None:
+			self.streamer.stop()
+		if self.control_server is not None:
+			self.control_server.stop()
+		if self.Stepper is not None:
+			self.Stepper.cleanup()
 		self.Destroy()
-		app.ExitMainLoop()
+		wx.GetApp().ExitMainLoop()
 	
 	def OnAbout(self,event):
 		caption = "About this application"
@@ -1245,10 +1898,12 @@ class MainWin(wx.Frame):
 				"Confirm Shutdown", wx.OK|wx.CANCEL|wx.CANCEL_DEFAULT|wx.ICON_INFORMATION)
 		if dlg.ShowModal() == wx.ID_OK:
 			## do shutdown ...
-			self.camera.cleanup()
+			if self.camera is not None:
+				self.camera.cleanup()
 			self.Destroy()
-			GPIO.cleanup()
-			app.ExitMainLoop()
+			if self.Stepper is not None:
+				self.Stepper.cleanup()
+			wx.GetApp().ExitMainLoop()
 			doshutdown = 1
 			print 'Shutting down now...'
 		dlg.Destroy()
@@ -1279,45 +1934,12 @@ class MainWin(wx.Frame):
 				pass
 			dlg2.Destroy()
 
-# functions for fitting
-def gaussian(x,a,c,w,o):
-	"""Gaussian function, with amplitude a, centred at c, width w = 1/e^2 radius, and offset o """
-	return a * np.exp(-2*(x-c)**2/(w**2)) + o
-
-def focussed_gaussian(z,zr,w0,c):
-	""" 
-	Expected form for the width of a gaussian beam at a position z,
-	with the focal position c, Rayleigh range zr and width at the focus of w0.
-	"""
-	w = w0 * np.sqrt(1.+((z-c)/zr)**2)
-	return w
-
-#csv writer
-def write_csv(xy,filename):
-	""" 
-	Module for writing csv data with arbitrary
-	number of columns to filename.
-	Takes in xy, which should be of the form [[x1,y1],[x2,y2] ...]
-	this can be done by zipping arrays, e.g.
-		xy = zip(x,y,z)
-		where x,y and z are 1d arrays
-	"""	
-	
-	np.savetxt(filename, xy, delimiter=',')
-	
-	#with open(filename, 'wb') as csvfile:
-	#	csv_writer = csv.writer(csvfile,delimiter=',')
-	#	for xy_line in xy:
-	#		csv_writer.writerow(xy_line)
-			
-def write_pkl(xy,filename):	
-	""" Shortcut method for pickling data """
-	pickle.dump(xy,open(filename,'wb'))
-
-	
+def main():
+	#redirect: error messages go to a pop-up box
+	app = wx.App(redirect=True)
+	frame = MainWin(None,"Raspberry Pi Beam Profiler v1.0:Jan2018")
+	frame.Maximize()
+	app.MainLoop()
 	
-#redirect: error messages go to a pop-up box
-app = wx.App(redirect=True)
-frame = MainWin(None,"Raspberry Pi Beam Profiler v1.0:Jan2018")
-frame.Maximize()
-app.MainLoop()
+if __name__ == '__main__':
+	main()
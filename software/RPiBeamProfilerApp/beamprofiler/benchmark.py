@@ -0,0 +1,254 @@
+"""
+Benchmark the image processing hot path on synthetic data - runs on any Linux box,
+without the camera, GPIO or a display.
+
+Synthetic v1/v2 Bayer frames of a Gaussian beam (libs/synthetic.py) are put through
+colour plane extraction, ROI crop, background subtraction, projection, each profile
+fit engine and the batched fitter, at several ROI sizes and noise levels, and scans
+of beam widths through the caustic fit. The time per call and the accuracy against
+the ground truth are printed, and saved to a JSON file so that the results can be
+compared between commits.
+
+Usage: python benchmark.py [--sensor 1 2] [--repeats N] [--output results.json]
+							[--compare previous_results.json]
+"""
+
+import numpy as np
+
+import argparse, json, os, platform, subprocess, sys, time
+from contextlib import contextmanager
+
+import scipy
+
+from libs.imageproc import bayer_plane, roi_slices, project
+from libs.noise_model import SensorNoiseModel
+from libs.fitting import fit_profiles, fit_caustic, fit_caustic_robust
+from libs.batchfit import fit_gaussians
+from libs.synthetic import SENSORS, CCD_XSIZE, CCD_YSIZE, synthetic_bayer, synthetic_plane, \
+							dark_frame, caustic_widths
+from libs.timing import monotonic
+
+# ROI side lengths as a fraction of the sensor, centred on the beam
+ROI_FRACTIONS = (1., 0.5, 0.25)
+# beam peak (counts above the dark level) - a well exposed beam, and a dim one
+NOISE_LEVELS = (('bright', 800.), ('dim', 80.))
+FIT_ENGINES = ('accurate', 'fast')
+
+# beam used for all frames - centre and 1/e^2 radii in mm
+BEAM_CENTRE = (1.8, 1.4)
+BEAM_WIDTH = (0.2, 0.15)
+SHUTTER_SPEED = 1000
+
+# caustic: waist (micron), Rayleigh range (mm) and focus position (mm) over a default scan
+CAUSTIC = dict(w0=50., zr=2., z0=12.5)
+CAUSTIC_POSITIONS = np.arange(0, 25.15, 0.15)
+# bad widths (x the true width) put into the scans for the robust caustic fit
+CAUSTIC_OUTLIERS = {20: 2., 90: 0.3, 140: 1.5}
+
+# slow-down (new time / old time) reported as a regression when comparing results
+REGRESSION_RATIO = 1.1
+
+@contextmanager
+def quiet():
+	""" Hide the fitting routines' progress prints """
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+	try:
+		yield
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+
+def timed(func, *args):
+	""" Call func(*args), returning the result and the time taken (s) """
+	st = monotonic()
+	result = func(*args)
+	return result, monotonic() - st
+
+def record(results, name, durations, n_items=1, **accuracy):
+	""" Add the median time of a benchmark (per item) to results, and print it """
+	per_call = float(np.median(durations)) / n_items
+	entry = dict(name=name, time_ms=1e3*per_call, per_second=1./per_call if per_call > 0 else None,
+				repeats=len(durations))
+	entry.update(accuracy)
+	results.append(entry)
+	acc = '  '.join('%s=%.4g' % (key, value) for key, value in sorted(accuracy.items()))
+	print '%-44s %10.3f ms %10.1f /s  %s' % (name, entry['time_ms'], entry['per_second'] or 0, acc)
+
+def width_errors(widths, truth):
+	""" Median absolute and mean (bias) relative error of fitted widths """
+	rel = np.asarray(widths, dtype=float) / truth - 1
+	rel = rel[np.isfinite(rel)]
+	if len(rel) == 0:
+		return dict(width_err=np.nan, width_bias=np.nan)
+	return dict(width_err=float(np.median(np.abs(rel))), width_bias=float(rel.mean()))
+
+def centred_roi(fraction):
+	""" [xmin, xmax, ymin, ymax] (mm) of an ROI of the given fraction of the sensor, around the beam """
+	hw, hh = 0.5*fraction*CCD_XSIZE, 0.5*fraction*CCD_YSIZE
+	cx = min(max(BEAM_CENTRE[0], hw), CCD_XSIZE-hw)
+	cy = min(max(BEAM_CENTRE[1], hh), CCD_YSIZE-hh)
+	return [cx-hw, cx+hw, cy-hh, cy+hh]
+
+def bench_unpack(results, version, repeats, rng):
+	""" Colour plane extraction from the raw Bayer data, into a new array and into a preallocated one """
+	bayer, offsets = synthetic_bayer(version, 'Red', BEAM_CENTRE, BEAM_WIDTH, rng=rng)
+	out = np.empty((bayer.shape[0]//2, bayer.shape[1]//2), dtype=np.uint16)
+	durations = [timed(bayer_plane, bayer, offsets, 'Red')[1] for i in range(repeats)]
+	record(results, 'v%d/unpack' % version, durations)
+	durations = [timed(bayer_plane, bayer, offsets, 'Red', out)[1] for i in range(repeats)]
+	record(results, 'v%d/unpack-into-slot' % version, durations)
+
+def bench_processing(results, version, fraction, noise, amplitude, repeats, rng):
+	""" Crop, background subtraction, projection and fitting of repeats frames with one ROI and noise level """
+	tag = 'v%d/roi%.2f/%s' % (version, fraction, noise)
+	noise_model = SensorNoiseModel.for_sensor(version)
+	roi = centred_roi(fraction)
+
+	h, w = SENSORS[version]['shape']
+	dark = dark_frame((h//2, w//2), rng=rng)
+	hot = dark > 100
+	frames = [synthetic_plane(version, BEAM_CENTRE, BEAM_WIDTH, amplitude, dark, SHUTTER_SPEED, rng=rng)[0]
+				for i in range(repeats)]
+
+	crop_t, bg_t, proj_t = [], [], []
+	profiles = []
+	for frame in frames:
+		st = monotonic()
+		image = frame.astype(np.float32)
+		image -= dark
+		image[hot] = 0
+		bg_t.append(monotonic() - st)
+
+		st = monotonic()
+		slices = roi_slices(image.shape, roi, CCD_XSIZE, CCD_YSIZE)
+		cropped = image[slices]
+		crop_t.append(monotonic() - st)
+
+		st = monotonic()
+		variance = noise_model.variance(cropped, SHUTTER_SPEED)
+		imageX, imageY, varX, varY = project(cropped, variance)
+		proj_t.append(monotonic() - st)
+
+		ch, cw = cropped.shape
+		Xs = np.linspace(roi[0], roi[1], cw)
+		Ys = np.linspace(roi[3], roi[2], ch)
+		profiles.append((Xs, imageX, Ys, imageY, varX, varY))
+
+	record(results, tag+'/background', bg_t)
+	record(results, tag+'/crop', crop_t)
+	record(results, tag+'/projection', proj_t)
+
+	for engine in FIT_ENGINES:
+		durations, xw, yw = [], [], []
+		for Xs, imageX, Ys, imageY, varX, varY in profiles:
+			with quiet():
+				(xpopt, xerrs, ypopt, yerrs), dt = timed(fit_profiles, Xs, imageX, Ys, imageY, varX, varY, engine)
+			durations.append(dt)
+			xw.append(xpopt[2])
+			yw.append(ypopt[2])
+		accuracy = width_errors(xw + yw, np.array([BEAM_WIDTH[0]]*len(xw) + [BEAM_WIDTH[1]]*len(yw)))
+		record(results, tag+'/fit-'+engine, durations, **accuracy)
+
+	# batched fitter: all x profiles in one call (time per profile)
+	Xs = profiles[0][0]
+	Y = np.array([p[1] for p in profiles])
+	sigma = np.sqrt(np.array([p[4] for p in profiles]))
+	durations = []
+	for i in range(max(repeats//2, 1)):
+		(P, errs, converged, iterations), dt = timed(fit_gaussians, Xs, Y, None, sigma)
+		durations.append(dt)
+	record(results, tag+'/fit-batch-x', durations, n_items=len(Y), **width_errors(P[:,2], BEAM_WIDTH[0]))
+
+def bench_caustic(results, repeats, rng):
+	""" Caustic (width against position) fit of a default scan, and the robust fit of scans with bad points """
+	durations, fits = [], []
+	for i in range(repeats):
+		w, werr = caustic_widths(CAUSTIC_POSITIONS, CAUSTIC['w0'], CAUSTIC['zr'], CAUSTIC['z0'], rng=rng)
+		with quiet():
+			(popt, perr), dt = timed(fit_caustic, CAUSTIC_POSITIONS, w, werr)
+		durations.append(dt)
+		fits.append(popt)
+	zr, w0, z0 = np.array(fits).T
+	record(results, 'caustic', durations,
+			w0_err=float(np.median(np.abs(w0/CAUSTIC['w0']-1))),
+			zr_err=float(np.median(np.abs(zr/CAUSTIC['zr']-1))),
+			z0_err_mm=float(np.median(np.abs(z0-CAUSTIC['z0']))))
+	
+	durations, fits, missed = [], [], 0
+	for i in range(repeats):
+		w, werr = caustic_widths(CAUSTIC_POSITIONS, CAUSTIC['w0'], CAUSTIC['zr'], CAUSTIC['z0'], rng=rng)
+		for index, factor in CAUSTIC_OUTLIERS.items():
+			w[index] *= factor
+		with quiet():
+			(popt, perr, outliers), dt = timed(fit_caustic_robust, CAUSTIC_POSITIONS, w, werr)
+		durations.append(dt)
+		fits.append(popt)
+		missed += len(set(CAUSTIC_OUTLIERS) - set(np.flatnonzero(outliers)))
+	zr, w0, z0 = np.array(fits).T
+	record(results, 'caustic-robust', durations,
+			w0_err=float(np.median(np.abs(w0/CAUSTIC['w0']-1))),
+			zr_err=float(np.median(np.abs(zr/CAUSTIC['zr']-1))),
+			outliers_missed=missed)
+
+def git_commit():
+	""" Current git commit of the code being benchmarked (None if unknown) """
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+							cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare(results, previous_filename):
+	""" Print the change in time of each benchmark since a previous results file """
+	with open(previous_filename) as f:
+		previous = json.load(f)
+	old = dict((entry['name'], entry) for entry in previous['results'])
+	print '\nCompared with', previous_filename, '(commit %s)' % previous['meta'].get('commit')
+	regressions = 0
+	for entry in results:
+		if entry['name'] not in old or not old[entry['name']]['time_ms']:
+			continue
+		ratio = entry['time_ms'] / old[entry['name']]['time_ms']
+		flag = ''
+		if ratio > REGRESSION_RATIO:
+			flag = '  << slower'
+			regressions += 1
+		print '%-44s %6.2fx%s' % (entry['name'], ratio, flag)
+	print regressions, 'benchmarks slower by more than', REGRESSION_RATIO, 'x'
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark the beam profiler processing on synthetic data')
+	parser.add_argument('--sensor', type=int, nargs='+', default=[1, 2], choices=[1, 2],
+						help='camera versions to simulate')
+	parser.add_argument('--repeats', type=int, default=5, help='frames (or calls) per benchmark')
+	parser.add_argument('--seed', type=int, default=1, help='random seed for the synthetic data')
+	parser.add_argument('--output', help='results file (default benchmark_<commit>.json)')
+	parser.add_argument('--compare', help='previous results file to compare with')
+	args = parser.parse_args(argv)
+
+	rng = np.random.RandomState(args.seed)
+	commit = git_commit()
+	meta = dict(commit=commit, date=time.strftime('%Y-%m-%dT%H:%M:%S%z'), host=platform.node(),
+				machine=platform.machine(), python=platform.python_version(),
+				numpy=np.__version__, scipy=scipy.__version__, repeats=args.repeats, seed=args.seed)
+	print 'Beam profiler benchmark - commit', commit, 'on', meta['host'], '(%s)' % meta['machine']
+
+	results = []
+	for version in args.sensor:
+		bench_unpack(results, version, args.repeats, rng)
+		for fraction in ROI_FRACTIONS:
+			for noise, amplitude in NOISE_LEVELS:
+				bench_processing(results, version, fraction, noise, amplitude, args.repeats, rng)
+	bench_caustic(results, args.repeats, rng)
+
+	output = args.output or 'benchmark_%s.json' % (commit or 'results')
+	with open(output, 'w') as f:
+		json.dump(dict(meta=meta, results=results), f, indent=2, sort_keys=True)
+	print '\nResults written to', output
+
+	if args.compare:
+		compare(results, args.compare)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,34 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+Importable core of the beam profiler, without the GUI:
+
+	beamprofiler.core.acquisition - camera and translation stage, dark frames, exposure control
+	beamprofiler.core.processing  - projection, noise model and the beam width fits
+	beamprofiler.core.scan        - running a scan, fitting the beam caustic and M-squared,
+	                                stability monitoring, settings and remote control
+	beamprofiler.core.export      - writing the results (csv, pickle, run report, network stream)
+
+Nothing is imported until it is used: importing beamprofiler.core does not pull in
+wx, matplotlib or scipy, and the camera (picamera) and GPIO libraries are only
+imported when a camera or stage is opened, e.g.
+
+	from beamprofiler.core import processing
+	xparams, xerrs, yparams, yerrs = processing.fit_profiles(Xs, imageX, Ys, imageY)
+"""
+
+__all__ = ['acquisition', 'processing', 'scan', 'export']
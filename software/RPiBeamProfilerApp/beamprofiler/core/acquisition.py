@@ -0,0 +1,48 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+Acquisition: the camera (MyCamera) and translation stage (StepMotorControl), and 
+the hardware-independent parts of acquisition - dark frame library, auto-exposure, 
+HDR merging, frame stacking, the shared-memory frame ring and the analysed live view.
+
+picamera and RPi.GPIO are only imported by open_camera() and open_stage().
+"""
+
+from ..libs.darkframes import DarkFrameLibrary, DARKFRAME_FILE
+from ..libs.exposure import ExposureController
+from ..libs.hdr import HDRMerger
+from ..libs.stacking import FrameStack
+from ..libs.framering import FrameRing
+from ..libs.liveview import LiveAnalyser, annotation as live_annotation
+
+def open_camera(**settings):
+	""" 
+	Open the Pi camera, setting any MyCamera attributes given as keyword arguments 
+	(e.g. col='Red', auto_exp='auto', roi=[xmin,xmax,ymin,ymax], acq_mode='stack')
+	"""
+	from ..libs.camera_control import MyCamera
+	camera = MyCamera()
+	for name, value in settings.items():
+		setattr(camera, name, value)
+	return camera
+	
+def open_stage(parent=None):
+	""" Set up the GPIO pins and return the translation stage controller (not yet calibrated) """
+	import RPi.GPIO as GPIO
+	from ..libs.stepper_control import StepMotorControl
+	GPIO.setmode(GPIO.BCM)
+	return StepMotorControl(parent)
@@ -0,0 +1,112 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+Export of the results: beam widths and caustic fit parameters as csv files (the 
+format written by 'Export Data as csv' in the GUI), the points left out of the caustic 
+fits as outliers, the M-squared analysis and its confidence intervals, images
+as pickles, the JSON run report, and live beam metrics streamed to the local network.
+"""
+
+import csv
+import cPickle as pickle
+
+import numpy as np
+
+from ..libs.runreport import run_report, write_run_report
+from ..libs.streaming import MetricsPublisher, StreamClient, decode_thumbnail
+
+# rows of the confidence intervals in the M-squared csv file
+INTERVAL_LABELS = (('m2', 'M2'), ('waist', '1/e2 waist radius (micron)'), ('rayleigh_range', 'Rayleigh range (mm)'),
+					('focus', 'Position of waist (mm)'), ('divergence', 'Divergence half-angle (mrad)'))
+
+def write_widths(filename,pos,xw,xe,yw,ye):
+	""" Write the widths and errors (micron) against position (mm) to a csv file, sorted by position """
+	dataout = sorted(zip(pos,xw,xe,yw,ye), key=lambda f: f[0])
+	np.savetxt(filename, dataout, delimiter=',')
+	
+def write_outliers(filename,pos,outliers):
+	""" 
+	Write the x and y outlier flags (1 if the point was left out of the caustic fit, 0 otherwise) 
+	against position (mm) to a csv file, sorted by position like the widths file
+	"""
+	xflags, yflags = [np.asarray(flags,dtype=int) for flags in outliers]
+	with open(filename, 'wb') as csvfile:
+		csv_writer = csv.writer(csvfile,delimiter=',')
+		csv_writer.writerow(['Position (mm)','X outlier','Y outlier'])
+		for row in sorted(zip(pos,xflags,yflags), key=lambda f: f[0]):
+			csv_writer.writerow(row)
+	
+def write_fit_params(filename,xfitparams,xfiterrs,yfitparams,yfiterrs):
+	""" Write the caustic fit parameters and errors (in export order) to a csv file """
+	with open(filename, 'wb') as csvfile:
+		csv_writer = csv.writer(csvfile,delimiter=',')
+		csv_writer.writerow(['X axis','','errors on line below'])
+		csv_writer.writerow(['1/e2 radius (micron)','Rayleigh range (mm)','Position of center (mm)'])
+		csv_writer.writerow(xfitparams)
+		csv_writer.writerow(xfiterrs)
+		csv_writer.writerow(['Y axis','','errors on line below'])
+		csv_writer.writerow(['1/e2 radius (micron)','Rayleigh range (mm)','Position of center (mm)'])
+		csv_writer.writerow(yfitparams)
+		csv_writer.writerow(yfiterrs)
+
+def write_beam_quality(filename,quality,intervals=None):
+	""" 
+	Write the M-squared analysis (caustic_beam_quality) to a csv file, with the resampling
+	confidence intervals (resample_caustic) if there are any
+	"""
+	with open(filename, 'wb') as csvfile:
+		csv_writer = csv.writer(csvfile,delimiter=',')
+		csv_writer.writerow(['Axis','M2','M2 error','1/e2 waist radius (micron)','error','Rayleigh range (mm)','error',
+							'Position of waist (mm)','error','Divergence half-angle (mrad)','error',
+							'Reduced chi2','Points','Within 1 zR','Beyond 2 zR','ISO 11146 sampling'])
+		for axis in ('x', 'y'):
+			q = quality[axis]
+			csv_writer.writerow([axis.upper(), q['m2'], q['m2_err'], q['waist'], q['waist_err'], 
+							q['rayleigh_range'], q['rayleigh_range_err'], q['focus'], q['focus_err'],
+							q['divergence'], q['divergence_err'], q['chi2'], q['points'], q['within_zr'],
+							q['beyond_2zr'], 'yes' if q['iso_sampling'] else 'no'])
+		csv_writer.writerow(['Wavelength (nm)', quality['wavelength_nm']])
+		csv_writer.writerow(['Waist asymmetry', quality['waist_asymmetry'], quality['waist_asymmetry_err']])
+		csv_writer.writerow(['Astigmatic distance (mm)', quality['astigmatic_distance'], quality['astigmatic_distance_err']])
+		if intervals is None:
+			return
+		csv_writer.writerow([])
+		csv_writer.writerow(['%g%% confidence intervals' % (100*intervals['confidence']), intervals['method'],
+							'%d resamples' % intervals['resamples']])
+		csv_writer.writerow(['Axis','Quantity','Value','Standard error','Lower','Upper','Failed resamples'])
+		for axis in ('x', 'y'):
+			for name, label in INTERVAL_LABELS:
+				ci = intervals[axis][name]
+				csv_writer.writerow([axis.upper(), label, ci['value'], ci['std_err'], ci['low'], ci['high'],
+									intervals[axis]['failed']])
+		ci = intervals['astigmatic_distance']
+		csv_writer.writerow(['', 'Astigmatic distance (mm)', ci['value'], ci['std_err'], ci['low'], ci['high']])
+
+def write_csv(xy,filename):
+	""" 
+	Module for writing csv data with arbitrary
+	number of columns to filename.
+	Takes in xy, which should be of the form [[x1,y1],[x2,y2] ...]
+	this can be done by zipping arrays, e.g.
+		xy = zip(x,y,z)
+		where x,y and z are 1d arrays
+	"""	
+	np.savetxt(filename, xy, delimiter=',')
+			
+def write_pkl(xy,filename):	
+	""" Shortcut method for pickling data """
+	pickle.dump(xy,open(filename,'wb'))
@@ -0,0 +1,31 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+Processing: colour plane extraction, region of interest, projection, the sensor 
+noise model, and the beam width engines - least-squares Gaussian fits (scipy is 
+imported when the first fit runs), the closed-form estimators, the batched fitter 
+and the worker process pool.
+"""
+
+from ..libs.imageproc import bayer_plane, roi_slices, exposure_metric, project
+from ..libs.noise_model import SensorNoiseModel, SENSOR_NOISE
+from ..libs.estimators import second_moment_width, caruana_gaussian
+from ..libs.batchfit import fit_gaussians, gaussian_moments
+from ..libs.fitting import gaussian, focussed_gaussian, fit_profile, fit_profiles, fit_caustic, \
+							fit_caustic_robust, fit_stats, add_fit_stats
+from ..libs.workers import FitWorkerPool, process_frame
+from ..libs.timing import PipelineTimers, STARTUP_STAGES, timers, monotonic
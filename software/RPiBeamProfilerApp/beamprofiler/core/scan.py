@@ -0,0 +1,325 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+Translation-stage scan without any GUI: move the stage through a range of 
+positions, capture and fit an image at each one, fit the beam caustic (width 
+against position) and its M-squared (ISO 11146), optionally with bootstrap confidence
+intervals, and export the results. The caustic functions are shared 
+with the GUI.
+
+ScanController runs scans from the remote control API (ControlServer) with a 
+ScanRunner, using the settings in a ProfilerSettings object. BeamMonitor logs the 
+beam's pointing and width stability at a fixed position instead of scanning.
+"""
+
+import sys
+import time
+import threading
+import cPickle as pickle
+
+import numpy as np
+
+from ..libs.fitting import fit_profiles, fit_caustic, fit_caustic_robust, fit_stats
+from ..libs.beamquality import caustic_beam_quality, beam_quality
+from ..libs.bootstrap import resample_caustic
+from ..libs.timing import timers, monotonic
+from ..libs.settings import ProfilerSettings
+from ..libs.control import ControlServer, ControlClient, DEFAULT_CONTROL_PORT
+from ..libs.monitoring import BeamMonitor, StabilityStats, read_time_series, read_header, analyse
+from .export import write_widths, write_outliers, write_fit_params, write_beam_quality, run_report, \
+					write_run_report
+
+def scan_positions(start,stop,step):
+	""" Stage positions (mm) of a scan from start to stop (inclusive) """
+	return np.arange(start,stop+step,step)
+	
+def fit_scan_caustics(pos,xw,xe,yw,ye):
+	""" 
+	Fit the x and y caustics of a scan (widths and errors in micron against position in mm),
+	leaving out outlying points (fit_caustic_robust). Returns (xfocus, xfocuserr, yfocus, 
+	yfocuserr, outliers), parameters in the order of focussed_gaussian: Rayleigh range, 
+	waist, focus position, and the x and y outlier flags of the points, in the order given
+	"""
+	order = np.argsort(pos)
+	pos, xw, xe, yw, ye = [np.asarray(a,dtype=float)[order] for a in (pos,xw,xe,yw,ye)]
+	xfocus, xfocuserr, xoutliers = fit_caustic_robust(pos, xw, xe, 'X')
+	yfocus, yfocuserr, youtliers = fit_caustic_robust(pos, yw, ye, 'Y')
+	unsort = np.argsort(order)
+	return xfocus, xfocuserr, yfocus, yfocuserr, (xoutliers[unsort], youtliers[unsort])
+	
+def export_order(params):
+	""" Caustic parameters in the order they are exported: waist, Rayleigh range, focus position """
+	return [params[1], params[0], params[2]]
+	
+def caustic_summary(xfitparams,xfiterrs,yfitparams,yfiterrs,pos=None,outliers=None):
+	""" 
+	The x and y caustic fit parameters (export order) as a dict, for progress events and the 
+	remote control API - with the positions (mm) of the outliers left out of each fit, if given
+	"""
+	summary = dict(x=dict(waist=xfitparams[0], rayleigh_range=xfitparams[1], focus=xfitparams[2], errors=list(xfiterrs)),
+				y=dict(waist=yfitparams[0], rayleigh_range=yfitparams[1], focus=yfitparams[2], errors=list(yfiterrs)))
+	if outliers is not None:
+		for axis, flags in zip(('x', 'y'), outliers):
+			summary[axis]['outliers'] = list(np.asarray(pos,dtype=float)[flags])
+	return summary
+
+class ScanRunner():
+	"""
+	Runs a scan with a camera (MyCamera) and translation stage (StepMotorControl).
+	
+	progress is called with an event name and a dict of details at each step 
+	('calibrated', 'point', 'caustic', ...), e.g. to report progress as JSON lines.
+	If save_prefix is set, each image is pickled to <save_prefix><n>.pkl, with 
+	the positions in <save_prefix>positions.csv (as the GUI's 'Save each image').
+	With the laser wavelength (nm), M-squared is worked out with the caustic fits, and 
+	with uncertainty 'bootstrap' or 'jackknife' its confidence intervals by resampling.
+	"""
+	def __init__(self,camera,stepper,positions,fit_engine='accurate',save_prefix=None,progress=None,
+					wavelength_nm=None,uncertainty='covariance'):
+		self.camera = camera
+		self.stepper = stepper
+		self.positions = np.asarray(positions,dtype=float)
+		self.fit_engine = fit_engine
+		self.save_prefix = save_prefix
+		self.progress = progress
+		self.wavelength_nm = wavelength_nm
+		self.uncertainty = uncertainty
+		
+		self.scanning = False
+		self.points = [] # (position, xw, xwerr, yw, ywerr), widths in micron
+		self.stats = None
+		self.centroid = None # (x, y) of the last image, mm
+		self.xfitparams = self.xfiterrs = self.yfitparams = self.yfiterrs = None
+		self.outliers = None # x and y flags of the points left out of the caustic fits
+		self.beam_quality = None # caustic_beam_quality() of the scan
+		self.intervals = None # and its resample_caustic() confidence intervals
+		
+	def emit(self,event,**details):
+		if self.progress is not None:
+			self.progress(event,details)
+		
+	def calibrate(self):
+		""" Find the stage's zero position - returns True if the calibration worked """
+		ok = self.stepper.calibrate()
+		self.emit('calibrated', ok=bool(ok))
+		return ok
+		
+	def measure(self):
+		""" Capture and fit an image - returns the widths and errors (micron): xw, xwerr, yw, ywerr """
+		cam = self.camera
+		cam.capture_image()
+		with timers.stage('fit'):
+			xpopt, xerrs, ypopt, yerrs = fit_profiles(cam.Xs,cam.imageX,cam.Ys,cam.imageY, \
+											cam.imageX_var,cam.imageY_var,self.fit_engine)
+		self.centroid = xpopt[1], ypopt[1]
+		return xpopt[2]*1e3, xerrs[2]*1e3, ypopt[2]*1e3, yerrs[2]*1e3
+		
+	def save_image(self,i):
+		""" Save the current image, and its position """
+		with timers.stage('save'):
+			pickle.dump(self.camera.image,open(self.save_prefix+str(i)+'.pkl','wb'))
+			with open(self.save_prefix+'positions.csv','a') as posfile:
+				posfile.write(str(i)+','+str(self.stepper.get_position())+'\n')
+		
+	def run(self):
+		""" Scan through all the positions - returns True if the scan was not stopped """
+		self.scanning = True
+		self.points = []
+		timers.reset()
+		start = dict(time=monotonic(), started=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+					ae_iterations=self.camera.exposure.iterations,
+					steps=self.stepper.steps_issued, fit_stats=dict(fit_stats))
+		self.emit('scan_start', positions=len(self.positions),
+					start=self.positions[0], stop=self.positions[-1])
+		
+		for i, pos in enumerate(self.positions):
+			if not self.scanning:
+				break
+			with timers.stage('move'):
+				self.stepper.set_position(pos)
+			xw, xwerr, yw, ywerr = self.measure()
+			if self.save_prefix is not None:
+				self.save_image(i)
+			position = self.stepper.get_position()
+			self.points.append((position, xw, xwerr, yw, ywerr))
+			self.emit('point', index=i, position=position, x0=self.centroid[0], y0=self.centroid[1],
+						wx=xw, wx_err=xwerr, wy=yw, wy_err=ywerr, shutter_speed=self.camera.shutter_speed)
+		
+		completed = self.scanning
+		self.scanning = False
+		self.stats = self.statistics(start)
+		self.emit('scan_end', completed=completed, duration_s=self.stats['duration_s'])
+		return completed
+		
+	def stop(self):
+		""" Stop the scan after the current position """
+		self.scanning = False
+		
+	def statistics(self,start):
+		""" Statistics of the scan that has just finished, for the run report """
+		cam = self.camera
+		n_done = len(self.points)
+		stats = dict(started=start['started'], duration_s=monotonic()-start['time'],
+					positions=len(self.positions), positions_done=n_done, completed=n_done>=len(self.positions),
+					acq_mode=cam.acq_mode, auto_exposure=(cam.auto_exp=='auto'),
+					fit_engine=self.fit_engine, worker_pool=False,
+					ae_iterations=cam.exposure.iterations-start['ae_iterations'],
+					stage_steps=self.stepper.steps_issued-start['steps'],
+					frames=n_done, dropped_frames=0)
+		stats['fit_stats'] = dict((key, fit_stats[key]-start['fit_stats'].get(key,0)) for key in fit_stats)
+		stats['fit_failures'] = stats['fit_stats']['profile_failures']
+		# stage timings of this scan only - later captures also add to timers
+		stats['stages'] = timers.summary()
+		return stats
+		
+	def fit_caustics(self):
+		""" 
+		Fit the caustics of the scan (and M-squared, with the wavelength), without the 
+		outlying points - sets and returns the export-order parameters and errors 
+		"""
+		pos, xw, xe, yw, ye = zip(*self.points)
+		xfocus, xfocuserr, yfocus, yfocuserr, self.outliers = fit_scan_caustics(pos, xw, xe, yw, ye)
+		self.xfitparams, self.xfiterrs = export_order(xfocus), export_order(xfocuserr)
+		self.yfitparams, self.yfiterrs = export_order(yfocus), export_order(yfocuserr)
+		self.emit('caustic', **caustic_summary(self.xfitparams, self.xfiterrs, self.yfitparams, self.yfiterrs,
+												pos, self.outliers))
+		if self.wavelength_nm is not None:
+			self.beam_quality = caustic_beam_quality(pos, xw, xe, yw, ye, self.wavelength_nm, self.outliers)
+			self.emit('beam_quality', **self.beam_quality)
+			if self.uncertainty != 'covariance':
+				self.intervals = resample_caustic(pos, xw, xe, yw, ye, self.wavelength_nm, self.uncertainty,
+													outliers=self.outliers)
+				self.emit('confidence_intervals', **self.intervals)
+		return self.xfitparams, self.xfiterrs, self.yfitparams, self.yfiterrs
+		
+	def export(self,output_filename):
+		""" 
+		Write the widths to output_filename (csv), the caustic fit parameters to 
+		<output_filename>_profilefitparams.csv, the outlier flags to <output_filename>_outliers.csv
+		and M-squared to <output_filename>_m2.csv. Returns the list of files written.
+		"""
+		pos, xw, xe, yw, ye = zip(*self.points)
+		write_widths(output_filename, pos, xw, xe, yw, ye)
+		fits_filename = output_filename[:-4] + "_profilefitparams.csv"
+		write_fit_params(fits_filename, self.xfitparams, self.xfiterrs, self.yfitparams, self.yfiterrs)
+		files = [output_filename, fits_filename]
+		if self.outliers is not None:
+			files.append(output_filename[:-4] + "_outliers.csv")
+			write_outliers(files[-1], pos, self.outliers)
+		if self.beam_quality is not None:
+			files.append(output_filename[:-4] + "_m2.csv")
+			write_beam_quality(files[-1], self.beam_quality, self.intervals)
+		return files
+		
+class ScanController():
+	"""
+	Controller for the remote control API (ControlServer) without a GUI - each scan 
+	runs with a ScanRunner in a background thread, with the current settings.
+	progress is passed on to the ScanRunners.
+	"""
+	def __init__(self,camera,stepper,settings=None,progress=None,software_version=None):
+		self.camera = camera
+		self.stepper = stepper
+		self.settings = settings if settings is not None else ProfilerSettings()
+		self.settings.apply_to_camera(camera)
+		self.progress = progress
+		self.software_version = software_version
+		
+		self.lock = threading.Lock()
+		self.runner = None # ScanRunner of the current or last scan
+		self.thread = None
+		self.scans = 0
+		self.error = None # why the last scan failed, if it did
+		
+	def scanning(self):
+		return self.thread is not None and self.thread.is_alive()
+		
+	def get_settings(self):
+		return self.settings.as_dict()
+		
+	def update_settings(self,changes):
+		with self.lock:
+			if self.scanning():
+				raise RuntimeError('Settings cannot be changed during a scan')
+			self.settings.update(**changes)
+			self.settings.apply_to_camera(self.camera)
+		return self.get_settings()
+		
+	def start_scan(self):
+		s = self.settings
+		with self.lock:
+			if self.scanning():
+				raise RuntimeError('A scan is already running')
+			if s.save_each_image and not s.image_prefix:
+				raise ValueError('image_prefix must be set to save each image')
+			positions = scan_positions(s.scan_start, s.scan_stop, s.step_size)
+			save_prefix = s.image_prefix if s.save_each_image else None
+			self.runner = ScanRunner(self.camera, self.stepper, positions, s.fit_engine, save_prefix, self.progress,
+									s.wavelength_nm, s.uncertainty)
+			self.scans += 1
+			self.error = None
+			self.thread = threading.Thread(target=self._run, args=(self.runner,))
+			self.thread.daemon = True
+			self.thread.start()
+		return self.scan_status()
+		
+	def _run(self,runner):
+		""" Run a scan, and fit the caustics if it wasn't stopped """
+		try:
+			if runner.run():
+				runner.fit_caustics()
+		except Exception as e:
+			self.error = '%s: %s' % (type(e).__name__, e)
+			print >>sys.stderr, 'Scan failed -', self.error
+			
+	def stop_scan(self):
+		if self.runner is not None:
+			self.runner.stop()
+		return self.scan_status()
+		
+	def scan_status(self):
+		runner = self.runner
+		if runner is None:
+			return dict(state='idle', scan=0)
+		return dict(state='scanning' if self.scanning() else 'idle', scan=self.scans,
+					positions=len(runner.positions), positions_done=len(runner.points),
+					completed=runner.stats['completed'] if runner.stats else None,
+					position=self.stepper.get_position(), error=self.error)
+		
+	def scan_results(self):
+		runner = self.runner
+		if runner is None:
+			raise RuntimeError('No scan has been run')
+		points = [dict(position=p[0], wx=p[1], wx_err=p[2], wy=p[3], wy_err=p[4]) for p in list(runner.points)]
+		caustic = None
+		if runner.xfitparams is not None:
+			caustic = caustic_summary(runner.xfitparams, runner.xfiterrs, runner.yfitparams, runner.yfiterrs,
+									[p[0] for p in runner.points], runner.outliers)
+		return dict(scan=self.scans, points=points, caustic=caustic, beam_quality=runner.beam_quality,
+					confidence_intervals=runner.intervals, stats=runner.stats)
+		
+	def export(self,filename):
+		""" Write the widths, caustic fit parameters and run report of the last completed scan """
+		runner = self.runner
+		if runner is None or self.scanning() or runner.xfitparams is None:
+			raise RuntimeError('No completed scan to export')
+		if not filename.endswith('.csv'):
+			raise ValueError('filename must end in .csv')
+		files = runner.export(filename)
+		report_filename = filename[:-4] + '_runreport.json'
+		write_run_report(run_report(runner.stats, self.software_version), report_filename)
+		return dict(files=files + [report_filename])
@@ -0,0 +1,147 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Vectorised Levenberg-Marquardt fitting of many 1d Gaussian profiles at once.
+
+All profiles share the same x grid, so the model, Jacobian and normal equations 
+for every profile are evaluated together as stacked numpy arrays (N profiles x 
+M points, N x 4 x 4 normal equations) instead of one curve_fit call per profile.
+The model is the same as gaussian() in the GUI: a * exp(-2(x-c)^2/w^2) + o
+"""
+
+import numpy as np
+
+def gaussian_moments(x,Y):
+	""" 
+	Initial guesses (N x 4 array of a, c, w, o) for the profiles Y (N x M): offset 
+	from a low percentile, amplitude from the peak, and centre and width from the 
+	centroid and extent of the points above half maximum (FWHM = 1.1774 w).
+	Using only the top half of the profile keeps the noise in the wings out of the 
+	moments, which otherwise badly overestimates the width of narrow beams.
+	"""
+	Y = np.atleast_2d(Y)
+	o = np.percentile(Y,10,axis=1)
+	S = Y - o[:,None]
+	a = S.max(axis=1)
+	top = S > 0.5*a[:,None]
+	St = S*top
+	c = St.dot(x)/np.maximum(St.sum(axis=1),1e-30)
+	w = np.maximum(top.sum(axis=1),1)*abs(x[1]-x[0])/1.1774
+	return np.column_stack((a,c,w,o))
+
+def _model_and_jacobian(x,P):
+	""" Model values (N x M) and Jacobian (N x M x 4) for parameters P (N x 4) """
+	a, c, w, o = P[:,0:1], P[:,1:2], P[:,2:3], P[:,3:4]
+	dx = x[None,:] - c
+	e = np.exp(-2*dx**2/w**2)
+	ae = a*e
+	J = np.empty(e.shape+(4,))
+	J[:,:,0] = e
+	J[:,:,1] = ae*4*dx/w**2
+	J[:,:,2] = ae*4*dx**2/w**3
+	J[:,:,3] = 1.
+	return ae + o, J
+
+def _chi2(x,Y,Wt,P):
+	a, c, w, o = P[:,0:1], P[:,1:2], P[:,2:3], P[:,3:4]
+	r = Y - (a*np.exp(-2*(x[None,:]-c)**2/w**2) + o)
+	return (Wt*r**2).sum(axis=1)
+
+def fit_gaussians(x,Y,p0=None,sigma=None,max_iter=100,tol=1e-8,lam0=1e-3):
+	"""
+	Fit the Gaussian model to every row of Y (N x M) on the common grid x (M).
+	
+	p0 (N x 4) are initial parameters (default: from gaussian_moments), sigma (N x M 
+	or M) the standard deviation of each point. Errors are from the diagonal of the 
+	covariance matrix, scaled by the reduced chi-squared if sigma is not given 
+	(as curve_fit does).
+	
+	Returns params (N x 4), errors (N x 4), converged (N bool) and the number of 
+	iterations each fit took (N).
+	"""
+	x = np.asarray(x,dtype=float)
+	Y = np.atleast_2d(np.asarray(Y,dtype=float))
+	N, M = Y.shape
+	P = gaussian_moments(x,Y) if p0 is None else np.array(p0,dtype=float,ndmin=2)
+	if sigma is None:
+		Wt = np.ones((N,M))
+	else:
+		Wt = 1./np.broadcast_to(np.asarray(sigma,dtype=float)**2,Y.shape)
+	
+	lam = np.full(N,lam0)
+	chi2 = _chi2(x,Y,Wt,P)
+	converged = np.zeros(N,dtype=bool)
+	iterations = np.zeros(N,dtype=int)
+	
+	for it in range(max_iter):
+		active = np.flatnonzero(~converged)
+		if active.size == 0:
+			break
+		iterations[active] += 1
+		Pa = P[active]
+		Wa = Wt[active]
+		model, J = _model_and_jacobian(x,Pa)
+		r = Y[active] - model
+		JW = J*Wa[:,:,None]
+		JWt = JW.transpose(0,2,1)
+		A = np.matmul(JWt,J)
+		g = np.matmul(JWt,r[:,:,None])[:,:,0]
+		
+		# damped normal equations (A + lam*diag(A)) dp = g, solved for all profiles at once
+		Ad = A.copy()
+		idx = np.arange(4)
+		Ad[:,idx,idx] += lam[active,None]*np.maximum(A[:,idx,idx],1e-30)
+		try:
+			dp = np.linalg.solve(Ad,g[:,:,None])[:,:,0]
+		except np.linalg.LinAlgError:
+			dp = np.array([np.linalg.lstsq(Ad[k],g[k],rcond=-1)[0] for k in range(len(active))])
+		
+		Pnew = Pa + dp
+		chi2_new = _chi2(x,Y[active],Wa,Pnew)
+		better = np.isfinite(chi2_new) & (chi2_new <= chi2[active])
+		
+		# accepted steps: move and reduce damping; rejected steps: increase damping
+		acc = active[better]
+		rel_change = (chi2[acc] - chi2_new[better]) / np.maximum(chi2[acc],1e-30)
+		P[acc] = Pnew[better]
+		chi2[acc] = chi2_new[better]
+		lam[acc] = np.maximum(lam[acc]/10.,1e-12)
+		lam[active[~better]] *= 10.
+		
+		small_step = (np.abs(dp[better]) <= tol*(np.abs(Pa[better])+tol)).all(axis=1)
+		converged[acc[(rel_change < tol) | small_step]] = True
+		# damping so large that no step can be taken - at a minimum
+		converged[active[~better][lam[active[~better]] > 1e10]] = True
+	
+	P[:,2] = np.abs(P[:,2])
+	
+	# parameter errors from the curvature matrix at the solution
+	model, J = _model_and_jacobian(x,P)
+	A = np.matmul((J*Wt[:,:,None]).transpose(0,2,1),J)
+	errors = np.full((N,4),np.nan)
+	try:
+		errors[:] = np.sqrt(np.abs(np.linalg.inv(A).diagonal(axis1=1,axis2=2)))
+	except np.linalg.LinAlgError:
+		# at least one singular fit - do them one by one
+		for k in range(N):
+			try:
+				errors[k] = np.sqrt(np.abs(np.linalg.inv(A[k]).diagonal()))
+			except np.linalg.LinAlgError:
+				pass
+	if sigma is None:
+		errors *= np.sqrt(chi2/max(M-4,1))[:,None]
+	
+	return P, errors, converged, iterations
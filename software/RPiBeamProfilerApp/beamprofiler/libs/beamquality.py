@@ -0,0 +1,183 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+
+"""
+Beam quality (ISO 11146) from a caustic scan: the squared width is fitted with the
+hyperbola w^2(z) = A + B(z-zm) + C(z-zm)^2 by linear least squares, giving the waist,
+its position, the Rayleigh range, the far-field divergence and M^2 for each axis,
+with their uncertainties from the covariance of A, B and C. The x and y fits give the
+waist asymmetry and the astigmatic distance. fit_hyperbolas() fits many resamples of
+the scan points at once, for the bootstrap (libs/bootstrap.py).
+
+ISO 11146 asks for second-moment widths; for the Gaussian beams the profile fits 
+assume, the fitted 1/e^2 radii are the same thing. Units are those of a scan - 
+position in mm and widths in micron - so the divergence is in mrad, and M^2 is 
+pi * w0 * theta / wavelength with the wavelength in nm.
+"""
+
+import numpy as np
+
+# ISO 11146 sampling: at least 10 widths, about half within one Rayleigh range of
+# the waist and half further than two Rayleigh ranges
+ISO_MIN_POINTS = 10
+ISO_MIN_REGION = 5
+
+def fit_hyperbola(pos,w,werr=None):
+	""" 
+	Fit w^2 = A + B(z-zm) + C(z-zm)^2 to widths w against position pos, weighted by the 
+	width errors werr (unweighted if any is missing). Returns (A, B, C), their covariance, 
+	zm and the reduced chi-squared. The covariance is scaled up by the reduced 
+	chi-squared when the scatter is larger than the errors (or unknown).
+	"""
+	pos, w = np.asarray(pos,dtype=float), np.asarray(w,dtype=float)
+	zm = pos.mean()
+	z = pos - zm
+	design = np.column_stack((np.ones_like(z), z, z**2))
+	sigma = np.ones_like(w)
+	weighted = werr is not None
+	if weighted:
+		werr = np.asarray(werr,dtype=float)
+		weighted = np.isfinite(werr).all() and (werr > 0).all()
+		if weighted:
+			# error on w^2
+			sigma = 2*np.abs(w)*werr
+	a = design / sigma[:,None]
+	b = w**2 / sigma
+	coeffs = np.linalg.lstsq(a, b, rcond=-1)[0]
+	cov = np.linalg.inv(np.dot(a.T, a))
+	dof = len(w) - 3
+	chi2 = np.sum((b - np.dot(a, coeffs))**2) / dof if dof > 0 else np.nan
+	if dof > 0 and (chi2 > 1 or not weighted):
+		cov *= chi2
+	return coeffs, cov, zm, chi2 if weighted else np.nan
+	
+def fit_hyperbolas(pos,w,werr,counts):
+	""" 
+	Vectorised fits of the hyperbola (as fit_hyperbola) to resamples of the points: 
+	counts (N x M) is the number of times each of the M points is in each of the N 
+	resamples. Returns the N x 3 coefficients (NaN for resamples of fewer than 3 
+	distinct points) and zm.
+	"""
+	pos, w = np.asarray(pos,dtype=float), np.asarray(w,dtype=float)
+	counts = np.atleast_2d(counts)
+	zm = pos.mean()
+	z = pos - zm
+	design = np.column_stack((np.ones_like(z), z, z**2))
+	weight = np.ones_like(w)
+	if werr is not None:
+		werr = np.asarray(werr,dtype=float)
+		if np.isfinite(werr).all() and (werr > 0).all():
+			weight = 1./(2*np.abs(w)*werr)**2
+	# normal equations of every resample: N x 3 x 3 and N x 3
+	outer = design[:,:,None] * design[:,None,:] * weight[:,None,None]
+	normal = np.tensordot(counts, outer, axes=(1,0))
+	rhs = np.dot(counts, design * (weight*w**2)[:,None])
+	coeffs = np.zeros((len(counts),3)) * np.nan
+	ok = (counts > 0).sum(axis=1) >= 3
+	coeffs[ok] = np.linalg.solve(normal[ok], rhs[ok][:,:,None])[:,:,0]
+	return coeffs, zm
+	
+def hyperbola_parameters(coeffs,zm,wavelength_nm):
+	""" 
+	waist (micron), focus (mm), rayleigh_range (mm), divergence (mrad) and m2 (arrays, 
+	NaN where there is no waist) from N x 3 hyperbola coefficients
+	"""
+	A, B, C = np.atleast_2d(coeffs).T
+	with np.errstate(invalid='ignore', divide='ignore'):
+		bad = ~((C > 0) & (4*A*C - B**2 > 0))
+		C = np.where(bad, np.nan, C)
+		w0 = np.sqrt((4*A*C - B**2)/(4*C))
+		theta = np.sqrt(C)
+		return dict(waist=w0, focus=zm - B/(2*C), rayleigh_range=w0/theta, divergence=theta,
+					m2=np.pi*w0*theta/wavelength_nm)
+	
+def _propagate(value,grad,cov):
+	""" value, and its error from the gradient with respect to (A, B, C) """
+	return value, np.sqrt(max(np.dot(grad, np.dot(cov, grad)), 0.))
+	
+def beam_quality(pos,w,werr,wavelength_nm):
+	""" 
+	ISO 11146 analysis of one axis of a caustic scan. Returns a dict of 
+		m2, waist (micron), focus (mm), rayleigh_range (mm), divergence (half-angle, mrad)
+	each with an <name>_err, and the reduced chi-squared of the fit, the number of 
+	points, how many are within one Rayleigh range / beyond two, and whether that 
+	meets the ISO sampling (iso_sampling). The results are NaN if the widths are not 
+	a hyperbola (no waist).
+	"""
+	pos, w = np.asarray(pos,dtype=float), np.asarray(w,dtype=float)
+	result = dict((name, np.nan) for name in ('m2', 'm2_err', 'waist', 'waist_err', 'focus', 'focus_err',
+							'rayleigh_range', 'rayleigh_range_err', 'divergence', 'divergence_err', 'chi2'))
+	result.update(points=len(pos), within_zr=0, beyond_2zr=0, iso_sampling=False)
+	if len(pos) < 3:
+		return result
+	(A, B, C), cov, zm, result['chi2'] = fit_hyperbola(pos, w, werr)
+	# 4 * w0^2 * C
+	Q = 4*A*C - B**2
+	if not C > 0 or not Q > 0:
+		print '!! Caution - the widths do not have a waist, no M-squared !!'
+		return result
+		
+	w0 = np.sqrt(Q/(4*C))
+	theta = np.sqrt(C)
+	zr = w0/theta
+	# gradients with respect to A, B, C
+	dw0 = np.array([1., -B/(2*C), B**2/(4*C**2)]) / (2*w0)
+	dtheta = np.array([0., 0., 1./(2*theta)])
+	result['waist'], result['waist_err'] = _propagate(w0, dw0, cov)
+	result['focus'], result['focus_err'] = _propagate(zm - B/(2*C), np.array([0., -1./(2*C), B/(2*C**2)]), cov)
+	result['divergence'], result['divergence_err'] = _propagate(theta, dtheta, cov)
+	result['rayleigh_range'], result['rayleigh_range_err'] = _propagate(zr, zr*(dw0/w0 - dtheta/theta), cov)
+	m2 = np.pi*w0*theta/wavelength_nm
+	result['m2'], result['m2_err'] = _propagate(m2, m2*(dw0/w0 + dtheta/theta), cov)
+	
+	distance = np.abs(pos - result['focus'])
+	result['within_zr'] = int(np.count_nonzero(distance <= zr))
+	result['beyond_2zr'] = int(np.count_nonzero(distance >= 2*zr))
+	result['iso_sampling'] = (len(pos) >= ISO_MIN_POINTS and result['within_zr'] >= ISO_MIN_REGION 
+								and result['beyond_2zr'] >= ISO_MIN_REGION)
+	return result
+	
+def _keep(outliers,n):
+	""" x and y flags of the points to use, from the x and y outlier flags (or None) """
+	if outliers is None:
+		return np.ones(n,dtype=bool), np.ones(n,dtype=bool)
+	return ~np.asarray(outliers[0],dtype=bool), ~np.asarray(outliers[1],dtype=bool)
+	
+def _ratio(a,aerr,b,berr):
+	""" a/b and its error """
+	r = a/b
+	return r, abs(r)*np.sqrt((aerr/a)**2 + (berr/b)**2)
+	
+def caustic_beam_quality(pos,xw,xe,yw,ye,wavelength_nm,outliers=None):
+	""" 
+	M^2 analysis of both axes of a scan (widths and errors in micron against position
+	in mm), leaving out the outliers (x and y flags, from fit_caustic_robust) if given. 
+	Returns dict(x=..., y=... (see beam_quality), wavelength_nm, waist_asymmetry (smaller 
+	over larger waist), astigmatic_distance (mm, |focus x - focus y|) with their errors)
+	"""
+	pos, xw, xe, yw, ye = [np.asarray(a,dtype=float) for a in (pos,xw,xe,yw,ye)]
+	xkeep, ykeep = _keep(outliers, len(pos))
+	x = beam_quality(pos[xkeep], xw[xkeep], xe[xkeep], wavelength_nm)
+	y = beam_quality(pos[ykeep], yw[ykeep], ye[ykeep], wavelength_nm)
+	if x['waist'] <= y['waist']:
+		asymmetry = _ratio(x['waist'], x['waist_err'], y['waist'], y['waist_err'])
+	else:
+		asymmetry = _ratio(y['waist'], y['waist_err'], x['waist'], x['waist_err'])
+	return dict(x=x, y=y, wavelength_nm=wavelength_nm,
+				waist_asymmetry=asymmetry[0], waist_asymmetry_err=asymmetry[1],
+				astigmatic_distance=abs(x['focus'] - y['focus']),
+				astigmatic_distance_err=np.hypot(x['focus_err'], y['focus_err']))
@@ -0,0 +1,143 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+
+"""
+Resampling (bootstrap or jackknife) confidence intervals for the caustic: the scan 
+points are resampled, and the ISO 11146 hyperbola refitted to each resample, giving 
+the spread of the waist, Rayleigh range, focus, divergence and M-squared that the 
+covariance of a single fit can miss (or lose, when a fit fails).
+
+All the resamples are fitted together (fit_hyperbolas in libs/beamquality.py), so 
+a thousand resamples of a scan take milliseconds; very large jobs are split across 
+a multiprocessing pool.
+"""
+
+import multiprocessing
+
+import numpy as np
+
+from .beamquality import fit_hyperbolas, hyperbola_parameters, _keep
+from .timing import monotonic
+
+METHODS = ('bootstrap', 'jackknife')
+N_RESAMPLES = 1000
+CONFIDENCE = 0.95
+QUANTITIES = ('waist', 'rayleigh_range', 'focus', 'divergence', 'm2')
+# resamples x points above which the fits are split across worker processes,
+# and the number of resamples per worker task
+POOL_THRESHOLD = 2000000
+CHUNK = 1000
+
+def bootstrap_counts(n_points,n_resamples,rng):
+	""" Number of times each point is drawn (with replacement) in each resample """
+	return rng.multinomial(n_points, np.ones(n_points)/n_points, size=n_resamples)
+
+def jackknife_counts(n_points):
+	""" Leave-one-out resamples """
+	return 1 - np.eye(n_points, dtype=int)
+	
+def resampled_parameters(pos,xw,xe,yw,ye,wavelength_nm,xkeep,ykeep,counts):
+	""" 
+	Parameters (hyperbola_parameters) of the x and y caustics of each resample, 
+	using only the points flagged in xkeep and ykeep
+	"""
+	x = hyperbola_parameters(*fit_hyperbolas(pos, xw, xe, counts*xkeep) + (wavelength_nm,))
+	y = hyperbola_parameters(*fit_hyperbolas(pos, yw, ye, counts*ykeep) + (wavelength_nm,))
+	return x, y
+	
+def _bootstrap_chunk(args):
+	""" Worker process entry point - parameters of n bootstrap resamples """
+	data, n, seed = args
+	counts = bootstrap_counts(len(data[0]), n, np.random.RandomState(seed))
+	return resampled_parameters(*data + (counts,))
+	
+def _merge(parts):
+	""" Join the (x, y) parameter dicts of several chunks of resamples """
+	return [dict((q, np.concatenate([part[axis][q] for part in parts])) for q in QUANTITIES) for axis in (0, 1)]
+
+def _interval(value,samples,method,confidence):
+	""" Standard error and confidence interval of one quantity from its resampled values """
+	good = samples[np.isfinite(samples)]
+	if len(good) < 2:
+		return dict(value=value, std_err=np.nan, low=np.nan, high=np.nan)
+	if method == 'jackknife':
+		from scipy.special import ndtri
+		n = len(good)
+		std_err = np.sqrt((n-1.)/n * np.sum((good - good.mean())**2))
+		half = ndtri(0.5 + 0.5*confidence) * std_err
+		return dict(value=value, std_err=std_err, low=value-half, high=value+half)
+	tail = 50.*(1-confidence)
+	low, high = np.percentile(good, [tail, 100.-tail])
+	return dict(value=value, std_err=good.std(ddof=1), low=low, high=high)
+	
+def resample_caustic(pos,xw,xe,yw,ye,wavelength_nm,method='bootstrap',n_resamples=N_RESAMPLES,
+						confidence=CONFIDENCE,processes=None,seed=None,outliers=None):
+	"""
+	Confidence intervals of the caustic parameters of a scan (widths and errors in micron
+	against position in mm) from bootstrap (n_resamples resamples with replacement, 
+	percentile intervals) or jackknife (leave-one-out, normal intervals) refits.
+	processes is the number of worker processes (default: a pool of all but one core 
+	only for very large jobs). Returns dict(x=..., y=...) of {quantity: dict(value, 
+	std_err, low, high)} for QUANTITIES, with the astigmatic_distance interval, the 
+	number of resamples without a waist (failed) and the settings used. Outliers 
+	(x and y flags, from fit_caustic_robust) are left out of every resample.
+	"""
+	if method not in METHODS:
+		raise ValueError('method must be one of ' + ', '.join(METHODS))
+	st = monotonic()
+	pos, xw, xe, yw, ye = [np.asarray(a,dtype=float) for a in (pos,xw,xe,yw,ye)]
+	n_points = len(pos)
+	xkeep, ykeep = _keep(outliers, n_points)
+	# outliers get no weight, but must not be NaN
+	xw, xe = np.where(xkeep, xw, 1.), np.where(xkeep, xe, 1.)
+	yw, ye = np.where(ykeep, yw, 1.), np.where(ykeep, ye, 1.)
+	data = (pos, xw, xe, yw, ye, wavelength_nm, xkeep, ykeep)
+	# the full fit, for the central values
+	best = resampled_parameters(*data + (np.ones((1,n_points),dtype=int),))
+	
+	if method == 'jackknife':
+		samples = resampled_parameters(*data + (jackknife_counts(n_points),))
+		# leaving out an outlier changes nothing - only the other resamples count
+		samples = [dict((q, s[q][keep]) for q in QUANTITIES) for s, keep in zip(samples, (xkeep, ykeep))]
+		n_resamples = int(max(xkeep.sum(), ykeep.sum()))
+		both = (xkeep & ykeep)[xkeep], (xkeep & ykeep)[ykeep]
+	else:
+		if processes is None:
+			processes = 1 if n_resamples*n_points <= POOL_THRESHOLD else max(multiprocessing.cpu_count()-1,1)
+		sizes = [CHUNK]*(n_resamples//CHUNK) + ([n_resamples % CHUNK] if n_resamples % CHUNK else [])
+		seeds = np.random.RandomState(seed).randint(2**31-1, size=len(sizes))
+		tasks = [(data, n, s) for n, s in zip(sizes, seeds)]
+		if processes > 1 and len(tasks) > 1:
+			pool = multiprocessing.Pool(min(processes, len(tasks)))
+			try:
+				parts = pool.map(_bootstrap_chunk, tasks)
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			parts = map(_bootstrap_chunk, tasks)
+		samples = _merge(parts)
+		both = slice(None), slice(None)
+		
+	result = dict(method=method, resamples=n_resamples, confidence=confidence)
+	for axis, b, s in zip(('x', 'y'), best, samples):
+		result[axis] = dict((q, _interval(b[q][0], s[q], method, confidence)) for q in QUANTITIES)
+		result[axis]['failed'] = int(np.count_nonzero(~np.isfinite(s['m2'])))
+	result['astigmatic_distance'] = _interval(abs(best[0]['focus'][0] - best[1]['focus'][0]),
+						np.abs(samples[0]['focus'][both[0]] - samples[1]['focus'][both[1]]), method, confidence)
+	result['time_s'] = monotonic() - st
+	return result
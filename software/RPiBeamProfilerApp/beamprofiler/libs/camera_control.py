@@ -14,13 +14,25 @@
 
 import numpy as np 
 import time
-import wx
+import threading
+import Queue
 
 #camera
 import picamera
 import picamera.array as camarray
 from picamera.array import PiBayerArray
 
+from .imageproc import bayer_plane, roi_slices, exposure_metric, project
+from .darkframes import DarkFrameLibrary
+from .exposure import ExposureController
+from .hdr import HDRMerger
+from .stacking import FrameStack
+from .noise_model import SensorNoiseModel
+from .timing import timers, monotonic
+
+# Shutter speeds (microseconds) used when building a dark frame library
+DARK_LIBRARY_SHUTTER_SPEEDS = [10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000]
+
 class MyCamera(picamera.PiCamera):
 	""" 
 	Class for interfacing with the picamera module, and getting raw (Bayer) data from the sensor
@@ -49,6 +61,14 @@ class MyCamera(picamera.PiCamera):
 		## Remove dark-frame from results
 		self.bg_subtract = True
 		
+		## Acquisition mode - 'single' frame, 'hdr' (exposure-bracketed) or 'stack' (averaged)
+		self.acq_mode = 'single'
+		self.hdr_exposures = 3 # number of frames in an HDR bracket
+		self.hdr_ratio = 4. # ratio of successive exposure times
+		self.stack_frames = 8 # number of frames averaged in stack mode
+		self.stack_clip_sigma = 4. # outlier rejection threshold (None to turn off)
+		self.stack = None # preallocated FrameStack, reused between captures
+		
 		## detect camera resolution / model
 		if self.MAX_RESOLUTION[0] == 2592:
 			self.version = 1 # OmniVision sensor
@@ -61,12 +81,22 @@ class MyCamera(picamera.PiCamera):
 		
 		print 'Detected camera version: ', self.version
 		
+		## Sensor noise model, for the variance of each pixel (fit weights)
+		self.noise_model = SensorNoiseModel.for_sensor(self.version)
+		
 		self.Hpixels = self.MAX_RESOLUTION[0]
 		self.Vpixels = self.MAX_RESOLUTION[1]
 				
 		self.image = np.array([0.])
+		self.image_variance = None # per-pixel variance of self.image, if known
+		self.raw_plane = None # most recent raw colour plane, before dark subtraction
 		self.background = None
 		
+		## Averaged dark frames for each colour / shutter speed, kept between sessions
+		self.darkframes = DarkFrameLibrary()
+		if self.darkframes.load():
+			print 'Loaded dark frame library:', self.darkframes.filename
+		
 		self.col = col
 		
 		#actual size of ccd in mm (same for both versions)
@@ -88,135 +118,285 @@ class MyCamera(picamera.PiCamera):
 		self.awb_gains = (1,1)
 		self.framerate = 5
 		
+		# Auto-exposure model - keeps its prediction between frames
+		self.exposure = ExposureController(min_shutter_speed=self.min_shutter_speed,
+							max_shutter_speed=int(1e6/self.framerate))
 		
-	def capture_background(self):
-		""" Capture an image into a 2d-array using current exposure settings"""
-		
-		if self.col == 'Interpolated':
-			self.interpolate = True
-		else:
-			self.interpolate = False
-			
-		st = time.time()
-		BayerArray = camarray.PiBayerArray(self)
-		self.capture(BayerArray, 'jpeg', bayer=True)
-		# bayer ordering
-		((ry, rx), (gy, gx), (Gy, Gx), (by, bx)) = BayerArray.BAYER_OFFSETS[BayerArray._header.bayer_order]
-		
-		et1 = time.time() - st
-		print 'elapsed time (capture):',et1
 		
+	def _bayer_to_plane(self,BayerArray,out=None):
+		""" 
+		Extract the selected colour plane from a PiBayerArray as a 2d-array 
+		(written into out if given, e.g. a frame ring slot)
+		"""
 		if self.interpolate:
 			## Use full resolution by interpolating the bayer data back to the full sensor resolution
 			
-			## demosaic - postprocess ccd data back to full resolution rgb array
-			self.background = BayerArray.demosaic()
-			et2 = time.time() - st
-			print 'elapsed time (demosaic):',et2
-		
-			##red pixels only:
-			self.background = np.asarray(self.background[:, :, 0],dtype=int)
+			##demosaic - postprocess ccd data back to full resolution rgb array
+			if out is not None:
+				out[...] = BayerArray.demosaic()[:, :, 0]
+				return out
+			return np.asarray(BayerArray.demosaic()[:, :, 0],dtype=int)
 		else:
 			## Lose a factor of 2 in resolution, but without interpolating 
 			## Use only 1 color of pixel in the bayer pattern - much faster than demosaic!
-			
-			## red pixels only:
-			if self.col=='Red':
-				print BayerArray.array
-				self.background = np.asarray(BayerArray.array[ry::2, rx::2, 0],dtype=int)
-			
-			elif self.col=='Green':
-				## green pixels:
-				self.background = np.asarray(BayerArray.array[gy::2, gx::2, 1],dtype=int)
-			
-			else:
-				## blue pixels:
-				self.background = np.asarray(BayerArray.array[by::2, bx::2, 2],dtype=int)
-			
-			## green... more complicated ...
-					
-	def capture_image(self):
-		""" Capture an image into a 2d-array using current exposure settings"""
+			return bayer_plane(BayerArray.array, \
+						BayerArray.BAYER_OFFSETS[BayerArray._header.bayer_order], self.col, out)
+	
+	def _stream_planes(self,n_frames):
+		""" 
+		Generator yielding n_frames raw colour planes, captured back-to-back 
+		(capture_continuous) with the current exposure settings
+		"""
+		if n_frames < 1:
+			return
+		self.interpolate = (self.col == 'Interpolated')
+		BayerArray = camarray.PiBayerArray(self)
+		st = monotonic()
+		for i, output in enumerate(self.capture_continuous(BayerArray, 'jpeg', bayer=True)):
+			timers.add('capture', monotonic() - st)
+			with timers.stage('unpack'):
+				plane = self._bayer_to_plane(output)
+			output.truncate(0)
+			yield plane
+			if i+1 >= n_frames:
+				break
+			st = monotonic()
+				
+	def _capture_plane(self,out=None):
+		""" 
+		Capture a raw (Bayer) frame and return the selected colour plane as a 2d-array
+		(written into out if given)
+		"""
 		
 		if self.col == 'Interpolated':
 			self.interpolate = True
 		else:
 			self.interpolate = False
 			
-		if self.auto_exp == 'auto':
-			self.shutter_speed = self.autoexpose()
+		with timers.stage('capture'):
+			BayerArray = camarray.PiBayerArray(self)
+			self.capture(BayerArray, 'jpeg', bayer=True)
 		
-		st = time.time()
-		BayerArray = camarray.PiBayerArray(self)
-		self.capture(BayerArray, 'jpeg', bayer=True)
-		# bayer ordering
-		((ry, rx), (gy, gx), (Gy, Gx), (by, bx)) = BayerArray.BAYER_OFFSETS[BayerArray._header.bayer_order]
+		with timers.stage('unpack'):
+			plane = self._bayer_to_plane(BayerArray,out)
 		
-		et1 = time.time() - st
-		print 'elapsed time (capture):',et1
+		self.raw_plane = plane
+		return plane
 		
-		#print BayerArray.array.shape
-		#self.image = BayerArray.array ## full BGGR bayer mosaic array
+	def capture_background(self,n_frames=8):
+		""" 
+		Capture n_frames dark frames using current exposure settings, and add 
+		their average to the dark frame library - block the laser beam first!
+		"""
+		self.background = self.darkframes.add(self.col, self.shutter_speed, \
+								(self._capture_plane() for i in range(n_frames)))
+		try:
+			self.darkframes.save()
+		except (IOError, OSError) as e:
+			print '\t !! WARNING :: Could not save dark frame library:', e
+		
+	def capture_background_library(self,shutter_speeds=None,n_frames=8):
+		""" 
+		Capture averaged dark frames over a range of shutter speeds (microseconds), 
+		so that background subtraction works for any exposure chosen by auto-exposure
+		"""
+		if shutter_speeds is None:
+			shutter_speeds = DARK_LIBRARY_SHUTTER_SPEEDS
+		set_speed = self.shutter_speed
+		for ss in shutter_speeds:
+			self.shutter_speed = int(ss)
+			# the sensor takes a couple of frames to settle to the new exposure
+			with timers.stage('settle'):
+				time.sleep(0.2)
+			print 'Dark frames at shutter speed', self.shutter_speed
+			self.capture_background(n_frames)
+		self.shutter_speed = set_speed
+					
+	def capture_image(self):
+		""" Capture an image into a 2d-array using current exposure settings"""
 		
-		if self.interpolate:
-			## Use full resolution by interpolating the bayer data back to the full sensor resolution
-			
-			##demosaic - postprocess ccd data back to full resolution rgb array
-			self.image = np.asarray(BayerArray.demosaic(),dtype=int)
-			et2 = time.time() - st
-			print 'elapsed time (demosaic):',et2
+		if self.acq_mode == 'hdr':
+			self.capture_hdr()
+			return
+		elif self.acq_mode == 'stack':
+			self.capture_stack()
+			return
 		
-			##red pixel values:
-			self.image = self.image[:, :, 0]
+		if self.auto_exp == 'auto':
+			self.image = self._capture_autoexposed()
 		else:
-			## Lose a factor of 2 in resolution, but without interpolating - i.e. use only 1 color of pixel
-			
-			# red pixels:
-			## red pixels only:
-			if self.col=='Red':
-				print BayerArray.array
-				self.image = np.asarray(BayerArray.array[ry::2, rx::2, 0],dtype=int)
+			self.image = self._capture_plane()
+			# keep the exposure model up to date, ready for switching to auto-exposure
+			self.roi_max, offset = exposure_metric(self.image, \
+								roi_slices(self.image.shape,self.roi,self.ccd_xsize,self.ccd_ysize))
+			self.exposure.update(self.shutter_speed, self.roi_max, offset)
+		self._process_image()
+		
+	def _capture_autoexposed(self,max_frames=8,out=None):
+		""" 
+		Capture a raw frame using the shutter speed predicted from the previous frame,
+		only retaking it if it is saturated or too dark to be used.
+		On return, self.shutter_speed is the exposure of the returned frame.
+		"""
+		if self.exposure.shutter_speed is not None:
+			self.shutter_speed = self.exposure.shutter_speed
 			
-			elif self.col=='Green':
-				## green pixels:
-				self.image = np.asarray(BayerArray.array[gy::2, gx::2, 1],dtype=int)
+		for i in range(max_frames):
+			plane = self._capture_plane(out)
+			peak, offset = exposure_metric(plane, roi_slices(plane.shape,self.roi,self.ccd_xsize,self.ccd_ysize))
+			usable = self.exposure.update(self.shutter_speed, peak, offset)
+			print 'Auto-exposure: shutter speed', self.shutter_speed, '- ROI peak', peak, '-', self.exposure.state
+			if usable:
+				break
+			if self.exposure.at_limit():
+				if self.exposure.state == 'saturated':
+					print '\n\n','-'*50,'SHUTTER SPEED AT MINIMUM - REDUCE OPTICAL POWER','-'*50
+				break
+			self.shutter_speed = self.exposure.shutter_speed
+		
+		self.roi_max = peak
+		return plane
+		
+	def capture_raw(self,out=None):
+		""" 
+		Capture a raw colour plane (auto-exposed if enabled) without any processing,
+		e.g. straight into a slot of the fitting worker pool's frame ring (out). 
+		self.shutter_speed is its exposure.
+		"""
+		if self.auto_exp == 'auto':
+			return self._capture_autoexposed(out=out)
+		return self._capture_plane(out)
+		
+	def capture_stack(self,n_frames=None,clip_sigma='default'):
+		""" 
+		Average n_frames frames with the current exposure settings (auto-exposure is only
+		run on the first frame). The per-pixel running mean and variance are accumulated 
+		in a separate thread while the next frames are streamed from the camera. 
+		Pixel values further than clip_sigma standard deviations from the mean are rejected.
+		Sets self.image to the mean and self.image_variance to the variance of the mean.
+		"""
+		if n_frames is None:
+			n_frames = self.stack_frames
+		if clip_sigma == 'default':
+			clip_sigma = self.stack_clip_sigma
 			
-			else:
-				## blue pixels:
-				self.image = np.asarray(BayerArray.array[by::2, bx::2, 2],dtype=int)
-				# dtype=int >> converts to signed integers - otherwise background subtraction can fail
+		if self.auto_exp == 'auto':
+			plane = self._capture_autoexposed()
+		else:
+			plane = self._capture_plane()
+		
+		if self.stack is None or self.stack.shape != plane.shape:
+			self.stack = FrameStack(plane.shape)
+		self.stack.clip_sigma = clip_sigma
+		self.stack.reset()
+		
+		frames = Queue.Queue()
+		stack_thread = threading.Thread(target=self.stack.consume,args=(frames,))
+		stack_thread.start()
+		try:
+			frames.put(plane)
+			for plane in self._stream_planes(n_frames-1):
+				frames.put(plane)
+		finally:
+			frames.put(None)
+			stack_thread.join()
+		if self.stack.rejected:
+			print 'Stack: rejected', self.stack.rejected, 'outlying pixel values'
+		
+		self.image = self.stack.mean.copy()
+		self._process_image(variance=self.stack.variance_of_mean())
+		
+	def capture_hdr(self,n_exposures=None,ratio=None):
+		""" 
+		Exposure-bracketed (high dynamic range) capture. Takes n_exposures frames, 
+		each ratio times longer than the last, starting from the current (or 
+		auto-exposed) shutter speed, and merges them into one float32 linear image 
+		in counts at the starting shutter speed.
+		Frames are merged in a separate thread while the next one is captured.
+		"""
+		if n_exposures is None:
+			n_exposures = self.hdr_exposures
+		if ratio is None:
+			ratio = self.hdr_ratio
+		
+		if self.auto_exp == 'auto':
+			plane = self._capture_autoexposed()
+		else:
+			plane = self._capture_plane()
+		base_speed = self.shutter_speed
+		
+		merger = HDRMerger(base_speed,saturation=self.exposure.saturation)
+		frames = Queue.Queue()
+		merge_thread = threading.Thread(target=merger.consume,args=(frames,))
+		merge_thread.start()
+		try:
+			for i in range(n_exposures):
+				if i > 0:
+					speed = int(base_speed * ratio**i)
+					if speed > self.exposure.max_shutter_speed:
+						break
+					self.shutter_speed = speed
+					plane = self._capture_plane()
+				dark, hot = None, None
+				if self.bg_subtract:
+					dark, hot = self.darkframes.get(self.col, self.shutter_speed)
+					if dark is not None and dark.shape != plane.shape:
+						dark, hot = None, None
+				frames.put((plane, self.shutter_speed, dark, hot))
+		finally:
+			frames.put(None)
+			merge_thread.join()
+			self.shutter_speed = base_speed
+		
+		self.image = merger.result()
+		self._process_image(dark_subtracted=True,variance=merger.variance(self.noise_model))
+		
+	def _process_image(self,dark_subtracted=False,variance=None):
+		""" 
+		Dark-frame subtraction, crop to the region of interest and projection onto x and y.
+		variance is the per-pixel variance of the image, if known, which is propagated 
+		to the variance of the projections (imageX_var, imageY_var). Otherwise the 
+		variance comes from the sensor noise model.
+		"""
+		self.image_variance = variance
 		
 		## apply crops for region of interest here
-		h,w = self.image.shape
-		self.roi_frac = [int(self.roi[0]/self.ccd_xsize),int(self.roi[1]/self.ccd_xsize),\
-						1-int(self.roi[2]/self.ccd_ysize),1-int(self.roi[3]/self.ccd_ysize)]
-						
-		self.cropped_image = self.image[  h*self.roi_frac[3]:h*self.roi_frac[2],w*self.roi_frac[0]:w*self.roi_frac[1]]
-		if self.background is not None:
-			cropped_bg = self.background[h*self.roi_frac[3]:h*self.roi_frac[2],w*self.roi_frac[0]:w*self.roi_frac[1]]
+		self.roi_slices = roi_slices(self.image.shape,self.roi,self.ccd_xsize,self.ccd_ysize)
 		
 		# remove dark frame
-		if self.bg_subtract:
-			if self.background is None:
-				print '\t !! WARNING :: No dark frame image to subtract '
-			else:
-				self.image = self.image - self.background
-				self.cropped_image = self.cropped_image - cropped_bg
-		
-		#print self.roi_frac
+		if self.bg_subtract and not dark_subtracted:
+			with timers.stage('background'):
+				dark, hot = self.darkframes.get(self.col, self.shutter_speed)
+				if dark is None or dark.shape != self.image.shape:
+					# fall back to a single dark frame set by set_background()
+					dark, hot = self.background, None
+				
+				if dark is None or dark.shape != self.image.shape:
+					print '\t !! WARNING :: No dark frame image to subtract '
+				else:
+					self.image = self.image - dark
+					if hot is not None:
+						self.image[hot] = 0
+		
+		st = monotonic()
+		self.cropped_image = self.image[self.roi_slices]
+		
 		#print 'Cropped shape:', cropped_image.shape
 		ch,cw = self.cropped_image.shape
 		
 		# only fit to cropped part of the image
-		self.imageX = self.cropped_image.sum(axis=0).astype(np.float)/ch
-		self.imageY = self.cropped_image.sum(axis=1).astype(np.float)/cw
+		if variance is not None:
+			cropped_var = variance[self.roi_slices]
+		elif self.noise_model is not None:
+			cropped_var = self.noise_model.variance(self.cropped_image,self.shutter_speed)
+		else:
+			cropped_var = None
+		self.imageX, self.imageY, self.imageX_var, self.imageY_var = project(self.cropped_image,cropped_var)
 		
 		# Approximate position - should use neareset integer to Ntimes pixel pitch
 		self.Xs = np.linspace(self.roi[0],self.roi[1],cw)
 		self.Ys = np.linspace(self.roi[3],self.roi[2],ch)
-		
-		et2 = time.time() - st
-		print 'elapsed time (capture + processing):',et1
+		timers.add('projection', monotonic() - st)
 	
 	def set_background(self):
 		""" Use whatever the current image is as the dark frame image """
@@ -236,65 +416,31 @@ class MyCamera(picamera.PiCamera):
 		""" Cleanup the camera memory stuff - needed to prevent GPU memory leak errors """
 		self.close()
 		
-	def autoexpose(self):
+	def autoexpose(self,max_frames=8):
 		""" 
-		Custom auto-exposure routine that finds the maximum pixel value and makes sure it's below saturation 
+		Custom auto-exposure routine: adjust the shutter speed until the maximum pixel value
+		in the region-of-interest is within the controller's desired range (below saturation).
+		Returns the shutter speed.
 		"""
-		
 		print 'Running auto-exposure:'
+		for i in range(max_frames):
+			self.image = self._capture_autoexposed()
+			if self.exposure.in_range(self.roi_max) or self.exposure.at_limit():
+				break
 		
-		#define 'good' range for maximum pixel value, arbitrary
-		desired_range = (800,950)
-		
-		#check current settings
-		finding_shutter_speed = True		
-		while finding_shutter_speed:
-			## need to add detection of min/max shutter speeds here !!
-				
-			print '.',
-			#print self.analog_gain, self.digital_gain
-			current_max = self.get_image_fast_max()
-			#print 'Image max value:',current_max
-			if current_max<desired_range[1] and current_max>desired_range[0]:
-				finding_shutter_speed = False
-			elif current_max>desired_range[1]:
-				# reduce exposure time
-				if self.shutter_speed == self.min_shutter_speed:
-					print '\n\n','-'*50,'SHUTTER SPEED AT MINIMUM - REDUCE OPTICAL POWER','-'*50
-					finding_shutter_speed = False
-
-				self.shutter_speed = int(0.5 * self.shutter_speed * desired_range[0] / current_max)
-				print 'New shutter speed:', self.shutter_speed
-			elif current_max == 0:
-				self.shutter_speed = int(100 * self.shutter_speed)
-			else:
-				# increase exposure time
-				self.old_shutter_speed = self.shutter_speed
-				print 'Old shutter speed', self.old_shutter_speed
-				self.shutter_speed = int(self.shutter_speed * desired_range[0] / current_max * 1.1)
-				if self.shutter_speed == self.old_shutter_speed:
-					# catch increments that are too small
-					print 'Estimated increment too small...'
-					self.shutter_speed = self.shutter_speed + 19
-				print 'New shutter speed', self.shutter_speed
-					
 		print ' Done'
-		print ' Shutter speed:',
-		print int(self.shutter_speed * 2.2)
-		return int(self.shutter_speed * 2.2)
+		print ' Shutter speed:', self.shutter_speed
+		return self.shutter_speed
 			
 	def get_image_fast_max(self):
 		""" 
-		Acquire a quick image using the RGBarray method
-		 - good for auto-exposure, but not proper image analysis! 
+		Exposure metric (robust maximum of the region-of-interest, in raw counts) of the 
+		most recent raw frame - only captures a new frame if there isn't one yet.
+		Resolution and capture port are left unchanged.
 		"""
-		
-		#print 'Getting image...',
-		st = time.time()
-		self.resolution = (int(self.Hpixels/2), int(self.Vpixels/2))
-		with camarray.PiRGBArray(self) as stream:
-			self.capture(stream,'rgb')
-			image = stream.array
-		print 'Elapsed time (get_image_fast):', time.time() - st
-		print '\tImage maximum value:',image[:,:,0].max()*4
-		return image[:,:,0].max()*4
+		if self.raw_plane is None:
+			self._capture_plane()
+		peak, offset = exposure_metric(self.raw_plane, \
+						roi_slices(self.raw_plane.shape,self.roi,self.ccd_xsize,self.ccd_ysize))
+		print '\tImage maximum value (ROI):',peak
+		return peak
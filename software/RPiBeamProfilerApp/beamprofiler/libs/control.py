@@ -0,0 +1,182 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+
+"""
+Remote control of the profiler over HTTP with JSON bodies, so that scans can be run 
+from scripts. It listens on localhost only, unless another host is given. Files are 
+only written inside the server's output directory: the export filename and the 
+image_prefix setting are taken relative to it, and paths outside it are rejected.
+
+	GET  /settings			all settings (see libs/settings.py)
+	PUT  /settings			change settings - body {"roi": [0.5, 3, 0.2, 2.5], "scan_stop": 20, ...}
+	POST /scan/start		start a scan with the current settings
+	POST /scan/stop			stop the scan after the current position
+	GET  /scan				scan status - {"state": "scanning"|"idle", "scan": 3, "positions_done": 12, ...}
+	GET  /results			widths of each point of the last scan, its caustic fit and M-squared
+							(and confidence intervals)
+	POST /export			write the results files - body {"filename": "run3.csv"}
+
+Replies are JSON; errors have a status of 400 (bad request or setting), 404 (unknown 
+path), 405 (wrong method), 409 (not possible now, e.g. starting a scan during a scan) or 
+500 (the request failed), and a body of {"error": message}.
+
+The requests are handed to a controller, with the methods get_settings(), 
+update_settings(changes), start_scan(), stop_scan(), scan_status(), scan_results() and 
+export(filename), which raise ValueError for bad values and RuntimeError for requests 
+that can't be done now - ScanController (core/scan.py) without a GUI, or the GUI's own.
+"""
+
+import json
+import os
+import threading
+import urllib2
+import BaseHTTPServer
+import SocketServer
+
+DEFAULT_CONTROL_PORT = 8766
+
+# (method, path): (controller method, whether it takes the request body)
+ROUTES = {
+	('GET', '/settings'): ('get_settings', False),
+	('PUT', '/settings'): ('update_settings', True),
+	('POST', '/scan/start'): ('start_scan', False),
+	('POST', '/scan/stop'): ('stop_scan', False),
+	('GET', '/scan'): ('scan_status', False),
+	('GET', '/results'): ('scan_results', False),
+	('POST', '/export'): ('export', True),
+	}
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	
+	def output_path(self, filename):
+		""" Absolute path of filename in the output directory - ValueError if it is outside it """
+		path = os.path.realpath(os.path.join(self.output_dir, filename))
+		if not path.startswith(os.path.join(self.output_dir, '')):
+			raise ValueError('Files can only be written in ' + self.output_dir)
+		return path
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	""" Passes each request to the server's controller """
+	def do_GET(self):
+		self.dispatch('GET')
+		
+	def do_PUT(self):
+		self.dispatch('PUT')
+		
+	def do_POST(self):
+		self.dispatch('POST')
+		
+	def dispatch(self, method):
+		path = self.path.split('?')[0].rstrip('/')
+		if (method, path) not in ROUTES:
+			if [route for route in ROUTES if route[1] == path]:
+				self.reply(405, dict(error='%s is not allowed for %s' % (method, path)))
+			else:
+				self.reply(404, dict(error='%s not found' % self.path))
+			return
+		name, takes_body = ROUTES[(method, path)]
+		try:
+			args = []
+			if takes_body:
+				args.append(self.read_body(name))
+			result = getattr(self.server.controller, name)(*args)
+		except ValueError as e:
+			self.reply(400, dict(error=str(e)))
+		except RuntimeError as e:
+			self.reply(409, dict(error=str(e)))
+		except Exception as e:
+			self.reply(500, dict(error='%s: %s' % (type(e).__name__, e)))
+		else:
+			self.reply(200, result)
+			
+	def read_body(self, name):
+		""" JSON body of the request, as the argument for controller method name """
+		length = int(self.headers.getheader('content-length') or 0)
+		try:
+			body = json.loads(self.rfile.read(length)) if length else {}
+		except ValueError:
+			raise ValueError('Request body is not valid JSON')
+		if not isinstance(body, dict):
+			raise ValueError('Request body must be a JSON object')
+		if name == 'export':
+			if not isinstance(body.get('filename'), basestring):
+				raise ValueError('filename is needed, as a string')
+			return self.server.output_path(body['filename'])
+		if 'image_prefix' in body and body['image_prefix']:
+			if not isinstance(body['image_prefix'], basestring):
+				raise ValueError('image_prefix must be a string')
+			body['image_prefix'] = self.server.output_path(body['image_prefix'])
+		return body
+		
+	def reply(self, status, body):
+		data = json.dumps(body, default=float)
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+		
+	def log_message(self, format, *args):
+		pass # no log line for every status poll
+
+class ControlServer():
+	""" 
+	HTTP server for the remote control API, handing requests to controller. host '' 
+	listens on all network interfaces; files are written in output_dir (default: the 
+	current directory).
+	"""
+	def __init__(self, controller, port=DEFAULT_CONTROL_PORT, host='localhost', output_dir=None):
+		self.controller = controller
+		self.address = (host, port)
+		self.output_dir = os.path.realpath(output_dir or os.getcwd())
+		self.server = None
+		
+	def start(self):
+		""" Start serving in a background thread - returns the (host, port) listened on """
+		self.server = _Server(self.address, _RequestHandler)
+		self.server.controller = self.controller
+		self.server.output_dir = self.output_dir
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self.server.server_address
+		
+	def stop(self):
+		if self.server is None:
+			return
+		self.server.shutdown()
+		self.server.server_close()
+		self.server = None
+
+class ControlClient():
+	""" 
+	Minimal client of the remote control API, e.g. 
+		profiler = ControlClient('beamprofiler.local'); profiler.request('PUT', '/settings', scan_stop=20)
+	Errors raise urllib2.HTTPError, with the JSON error body readable from it.
+	"""
+	def __init__(self, host='localhost', port=DEFAULT_CONTROL_PORT, timeout=30.):
+		self.url = 'http://%s:%d' % (host, port)
+		self.timeout = timeout
+		
+	def request(self, method, path, **body):
+		""" Make a request, with keyword arguments as the JSON body - returns the JSON reply """
+		data = json.dumps(body) if body else None
+		request = urllib2.Request(self.url + path, data, {'Content-Type': 'application/json'})
+		request.get_method = lambda: method
+		return json.loads(urllib2.urlopen(request, timeout=self.timeout).read())
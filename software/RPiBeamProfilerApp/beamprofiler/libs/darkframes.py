@@ -0,0 +1,145 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import numpy as np
+
+# Default location of the dark frame library on disk (persists between sessions)
+DARKFRAME_FILE = os.path.join(os.path.expanduser('~'),'.beamprofiler','darkframes.npz')
+
+class DarkFrameLibrary():
+	"""
+	Library of averaged dark frames, indexed by colour mode and shutter speed.
+	
+	Each entry holds the float32 mean of a number of dark frames and a boolean
+	hot-pixel mask. Dark frames for shutter speeds in between stored entries are 
+	linearly interpolated (the dark signal grows linearly with exposure time);
+	outside the stored range the nearest entry is used.
+	
+	The library can be saved to and loaded from a compressed .npz file so the 
+	dark frames only need to be taken once.
+	"""
+	def __init__(self,filename=DARKFRAME_FILE,hot_sigma=6.):
+		self.filename = filename
+		self.hot_sigma = hot_sigma
+		
+		# (col, shutter_speed) -> (mean, hot pixel mask, number of frames)
+		self.frames = {}
+		
+		# Most recent lookup, so repeated requests (e.g. during a scan) are free
+		self._last_key = None
+		self._last_result = (None, None)
+		
+	def add(self,col,shutter_speed,frames):
+		""" 
+		Average the dark frames in the iterable frames and store the result under
+		the given colour mode and shutter speed (microseconds)
+		"""
+		total = None
+		n = 0
+		for frame in frames:
+			if total is None:
+				total = np.zeros(frame.shape,dtype=np.float64)
+			total += frame
+			n += 1
+		if n == 0:
+			raise ValueError('No dark frames to average')
+		
+		mean = (total/n).astype(np.float32)
+		self.frames[(col,int(shutter_speed))] = (mean, self.find_hot_pixels(mean), n)
+		self._last_key = None
+		return mean
+		
+	def find_hot_pixels(self,mean):
+		""" Flag pixels that are well above the typical dark level (robust median/MAD estimate) """
+		med = np.median(mean)
+		mad = np.median(np.abs(mean - med))
+		# 1.4826 * MAD = standard deviation for normally distributed noise; 
+		# don't let a perfectly flat frame flag every pixel
+		noise = max(1.4826*mad, 1.)
+		return mean > med + self.hot_sigma*noise
+	
+	def exposures(self,col):
+		""" Sorted list of shutter speeds stored for the colour mode col """
+		return sorted([ss for (c,ss) in self.frames if c == col])
+	
+	def get(self,col,shutter_speed):
+		""" 
+		Return the (dark frame, hot pixel mask) for the colour mode and shutter speed.
+		Returns (None, None) if there are no dark frames for this colour mode.
+		"""
+		key = (col,int(shutter_speed))
+		if key == self._last_key:
+			return self._last_result
+		
+		exps = self.exposures(col)
+		if len(exps) == 0:
+			result = (None, None)
+		elif key in self.frames:
+			result = self.frames[key][:2]
+		else:
+			# bracketing exposures
+			idx = np.searchsorted(exps,shutter_speed)
+			if idx == 0:
+				result = self.frames[(col,exps[0])][:2]
+			elif idx == len(exps):
+				result = self.frames[(col,exps[-1])][:2]
+			else:
+				lo, hi = exps[idx-1], exps[idx]
+				mean_lo, hot_lo, n = self.frames[(col,lo)]
+				mean_hi, hot_hi, n = self.frames[(col,hi)]
+				f = np.float32(float(shutter_speed - lo)/(hi - lo))
+				result = (mean_lo + f*(mean_hi - mean_lo), hot_lo | hot_hi)
+				
+		self._last_key = key
+		self._last_result = result
+		return result
+	
+	def clear(self):
+		""" Remove all stored dark frames """
+		self.frames = {}
+		self._last_key = None
+		
+	def save(self,filename=None):
+		""" Write the library to a compressed .npz file """
+		if filename is None:
+			filename = self.filename
+		dirname = os.path.dirname(filename)
+		if dirname and not os.path.isdir(dirname):
+			os.makedirs(dirname)
+		
+		arrays = {}
+		for i, ((col,ss),(mean,hot,n)) in enumerate(sorted(self.frames.items())):
+			arrays['mean_%d' % i] = mean
+			arrays['hot_%d' % i] = hot
+		arrays['cols'] = np.array([col for (col,ss) in sorted(self.frames)])
+		arrays['shutter_speeds'] = np.array([ss for (col,ss) in sorted(self.frames)],dtype=int)
+		arrays['nframes'] = np.array([self.frames[k][2] for k in sorted(self.frames)],dtype=int)
+		np.savez_compressed(filename,**arrays)
+		
+	def load(self,filename=None):
+		""" Read the library from a .npz file, returns False if the file doesn't exist """
+		if filename is None:
+			filename = self.filename
+		if not os.path.isfile(filename):
+			return False
+		
+		data = np.load(filename)
+		self.clear()
+		for i, (col,ss,n) in enumerate(zip(data['cols'],data['shutter_speeds'],data['nframes'])):
+			self.frames[(str(col),int(ss))] = \
+				(data['mean_%d' % i].astype(np.float32), data['hot_%d' % i].astype(bool), int(n))
+		data.close()
+		return True
@@ -0,0 +1,81 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Fast beam width estimators, that don't need iterative non-linear fitting.
+All widths are 1/e^2 radii, in the units of the position array.
+"""
+
+import numpy as np
+
+def second_moment_width(x,profile):
+	"""
+	Second-moment (ISO 11146 'D4sigma') beam width of a 1d profile.
+	Returns (centre, width) where the width is 2*sigma, equal to the 1/e^2 radius 
+	for a Gaussian beam. The profile should be background subtracted - the 
+	second moment is very sensitive to offsets in the wings.
+	"""
+	total = profile.sum()
+	if total <= 0:
+		return np.nan, np.nan
+	centre = np.dot(x,profile)/total
+	var = np.dot((x-centre)**2,profile)/total
+	return centre, 2*np.sqrt(max(var,0))
+
+def caruana_gaussian(x,profile,offset=None,threshold=0.2):
+	"""
+	Closed-form Gaussian fit (Caruana's algorithm): the log of a Gaussian is a parabola, 
+		ln(y - offset) = ln(a) - 2(x-c)^2/w^2
+	so a weighted linear least-squares fit of a quadratic to the log of the points 
+	above threshold*peak gives the amplitude a, centre c and 1/e^2 radius w directly,
+	without iteration. The points are weighted by y^2, since the noise on ln(y) scales as 1/y.
+	
+	offset defaults to the mean of the lowest 10% of the profile.
+	Returns (a, c, w, offset) - the same order as the parameters of gaussian() - 
+	or NaNs if there aren't enough points or the profile isn't peaked.
+	"""
+	profile = np.asarray(profile,dtype=float)
+	if offset is None:
+		n = max(len(profile)//10,1)
+		offset = np.partition(profile,n-1)[:n].mean()
+	y = profile - offset
+	peak = y.max()
+	use = y > threshold*peak
+	if peak <= 0 or np.count_nonzero(use) < 3:
+		return np.nan, np.nan, np.nan, offset
+	
+	y = y[use]
+	xs = x[use]
+	x0 = xs.mean() # centre the x values, for a well-conditioned fit
+	xs = xs - x0
+	wt = y*y
+	ly = np.log(y)
+	
+	# weighted normal equations for ly = A + B xs + C xs^2
+	s0 = wt.sum(); s1 = np.dot(wt,xs); x2 = xs*xs
+	s2 = np.dot(wt,x2); s3 = np.dot(wt,x2*xs); s4 = np.dot(wt,x2*x2)
+	M = np.array([[s0,s1,s2],[s1,s2,s3],[s2,s3,s4]])
+	v = np.array([wt.dot(ly), np.dot(wt*xs,ly), np.dot(wt*x2,ly)])
+	try:
+		A, B, C = np.linalg.solve(M,v)
+	except np.linalg.LinAlgError:
+		return np.nan, np.nan, np.nan, offset
+	if C >= 0:
+		return np.nan, np.nan, np.nan, offset
+	
+	c = -B/(2*C)
+	w = np.sqrt(-2./C)
+	a = np.exp(A - B*B/(4*C))
+	return a, c + x0, w, offset
@@ -0,0 +1,109 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import numpy as np
+
+class ExposureController():
+	"""
+	Model-based auto-exposure for the raw sensor data.
+	
+	The raw (Bayer) pixel values respond linearly to exposure time, 
+		peak = offset + gain * shutter_speed
+	so one unsaturated frame is enough to predict the shutter speed that puts 
+	the peak of the region-of-interest in the middle of desired_range.
+	Only when a frame is saturated (or has no signal above the dark level) does 
+	the controller fall back to bisection between bracketing shutter speeds.
+	
+	The last prediction is kept between frames, so during a scan each frame 
+	is taken with the shutter speed predicted from the previous one.
+	"""
+	def __init__(self,desired_range=(800,950),saturation=1000,dark_threshold=20,
+					min_shutter_speed=9,max_shutter_speed=200000):
+		self.desired_range = desired_range
+		self.target = 0.5*(desired_range[0]+desired_range[1])
+		self.saturation = saturation
+		self.dark_threshold = dark_threshold
+		self.min_shutter_speed = min_shutter_speed
+		self.max_shutter_speed = max_shutter_speed
+		
+		self.reset()
+		
+	def reset(self):
+		""" Forget the sensor model and brackets (e.g. after changing colour or ROI) """
+		self.gain = None	# counts per microsecond
+		self.offset = 0.
+		self.lo = None		# longest shutter speed known to be too dark
+		self.hi = None		# shortest shutter speed known to saturate
+		self.state = None	# 'ok', 'saturated' or 'dark' for the last frame
+		self.last_shutter_speed = None
+		self.shutter_speed = None # predicted shutter speed for the next frame
+		self.iterations = 0
+		
+	def clamp(self,shutter_speed):
+		""" Keep shutter speed within the limits of the sensor / frame rate """
+		return int(min(max(shutter_speed,self.min_shutter_speed),self.max_shutter_speed))
+	
+	def update(self,shutter_speed,peak,offset=0.):
+		""" 
+		Update the model with the region-of-interest peak value (raw counts) and 
+		dark level offset of a frame taken at shutter_speed (microseconds).
+		
+		Returns True if the frame is usable (neither saturated nor dark). 
+		The shutter speed for the next frame is then available as self.shutter_speed
+		"""
+		self.iterations += 1
+		self.last_shutter_speed = shutter_speed
+		
+		if peak >= self.saturation:
+			self.state = 'saturated'
+			if self.hi is None or shutter_speed < self.hi:
+				self.hi = shutter_speed
+		elif peak - offset < self.dark_threshold:
+			self.state = 'dark'
+			if self.lo is None or shutter_speed > self.lo:
+				self.lo = shutter_speed
+		else:
+			self.state = 'ok'
+			self.gain = float(peak - offset) / shutter_speed
+			self.offset = offset
+			# linear region found - old brackets no longer needed
+			self.lo = None
+			self.hi = None
+			
+		self.shutter_speed = self.next_shutter_speed()
+		return self.state == 'ok'
+	
+	def in_range(self,peak):
+		""" Is the peak value within the desired range? """
+		return self.desired_range[0] <= peak <= self.desired_range[1]
+		
+	def next_shutter_speed(self):
+		""" Shutter speed for the next frame, from the linear model or by bisection """
+		if self.state == 'ok':
+			return self.clamp((self.target - self.offset) / self.gain)
+		
+		if self.lo is not None and self.hi is not None:
+			# bracketed - bisect in log space
+			return self.clamp(np.sqrt(float(self.lo)*self.hi))
+		elif self.state == 'saturated':
+			# saturated - peak could be anywhere above 1023, so step down a long way
+			return self.clamp(self.last_shutter_speed / 8.)
+		else:
+			return self.clamp(self.last_shutter_speed * 8.)
+		
+	def at_limit(self):
+		""" True if the next frame would not change anything - i.e. we've hit a shutter speed limit """
+		# the camera rounds shutter speeds to a whole number of sensor lines
+		return abs(self.shutter_speed - self.last_shutter_speed) <= 0.01*self.last_shutter_speed
@@ -0,0 +1,197 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Fitting functions for the beam profiles (Gaussian) and the beam width 
+against translation stage position (focussed Gaussian beam)
+"""
+
+import numpy as np
+
+from .estimators import caruana_gaussian
+
+# running totals for run reports: profile fits, model evaluations during those fits,
+# fits that did not converge (profiles and caustics), and scan points left out of 
+# caustic fits as outliers
+fit_stats = dict(profile_fits=0, evaluations=0, profile_failures=0, caustic_fits=0, caustic_failures=0,
+				caustic_outliers=0)
+
+# robust caustic fits: a width is an outlier if its residual is more than OUTLIER_THRESHOLD
+# times the robust spread of the residuals, and more than OUTLIER_MIN_DEVIATION of the 
+# fitted width. At most MAX_OUTLIER_FRACTION of the points are left out.
+OUTLIER_THRESHOLD = 4.
+OUTLIER_MIN_DEVIATION = 0.01
+MAX_OUTLIER_FRACTION = 0.25
+
+def add_fit_stats(stats):
+	""" Add fit statistics from elsewhere (e.g. a worker process) to the running totals """
+	for key, value in stats.items():
+		fit_stats[key] = fit_stats.get(key,0) + value
+
+def curve_fit(*args,**kwargs):
+	""" scipy.optimize.curve_fit - scipy is only imported when a fit is first needed """
+	from scipy.optimize import curve_fit
+	return curve_fit(*args,**kwargs)
+	
+def least_squares(*args,**kwargs):
+	""" scipy.optimize.least_squares - imported when a robust fit is first needed """
+	from scipy.optimize import least_squares
+	return least_squares(*args,**kwargs)
+	
+def gaussian(x,a,c,w,o):
+	"""Gaussian function, with amplitude a, centred at c, width w = 1/e^2 radius, and offset o """
+	return a * np.exp(-2*(x-c)**2/(w**2)) + o
+
+def focussed_gaussian(z,zr,w0,c):
+	""" 
+	Expected form for the width of a gaussian beam at a position z,
+	with the focal position c, Rayleigh range zr and width at the focus of w0.
+	"""
+	w = w0 * np.sqrt(1.+((z-c)/zr)**2)
+	return w
+
+def profile_sigma(variance):
+	""" Standard deviation of each point of a projected profile, for weighting fits (None if unknown) """
+	if variance is None:
+		return None
+	return np.sqrt(np.maximum(variance,1e-12))
+	
+def fit_profile(xs,profile,variance=None,estimate=None,width_guess=None,label=''):
+	""" 
+	Weighted curve_fit of gaussian to one projected profile, starting from the 
+	closed-form (caruana_gaussian) estimate if it is usable. variance is the variance
+	of each point of the profile (unweighted fit if None).
+	Returns parameters (a, c, w, o) and their errors.
+	"""
+	# weight the fits with the standard deviation of each projected pixel, 
+	# so the errors on the widths are meaningful
+	sigma = profile_sigma(variance)
+	
+	if estimate is None:
+		estimate = caruana_gaussian(xs,profile)
+	if np.isfinite(estimate).all():
+		p0 = list(estimate)
+	else:
+		if width_guess is None:
+			width_guess = 0.1*abs(xs[-1]-xs[0])
+		p0 = [profile.max(),xs[profile.argmax()],width_guess,0]
+	def counted_gaussian(x,*p):
+		fit_stats['evaluations'] += 1
+		return gaussian(x,*p)
+		
+	fit_stats['profile_fits'] += 1
+	try:
+		print 'Initial params '+label+':',p0
+		popt, perr = curve_fit(counted_gaussian,xs,profile,p0=p0,sigma=sigma,absolute_sigma=sigma is not None)
+		popt[2] = abs(popt[2])
+		errs = np.sqrt(perr.diagonal())
+	except RuntimeError:
+		print 'Runtime Error ('+label+' fit) - probably caused by fitting not converging. Using initial params'
+		fit_stats['profile_failures'] += 1
+		popt = np.array(p0)
+		errs = np.ones(len(p0))*np.sqrt(abs(p0[0]))
+	return popt, errs
+	
+def fit_profiles(Xs,imageX,Ys,imageY,varX=None,varY=None,engine='accurate'):
+	""" 
+	Fit Gaussians to the x and y projections of an image. engine is 'accurate' 
+	(weighted non-linear least squares) or 'fast' (closed-form log-parabola estimate only,
+	without errors). Returns the parameters and errors for x, then y.
+	"""
+	# closed-form estimates - the result in fast mode, or the starting point for the full fit
+	xest = caruana_gaussian(Xs,imageX)
+	yest = caruana_gaussian(Ys,imageY)
+	
+	if engine == 'fast' and np.isfinite(xest).all() and np.isfinite(yest).all():
+		return np.array(xest), np.zeros(4)*np.nan, np.array(yest), np.zeros(4)*np.nan
+	
+	xpopt, xerrs = fit_profile(Xs,imageX,varX,xest,label='X')
+	ypopt, yerrs = fit_profile(Ys,imageY,varY,yest,label='Y')
+	return xpopt, xerrs, ypopt, yerrs
+	
+def fit_caustic(pos,w,werr,label=''):
+	""" 
+	Fit focussed_gaussian to the widths w (micron) against position pos (mm), 
+	weighted by the width errors werr. Returns the fit parameters (zr, w0, c) and their errors
+	"""
+	pos, w, werr = np.asarray(pos,dtype=float), np.asarray(w,dtype=float), np.asarray(werr,dtype=float)
+	# start from the narrowest point, with the Rayleigh range a quarter of the scan
+	p0 = [0.25*(pos.max()-pos.min()), w.min(), pos[w.argmin()]]
+	
+	fit_stats['caustic_fits'] += 1
+	try:
+		if (werr <= 0).any() or not np.isfinite(werr).all():
+			raise ValueError('Width errors must be positive')
+		popt, pcov = curve_fit(focussed_gaussian, pos, w, p0=p0, sigma=werr, absolute_sigma=True)
+	except (RuntimeError, ValueError, TypeError) as e:
+		print '!! Caution - some issue with '+label+' width fitting !!', e
+		try: 
+			print 'Trying fitting without using errorbars...',
+			popt, pcov = curve_fit(focussed_gaussian, pos, w, p0=p0)
+		except (RuntimeError, ValueError, TypeError):
+			print "But that didn't work either \nContinuing without fitting"
+			fit_stats['caustic_failures'] += 1
+			popt, pcov = np.array([1,1,1]),np.array([[0,0,0],[0,0,0],[0,0,0]])
+	
+	popt[0] = abs(popt[0])
+	return popt, np.sqrt(np.abs(pcov.diagonal()))
+	
+def fit_caustic_robust(pos,w,werr,label=''):
+	""" 
+	Outlier-resistant fit_caustic: focussed_gaussian is first fitted with a soft-L1 loss, 
+	so that a few bad widths (a saturated frame, dust, vibration) hardly pull the fit, 
+	then the points with outlying residuals are flagged and the weighted fit is 
+	repeated without them. Returns the fit parameters (zr, w0, c), their errors, and 
+	the outlier flags (bool array, one per point).
+	"""
+	pos, w, werr = np.asarray(pos,dtype=float), np.asarray(w,dtype=float), np.asarray(werr,dtype=float)
+	outliers = ~np.isfinite(w)
+	good = ~outliers
+	if np.isfinite(werr[good]).all() and (werr[good] > 0).all():
+		sigma = werr
+	else:
+		# no error bars (e.g. the fast fit engine) - assume the same relative error for all
+		sigma = np.abs(w)
+	if good.sum() > 3:
+		# start from the running median of the widths, so one bad point can't set the waist
+		order = np.argsort(pos[good])
+		z, wg = pos[good][order], w[good][order]
+		wm = np.median([wg[:-2], wg[1:-1], wg[2:]], axis=0)
+		p0 = [0.25*(z.max()-z.min()), wm.min(), z[1+wm.argmin()]]
+		def residuals(p):
+			return (focussed_gaussian(pos[good],*p) - w[good]) / sigma[good]
+		try:
+			fit = least_squares(residuals, p0, loss='soft_l1')
+			# again, with the loss switching to linear at the robust spread of the residuals
+			scale = 1.4826*np.median(np.abs(fit.fun))
+			if scale > 0:
+				fit = least_squares(residuals, fit.x, loss='soft_l1', f_scale=scale)
+			r = np.abs(fit.fun)
+			scale = 1.4826*np.median(r)
+			model = focussed_gaussian(pos[good],*fit.x)
+			bad = (r > OUTLIER_THRESHOLD*scale) & (np.abs(w[good]-model) > OUTLIER_MIN_DEVIATION*np.abs(model))
+			# only the worst points, if too many look bad
+			limit = int(MAX_OUTLIER_FRACTION*len(r))
+			if bad.sum() > limit:
+				bad &= r > np.sort(r)[::-1][limit]
+			outliers[np.flatnonzero(good)[bad]] = True
+		except (ValueError, np.linalg.LinAlgError) as e:
+			print '!! Robust '+label+' width fit failed:', e
+			
+	if outliers.any():
+		fit_stats['caustic_outliers'] += int(outliers.sum())
+		print label+' width outliers left out of the fit at', ', '.join('%.3f' % p for p in pos[outliers]), 'mm'
+	popt, perr = fit_caustic(pos[~outliers], w[~outliers], werr[~outliers], label)
+	return popt, perr, outliers
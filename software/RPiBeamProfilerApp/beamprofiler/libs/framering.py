@@ -0,0 +1,139 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+Fixed-size ring of preallocated uint16 frame slots in shared memory, so that 
+frames can be handed between the capture, fitting, saving and display stages 
+(including worker processes) without allocating or copying them.
+
+Each slot has a metadata record (sequence number, capture time, exposure and 
+stage position). Slots are leased: acquire_write() gives a free slot to the 
+capture stage, which fills it and commit()s it; other stages take read leases 
+with acquire_read() and release() them when done. A slot is free again once 
+every lease on it has been released.
+
+Lease counts are only kept in the process that owns the ring. Worker processes 
+attach() to the same memory and are handed a slot and its sequence number; 
+check_seq() tells them whether the slot still holds that frame.
+"""
+
+import time
+import ctypes
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+# metadata fields for each slot
+META_FIELDS = ('seq', 'timestamp', 'exposure', 'position')
+SEQ, TIMESTAMP, EXPOSURE, POSITION = range(len(META_FIELDS))
+
+class FrameRing():
+	""" Ring buffer of nslots shared-memory frames of frame_shape (uint16) """
+	def __init__(self,frame_shape,nslots=8,buffers=None):
+		self.frame_shape = tuple(frame_shape)
+		self.nslots = nslots
+		
+		if buffers is None:
+			buffers = (RawArray(ctypes.c_uint16,nslots*int(np.prod(self.frame_shape))),
+						RawArray(ctypes.c_double,nslots*len(META_FIELDS)))
+		self.buffers = buffers
+		self.frames = np.frombuffer(buffers[0],dtype=np.uint16).reshape((nslots,)+self.frame_shape)
+		self.meta = np.frombuffer(buffers[1],dtype=np.float64).reshape(nslots,len(META_FIELDS))
+		
+		# number of leases held on each slot (owning process only)
+		self.leases = np.zeros(nslots,dtype=int)
+		self.reset()
+		
+	@classmethod
+	def attach(cls,frame_shape,nslots,buffers):
+		""" Ring using the shared memory of an existing ring, e.g. in a worker process """
+		return cls(frame_shape,nslots,buffers)
+		
+	def reset(self):
+		""" Mark all slots as empty and zero the counters (any leases are forgotten) """
+		self.leases.fill(0)
+		self.meta.fill(np.nan)
+		self.meta[:,SEQ] = -1
+		self.next_seq = 0
+		self.next_slot = 0
+		self.dropped = 0
+		self.latest = None
+		
+	@property
+	def n_free(self):
+		""" Number of slots with no leases """
+		return int(np.count_nonzero(self.leases == 0))
+		
+	def acquire_write(self):
+		""" 
+		Lease a free slot for writing a new frame, oldest first. Returns the slot index, 
+		or None if every slot is leased - the frame is then counted as dropped.
+		"""
+		for i in range(self.nslots):
+			slot = (self.next_slot + i) % self.nslots
+			if self.leases[slot] == 0:
+				self.leases[slot] = 1
+				self.meta[slot,SEQ] = -1 # not a valid frame until committed
+				self.next_slot = (slot + 1) % self.nslots
+				return slot
+		self.dropped += 1
+		return None
+		
+	def commit(self,slot,exposure=np.nan,position=np.nan,timestamp=None):
+		""" 
+		Finish writing a frame into slot, and stamp its metadata. The write lease 
+		becomes a read lease, so release() the slot when finished with it. 
+		Returns the frame's sequence number.
+		"""
+		seq = self.next_seq
+		self.next_seq += 1
+		self.meta[slot] = (seq, time.time() if timestamp is None else timestamp, exposure, position)
+		self.latest = slot
+		return seq
+		
+	def write(self,frame,**metadata):
+		""" Copy a frame into a free slot and commit it - returns (slot, seq), or (None, None) if dropped """
+		slot = self.acquire_write()
+		if slot is None:
+			return None, None
+		self.frames[slot] = frame
+		return slot, self.commit(slot,**metadata)
+		
+	def acquire_read(self,slot):
+		""" Take a read lease on a committed slot, and return the frame (a view, not a copy) """
+		if self.meta[slot,SEQ] < 0:
+			raise ValueError('Slot %d does not hold a committed frame' % slot)
+		self.leases[slot] += 1
+		return self.frames[slot]
+		
+	def release(self,slot):
+		""" Release a lease on slot """
+		if self.leases[slot] > 0:
+			self.leases[slot] -= 1
+			
+	def check_seq(self,slot,seq):
+		""" True if slot still holds frame number seq """
+		return int(self.meta[slot,SEQ]) == seq
+		
+	def metadata(self,slot):
+		""" Metadata of the frame in slot, as a dict """
+		record = dict(zip(META_FIELDS,self.meta[slot].tolist()))
+		record['seq'] = int(record['seq'])
+		return record
+		
+	def stats(self):
+		""" Frame counters, for status display and run reports """
+		return dict(frames=self.next_seq, dropped=self.dropped, free_slots=self.n_free, slots=self.nslots)
@@ -0,0 +1,106 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import numpy as np
+
+class HDRMerger():
+	"""
+	Merge exposure-bracketed raw frames into a single float32 linear image.
+	
+	For each pixel, the dark-subtracted signal of every unsaturated frame is summed 
+	and divided by the summed exposure time of those frames, i.e. frames are 
+	weighted by their exposure time (optimal for shot-noise-limited data). The 
+	result is scaled to counts at the reference shutter speed, so it can be 
+	treated like a normal frame taken at that exposure, but with the wings 
+	of the beam measured at the longer exposures.
+	
+	Frames are accumulated one at a time into running sums, so no stack of frames 
+	is kept, and merging can overlap the capture of the next frame (see consume).
+	"""
+	def __init__(self,reference_shutter_speed,saturation=1000):
+		self.reference_shutter_speed = float(reference_shutter_speed)
+		self.saturation = saturation
+		
+		self.signal = None		# sum of dark-subtracted signal of unsaturated frames
+		self.exposure = None	# sum of relative exposure time of unsaturated frames
+		self.fallback = None	# shortest-exposure frame, for pixels saturated in every frame
+		self.fallback_scale = None
+		self.nvalid = None		# number of unsaturated frames for each pixel
+		self.nframes = 0
+		
+	def add(self,frame,shutter_speed,dark=None,hot=None):
+		""" 
+		Add a raw frame (before dark subtraction) taken at shutter_speed, with the 
+		matching dark frame and hot pixel mask (optional)
+		"""
+		rel_exp = np.float32(shutter_speed/self.reference_shutter_speed)
+		
+		saturated = frame >= self.saturation
+		valid = ~saturated
+		if hot is not None:
+			valid &= ~hot
+			saturated &= ~hot
+		signal = np.asarray(frame,dtype=np.float32)
+		if dark is not None:
+			signal -= dark
+		
+		if self.signal is None:
+			self.signal = np.zeros(frame.shape,dtype=np.float32)
+			self.exposure = np.zeros(frame.shape,dtype=np.float32)
+			self.nvalid = np.zeros(frame.shape,dtype=np.uint8)
+		
+		signal *= valid
+		self.signal += signal
+		self.exposure += rel_exp * valid
+		self.nvalid += valid
+		
+		if self.fallback is None or rel_exp < self.fallback_scale:
+			self.fallback = signal
+			self.fallback_scale = rel_exp
+			# saturated pixels - use the saturation level as a lower limit
+			# (hot pixels stay at 0, as in a single frame)
+			self.fallback[saturated] = self.saturation
+		self.nframes += 1
+		
+	def consume(self,queue):
+		""" 
+		Add frames from a Queue of (frame, shutter_speed, dark, hot) tuples until None is 
+		received - run in a separate thread to merge while the next frame is captured
+		"""
+		while True:
+			item = queue.get()
+			if item is None:
+				break
+			self.add(*item)
+	
+	def result(self):
+		""" Merged float32 image, in counts at the reference shutter speed """
+		if self.signal is None:
+			raise ValueError('No frames added')
+		merged = np.empty_like(self.signal)
+		ok = self.exposure > 0
+		np.divide(self.signal,self.exposure,out=merged,where=ok)
+		merged[~ok] = self.fallback[~ok] / self.fallback_scale
+		return merged
+	
+	def variance(self,noise_model):
+		""" 
+		Per-pixel variance of the merged image, from a SensorNoiseModel. The signal sum 
+		has variance gain*sum + nvalid*floor, which is divided by the summed exposure squared.
+		"""
+		merged = self.result()
+		exposure = np.maximum(self.exposure,self.fallback_scale)
+		floor = noise_model.variance(0.,self.reference_shutter_speed)
+		return noise_model.gain*np.maximum(merged,0)/exposure + np.maximum(self.nvalid,1)*floor/exposure**2
@@ -0,0 +1,95 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Pure numpy image handling routines shared by the camera class and the 
+processing code. Nothing in here talks to the hardware, so these can be 
+used (and tested) on any machine.
+"""
+
+import numpy as np
+
+def bayer_plane(bayer_data,bayer_offsets,col,out=None):
+	""" 
+	Extract a single colour plane from the raw bayer data (3d array, as 
+	given by PiBayerArray.array), without any interpolation.
+	
+	bayer_offsets are the ((ry, rx), (gy, gx), (Gy, Gx), (by, bx)) pixel offsets
+	of the bayer pattern. Returns a half-resolution 2d-array of signed integers
+	(otherwise background subtraction can fail), or if out is given (e.g. a 
+	FrameRing slot) the plane is written into it and out is returned.
+	"""
+	((ry, rx), (gy, gx), (Gy, Gx), (by, bx)) = bayer_offsets
+	if col=='Red':
+		plane = bayer_data[ry::2, rx::2, 0]
+	elif col=='Green':
+		plane = bayer_data[gy::2, gx::2, 1]
+	else:
+		plane = bayer_data[by::2, bx::2, 2]
+	if out is not None:
+		out[...] = plane
+		return out
+	return np.asarray(plane,dtype=int)
+
+def roi_slices(shape,roi,ccd_xsize,ccd_ysize):
+	""" 
+	Row and column slices of an image with the given shape that correspond to the 
+	region-of-interest roi = [xmin,xmax,ymin,ymax] (mm). Row 0 is the top of the 
+	sensor (y = ccd_ysize).
+	"""
+	h,w = shape
+	c0 = int(round(w*roi[0]/ccd_xsize))
+	c1 = int(round(w*roi[1]/ccd_xsize))
+	r0 = int(round(h*(1-roi[3]/ccd_ysize)))
+	r1 = int(round(h*(1-roi[2]/ccd_ysize)))
+	
+	# always keep at least one pixel
+	c0 = min(max(c0,0),w-1)
+	r0 = min(max(r0,0),h-1)
+	c1 = min(max(c1,c0+1),w)
+	r1 = min(max(r1,r0+1),h)
+	return slice(r0,r1), slice(c0,c1)
+
+def exposure_metric(image,slices,stride=2,reject=4,dark_fraction=0.01):
+	""" 
+	Cheap estimate of the peak value and dark (offset) level of the region-of-interest 
+	of a raw image, for auto-exposure.
+	
+	Uses every stride-th pixel of the ROI in each direction (a stride of 2 still 
+	samples a focussed beam, which is ~20 pixels across, adequately). The peak is 
+	the (reject+1)-th largest sampled value, so a few hot pixels are ignored - a 
+	high percentile would ignore a small beam on a large ROI as well. The offset 
+	is the dark_fraction quantile. Both come from a single O(n) partition.
+	"""
+	sub = np.ravel(image[slices][::stride, ::stride])
+	n = sub.size
+	ipeak = max(n - 1 - reject, 0)
+	ioffset = min(int(dark_fraction*n), ipeak)
+	part = np.partition(sub,[ioffset,ipeak])
+	return part[ipeak], part[ioffset]
+
+def project(cropped_image,cropped_var=None):
+	""" 
+	Mean of the (cropped) image along y and x, i.e. the x and y profiles, and 
+	their variances if the per-pixel variance cropped_var is given (else None)
+	"""
+	ch,cw = cropped_image.shape
+	imageX = cropped_image.sum(axis=0).astype(np.float)/ch
+	imageY = cropped_image.sum(axis=1).astype(np.float)/cw
+	if cropped_var is None:
+		return imageX, imageY, None, None
+	varX = cropped_var.sum(axis=0).astype(np.float)/ch**2
+	varY = cropped_var.sum(axis=1).astype(np.float)/cw**2
+	return imageX, imageY, varX, varY
@@ -0,0 +1,213 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+
+"""
+Analysed live view: the GPU preview, with the beam's centroid, 1/e^2 ellipse and widths
+shown over it at video rate.
+
+While the preview runs, small YUV frames are recorded from a splitter port of the
+camera (LiveAnalyser is the recording's output), and the closed-form log-parabola 
+estimator (caruana_gaussian, the 'fast' fit engine) is run on the x and y projections 
+of the luma in the region of interest. The ISP's gamma curve is undone with a lookup 
+table first. This is approximate, since the raw Bayer data only comes from still 
+captures, so the live widths are for alignment - scans still use the raw frames.
+
+The ellipse and centroid are drawn on an RGBA overlay, and the numbers are shown 
+with the camera's annotate_text. The annotation is burnt into every output, so its 
+rows at the top of the frame are left out of the analysis. The exposure is left as it 
+is set for captures (not switched to auto), so the live view shows whether a capture 
+would saturate - the ellipse turns red if any pixel in the region of interest is at 
+full scale.
+"""
+
+import numpy as np
+
+from .imageproc import roi_slices, project
+from .estimators import caruana_gaussian
+from .timing import monotonic
+
+# splitter port for the analysed frames (0 is left for recordings), their size (width a
+# multiple of 32 and height of 16, so the YUV planes are not padded), and the frame rate
+LIVE_PORT = 1
+LIVE_SIZE = (320, 240)
+LIVE_FRAMERATE = 30
+# camera resolution while the live view runs - binned full-sensor modes, so the
+# video frames cover the whole sensor (and the region of interest maps onto them)
+FULL_FOV_RESOLUTION = {1: (1296, 972), 2: (1640, 1232)}
+# preview window (x, y, width, height) on the screen
+PREVIEW_WINDOW = (100, 100, 1000, 750)
+# 8-bit luma at and above which a pixel is counted as saturated
+SATURATION_LEVEL = 250
+
+# linear intensity of each 8-bit luma value - inverse of the BT.709 transfer function
+_v = np.arange(256) / 255.
+GAMMA_LUT = np.where(_v < 0.081, _v/4.5, ((_v + 0.099)/1.099)**(1/0.45)).astype(np.float32) * 255
+del _v
+
+# overlay colours (RGBA)
+ROI_COLOUR = (128, 128, 128, 160)
+BEAM_COLOUR = (0, 255, 0, 255)
+SATURATED_COLOUR = (255, 0, 0, 255)
+
+class LiveAnalyser():
+	"""
+	Analysed live view with a camera (MyCamera). start() and stop() switch it on and off;
+	in between, the camera calls write() with each YUV frame (from its own thread).
+	
+	metrics is the analysis of the latest frame - x0, y0 (mm), wx, wy (1/e^2 radii, micron), 
+	peak (fraction of full scale), saturated, fps - and on_frame, if given, is called with 
+	it after each frame (from the camera's thread, so it must be quick).
+	"""
+	def __init__(self,camera,size=LIVE_SIZE,on_frame=None):
+		self.camera = camera
+		self.size = tuple(size)
+		self.on_frame = on_frame
+		w, h = self.size
+		self.frame_bytes = w*h*3//2 # Y, then U and V at half resolution
+		self.buffer = bytearray()
+		self.canvas = np.zeros((h, w, 4), dtype=np.uint8)
+		self.overlay = None
+		self.metrics = None
+		self.frames = 0
+		self.running = False
+		self.annotation_rows = 0
+		self._last = None
+		self._saved = None
+		
+		# frame pixel centres in mm (row 0 is the top of the sensor)
+		self.Xs = (np.arange(w) + 0.5) * camera.ccd_xsize / w
+		self.Ys = camera.ccd_ysize - (np.arange(h) + 0.5) * camera.ccd_ysize / h
+		
+	def start(self):
+		""" Start the preview, the overlay and the analysed recording """
+		cam = self.camera
+		self._saved = dict(resolution=cam.resolution, framerate=cam.framerate, annotate_text=cam.annotate_text)
+		cam.resolution = FULL_FOV_RESOLUTION[cam.version]
+		# keep the capture exposure - the frame period must be at least the shutter time
+		cam.framerate = min(LIVE_FRAMERATE, 1e6/max(cam.shutter_speed, 1))
+		cam.exposure_mode = 'off'
+		
+		# rows of the frame under the annotation text
+		res_h = cam.resolution[1]
+		self.annotation_rows = int(np.ceil(1.5 * cam.annotate_text_size * self.size[1] / float(res_h)))
+		
+		cam.preview_fullscreen = False
+		cam.preview_window = PREVIEW_WINDOW
+		cam.start_preview()
+		self.overlay = cam.add_overlay(self.canvas.tobytes(), size=self.size, format='rgba', layer=3,
+										fullscreen=False, window=PREVIEW_WINDOW)
+		self.buffer = bytearray()
+		self.frames = 0
+		self._last = None
+		self.running = True
+		cam.start_recording(self, format='yuv', resize=self.size, splitter_port=LIVE_PORT)
+		
+	def stop(self):
+		""" Stop the live view, and put the camera back as it was """
+		cam = self.camera
+		self.running = False
+		try:
+			cam.stop_recording(splitter_port=LIVE_PORT)
+		finally:
+			if self.overlay is not None:
+				cam.remove_overlay(self.overlay)
+				self.overlay = None
+			cam.stop_preview()
+			if self._saved is not None:
+				cam.annotate_text = self._saved['annotate_text']
+				cam.framerate = self._saved['framerate']
+				cam.resolution = self._saved['resolution']
+				
+	## file-like output for start_recording
+	def write(self,data):
+		""" Called by the camera with the YUV data - analyses each complete frame """
+		self.buffer.extend(data)
+		while len(self.buffer) >= self.frame_bytes:
+			frame = self.buffer[:self.frame_bytes]
+			del self.buffer[:self.frame_bytes]
+			if self.running:
+				w, h = self.size
+				self.process(np.frombuffer(frame, dtype=np.uint8, count=w*h).reshape(h, w))
+		return len(data)
+		
+	def flush(self):
+		pass
+		
+	def process(self,luma):
+		""" Analyse a frame's luma (h x w, uint8), and update the overlay and annotation """
+		now = monotonic()
+		metrics = self.analyse(luma)
+		metrics['fps'] = 1./(now - self._last) if self._last is not None and now > self._last else 0.
+		self._last = now
+		self.frames += 1
+		self.metrics = metrics
+		if self.overlay is not None:
+			self.draw(metrics)
+			self.overlay.update(self.canvas.tobytes())
+			self.camera.annotate_text = annotation(metrics)
+		if self.on_frame is not None:
+			self.on_frame(metrics)
+		
+	def analyse(self,luma):
+		""" Centroid (mm), widths (micron), peak and saturation of the beam in a frame's luma """
+		cam = self.camera
+		rows, cols = roi_slices(luma.shape, cam.roi, cam.ccd_xsize, cam.ccd_ysize)
+		start = min(max(rows.start, self.annotation_rows), luma.shape[0]-1)
+		rows = slice(start, max(rows.stop, start+1))
+		cropped = luma[rows, cols]
+		peak = int(cropped.max()) if cropped.size else 0
+		imageX, imageY, varX, varY = project(GAMMA_LUT[cropped])
+		a, x0, wx, o = caruana_gaussian(self.Xs[cols], imageX)
+		a, y0, wy, o = caruana_gaussian(self.Ys[rows], imageY)
+		return dict(x0=x0, y0=y0, wx=abs(wx)*1e3, wy=abs(wy)*1e3, peak=peak/255., 
+					saturated=peak >= SATURATION_LEVEL, rows=(rows.start, rows.stop), cols=(cols.start, cols.stop))
+		
+	def draw(self,metrics):
+		""" Draw the region of interest, centroid and 1/e^2 ellipse on the overlay canvas """
+		canvas = self.canvas
+		canvas[...] = 0
+		h, w = canvas.shape[:2]
+		(r0, r1), (c0, c1) = metrics['rows'], metrics['cols']
+		canvas[r0, c0:c1] = canvas[r1-1, c0:c1] = ROI_COLOUR
+		canvas[r0:r1, c0] = canvas[r0:r1, c1-1] = ROI_COLOUR
+		if not np.isfinite([metrics['x0'], metrics['y0'], metrics['wx'], metrics['wy']]).all():
+			return
+		colour = SATURATED_COLOUR if metrics['saturated'] else BEAM_COLOUR
+		# mm to overlay pixels
+		sx, sy = w / self.camera.ccd_xsize, h / self.camera.ccd_ysize
+		cx, cy = metrics['x0']*sx, (self.camera.ccd_ysize - metrics['y0'])*sy
+		rx, ry = 1e-3*metrics['wx']*sx, 1e-3*metrics['wy']*sy
+		t = np.linspace(0, 2*np.pi, 360)
+		_plot(canvas, cx + rx*np.cos(t), cy + ry*np.sin(t), colour)
+		arm = np.linspace(-1.5, 1.5, 60)
+		_plot(canvas, cx + rx*arm, np.repeat(cy, len(arm)), colour)
+		_plot(canvas, np.repeat(cx, len(arm)), cy + ry*arm, colour)
+		
+def _plot(canvas,x,y,colour):
+	""" Set the canvas pixels at (x, y), where they are inside it """
+	h, w = canvas.shape[:2]
+	col, row = np.round(x).astype(int), np.round(y).astype(int)
+	inside = (col >= 0) & (col < w) & (row >= 0) & (row < h)
+	canvas[row[inside], col[inside]] = colour
+	
+def annotation(metrics):
+	""" Text shown on the preview for a frame's metrics """
+	text = 'wx %.0f um  wy %.0f um  x0 %.3f  y0 %.3f mm  peak %.0f%%' % (metrics['wx'], metrics['wy'],
+				metrics['x0'], metrics['y0'], 100*metrics['peak'])
+	if metrics['saturated']:
+		text += '  SATURATED'
+	return text
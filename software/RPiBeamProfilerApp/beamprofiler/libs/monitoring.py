@@ -0,0 +1,322 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+
+"""
+Beam pointing and stability monitoring at a fixed stage position: frames are 
+captured at a fixed rate for as long as needed (hours), and the centroid and widths 
+of each are found with the fast (log-parabola) estimator.
+
+Each sample is appended to a compact binary time series file (TimeSeriesWriter - 
+a short JSON header, then fixed-size little-endian records, RECORD_DTYPE), and fed 
+to rolling statistics that use bounded memory however long the run is:
+	- running mean and standard deviation (Welford) of each quantity, and the RMS 
+	  pointing jitter - radial RMS deviation of the centroid from its mean
+	- the same over the last WINDOW samples
+	- Allan deviation at octave averaging times tau0, 2 tau0, 4 tau0, ..., from a
+	  cascade of accumulators (one pending pair average and one sum per octave), so
+	  drift (rising Allan deviation at long tau) can be told apart from jitter. The
+	  samples are taken as evenly spaced, tau0 = 1/rate - missed captures (counted
+	  in the summary) make this approximate
+read_time_series() and analyse() read the file back, analyse() in chunks.
+"""
+
+import json
+import os
+import time
+from collections import deque
+
+import numpy as np
+
+from .fitting import fit_profiles
+from .timing import monotonic
+
+FILE_MAGIC = 'BPTS0001'
+# time (s since the epoch), centroid x0, y0 (mm), 1/e^2 radii wx, wy (micron), 
+# maximum pixel value (counts) and exposure (us)
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('x0', '<f4'), ('y0', '<f4'), ('wx', '<f4'), ('wy', '<f4'),
+						('peak', '<f4'), ('shutter_speed', '<f4')])
+# quantities with rolling statistics
+QUANTITIES = ('x0', 'y0', 'wx', 'wy', 'peak')
+# samples in the rolling window statistics
+WINDOW = 600
+# most octaves of the Allan deviation (tau0 to 2^(MAX_LEVELS-1) tau0)
+MAX_LEVELS = 24
+# the file is flushed at least this often (s)
+FLUSH_INTERVAL = 1.
+
+class TimeSeriesWriter():
+	""" 
+	Append-only binary time series file. An existing file with the same record format 
+	is appended to; header is a dict of details of the run (JSON-able) for a new file.
+	"""
+	def __init__(self, filename, header=None):
+		self.filename = filename
+		if os.path.exists(filename) and os.path.getsize(filename) > 0:
+			read_header(filename) # check it is a time series with the same records
+			self.f = open(filename, 'ab')
+			# drop a partly written last record (e.g. after a power cut)
+			offset, n = _record_offset(filename)
+			self.f.truncate(offset + n*RECORD_DTYPE.itemsize)
+		else:
+			header = dict(header or {}, dtype=RECORD_DTYPE.descr, created=time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+			text = json.dumps(header, default=float)
+			self.f = open(filename, 'wb')
+			self.f.write(FILE_MAGIC + np.array([len(text)], dtype='<u4').tostring() + text)
+		self.last_flush = monotonic()
+		
+	def append(self, record):
+		""" Write one record (a RECORD_DTYPE array of length 1, or a tuple of its fields) """
+		self.f.write(np.array(record, dtype=RECORD_DTYPE).tostring())
+		if monotonic() - self.last_flush > FLUSH_INTERVAL:
+			self.flush()
+			
+	def flush(self):
+		self.f.flush()
+		self.last_flush = monotonic()
+		
+	def close(self):
+		self.f.close()
+
+def read_header(filename):
+	""" The JSON header of a time series file, as a dict """
+	with open(filename, 'rb') as f:
+		if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+			raise ValueError(filename + ' is not a beam monitoring time series')
+		length = np.frombuffer(f.read(4), dtype='<u4')[0]
+		header = json.loads(f.read(length))
+	if [tuple(field) for field in header['dtype']] != RECORD_DTYPE.descr:
+		raise ValueError(filename + ' has a different record format')
+	return header
+	
+def _record_offset(filename):
+	""" Byte offset of the first record, and the number of complete records """
+	with open(filename, 'rb') as f:
+		f.seek(len(FILE_MAGIC))
+		offset = len(FILE_MAGIC) + 4 + np.frombuffer(f.read(4), dtype='<u4')[0]
+	return offset, (os.path.getsize(filename) - offset) // RECORD_DTYPE.itemsize
+
+def read_time_series(filename, start=0, count=None):
+	""" Records start to start+count (default all) of a time series file, as a RECORD_DTYPE array """
+	read_header(filename)
+	offset, n = _record_offset(filename)
+	count = n - start if count is None else min(count, n - start)
+	with open(filename, 'rb') as f:
+		f.seek(offset + start*RECORD_DTYPE.itemsize)
+		return np.fromfile(f, dtype=RECORD_DTYPE, count=max(count, 0))
+
+class RunningStats():
+	""" Mean and variance of a vector of quantities, updated one sample at a time (Welford) """
+	def __init__(self, n):
+		self.count = 0
+		self.mean = np.zeros(n)
+		self.m2 = np.zeros(n)
+		
+	def add(self, values):
+		self.count += 1
+		delta = values - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (values - self.mean)
+		
+	def std(self):
+		return np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.zeros_like(self.mean)*np.nan
+
+class AllanAccumulator():
+	""" 
+	Non-overlapping Allan variance of a vector of quantities at averaging times 
+	tau0 * 2^m, from a cascade of octave accumulators: level m averages pairs of 
+	level m-1 averages, and sums the squared differences of its successive averages. 
+	Memory is O(levels), however many samples are added.
+	"""
+	def __init__(self, n, tau0, max_levels=MAX_LEVELS):
+		self.tau0 = tau0
+		self.max_levels = max_levels
+		self.pending = [] # per level: first average of an incomplete pair, or None
+		self.previous = [] # per level: the last complete average
+		self.sums = [] # per level: sum of squared differences of successive averages
+		self.counts = [] # per level: number of differences
+		self.n = n
+		
+	def add(self, values):
+		values = np.asarray(values, dtype=float)
+		level = 0
+		while values is not None and level < self.max_levels:
+			if level == len(self.pending):
+				self.pending.append(None)
+				self.previous.append(None)
+				self.sums.append(np.zeros(self.n))
+				self.counts.append(0)
+			if self.previous[level] is not None:
+				self.sums[level] += (values - self.previous[level])**2
+				self.counts[level] += 1
+			self.previous[level] = values
+			# pair this average with the pending one to make the next level's average
+			if self.pending[level] is None:
+				self.pending[level] = values
+				values = None
+			else:
+				values, self.pending[level] = 0.5*(self.pending[level] + values), None
+			level += 1
+			
+	def deviation(self, min_count=1):
+		""" Averaging times (s) and Allan deviations (one row per tau) with at least min_count differences """
+		taus, adev = [], []
+		for level, count in enumerate(self.counts):
+			if count >= min_count:
+				taus.append(self.tau0 * 2**level)
+				adev.append(np.sqrt(0.5 * self.sums[level] / count))
+		return np.array(taus), np.array(adev).reshape(-1, self.n)
+
+class StabilityStats():
+	""" Rolling statistics of monitoring samples (RECORD_DTYPE records) - see the module docstring """
+	def __init__(self, tau0, window=WINDOW):
+		n = len(QUANTITIES)
+		self.total = RunningStats(n)
+		self.recent = deque(maxlen=window)
+		self.allan = AllanAccumulator(n, tau0)
+		self.first_time = self.last_time = None
+		
+	def add(self, record):
+		values = np.array([float(record[name]) for name in QUANTITIES])
+		if not np.isfinite(values).all():
+			return
+		self.total.add(values)
+		self.recent.append(values)
+		self.allan.add(values)
+		if self.first_time is None:
+			self.first_time = float(record['time'])
+		self.last_time = float(record['time'])
+		
+	def summary(self):
+		""" The statistics as a dict - centroid jitter in micron """
+		std = self.total.std()
+		recent = np.array(self.recent) if self.recent else np.zeros((0, len(QUANTITIES)))
+		recent_std = recent.std(axis=0, ddof=1) if len(recent) > 1 else std*np.nan
+		taus, adev = self.allan.deviation()
+		return dict(
+			samples=self.total.count,
+			duration_s=(self.last_time - self.first_time) if self.first_time is not None else 0.,
+			mean=dict(zip(QUANTITIES, self.total.mean.tolist())),
+			std=dict(zip(QUANTITIES, std.tolist())),
+			# radial RMS of the centroid about its mean (micron)
+			jitter_rms_um=1e3*float(np.hypot(std[0], std[1])),
+			recent_jitter_rms_um=1e3*float(np.hypot(recent_std[0], recent_std[1])),
+			recent_std=dict(zip(QUANTITIES, recent_std.tolist())),
+			allan=dict(tau_s=taus.tolist(), **dict((name, adev[:,i].tolist()) for i, name in enumerate(QUANTITIES))),
+			)
+			
+	def status_text(self):
+		""" One-line summary, for a status bar """
+		s = self.summary()
+		if s['samples'] < 2:
+			return 'Monitoring - %d samples' % s['samples']
+		return 'Monitoring - %d samples, %.0f s: jitter %.1f um RMS (last %d: %.1f um), widths %.1f +/- %.1f, %.1f +/- %.1f um' % (
+				s['samples'], s['duration_s'], s['jitter_rms_um'], len(self.recent), s['recent_jitter_rms_um'],
+				s['mean']['wx'], s['std']['wx'], s['mean']['wy'], s['std']['wy'])
+
+def analyse(filename, chunk=65536):
+	""" StabilityStats summary of a time series file, read in chunks (bounded memory) """
+	header = read_header(filename)
+	stats = StabilityStats(1. / header['rate'])
+	start = 0
+	while True:
+		records = read_time_series(filename, start, chunk)
+		if len(records) == 0:
+			break
+		for record in records:
+			stats.add(record)
+		start += len(records)
+	return stats.summary()
+
+class BeamMonitor():
+	"""
+	Captures and measures a frame every 1/rate seconds with camera (MyCamera), writing 
+	the samples to filename and keeping StabilityStats. The capture schedule is fixed: 
+	if a capture overruns, the missed slots are skipped (and counted) rather than 
+	caught up with. Use run() for a headless run, or time_to_next() and sample() 
+	from an event loop (the GUI).
+	"""
+	def __init__(self, camera, filename, rate=1., position=None, engine='fast', progress=None):
+		self.camera = camera
+		self.rate = float(rate)
+		self.engine = engine
+		self.progress = progress
+		self.writer = TimeSeriesWriter(filename, dict(rate=self.rate, position=position, engine=engine,
+										colour=camera.col, roi=list(camera.roi)))
+		self.stats = StabilityStats(1. / self.rate)
+		self.running = False
+		self.start = None
+		self.slot = 0
+		self.missed = 0
+		self.last_fit = None # x and y Gaussian parameters of the last sample
+		
+	def time_to_next(self):
+		""" Time (s) until the next capture is due """
+		if self.start is None:
+			return 0.
+		return self.start + self.slot/self.rate - monotonic()
+		
+	def sample(self):
+		""" Capture and measure a frame now, record it, and return the record """
+		now = monotonic()
+		if self.start is None:
+			self.start = now
+		cam = self.camera
+		t = time.time()
+		cam.capture_image()
+		xpopt, xerrs, ypopt, yerrs = fit_profiles(cam.Xs, cam.imageX, cam.Ys, cam.imageY,
+									cam.imageX_var, cam.imageY_var, self.engine)
+		self.last_fit = xpopt, ypopt
+		record = np.array((t, xpopt[1], ypopt[1], abs(xpopt[2])*1e3, abs(ypopt[2])*1e3,
+							float(cam.image.max()), cam.shutter_speed), dtype=RECORD_DTYPE)
+		self.writer.append(record)
+		self.stats.add(record)
+		
+		# next slot on the fixed schedule, skipping any that have been missed
+		elapsed_slots = int((monotonic() - self.start) * self.rate)
+		next_slot = max(self.slot + 1, elapsed_slots + 1)
+		self.missed += next_slot - self.slot - 1
+		self.slot = next_slot
+		if self.progress is not None:
+			self.progress('sample', dict((name, record[name].item()) for name in RECORD_DTYPE.names))
+		return record
+		
+	def run(self, duration=None):
+		""" Sample until stop() is called, or for duration (s) """
+		self.running = True
+		end = None if duration is None else monotonic() + duration
+		try:
+			while self.running and (end is None or monotonic() < end):
+				wait = self.time_to_next()
+				if wait > 0:
+					time.sleep(min(wait, 0.5))
+					continue
+				self.sample()
+		finally:
+			self.running = False
+			self.writer.flush()
+		return self.summary()
+			
+	def stop(self):
+		self.running = False
+		
+	def summary(self):
+		summary = self.stats.summary()
+		summary.update(rate=self.rate, missed_slots=self.missed, filename=self.writer.filename)
+		return summary
+		
+	def close(self):
+		self.writer.close()
@@ -0,0 +1,58 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import numpy as np
+
+# Approximate noise parameters for the raw 10-bit data at unity analog gain:
+# (gain in counts per electron, read noise in counts, dark current in electrons per second)
+# These can be measured for an individual sensor with SensorNoiseModel.calibrate()
+SENSOR_NOISE = {1: (0.22, 1.5, 15.), # OmniVision OV5647
+				2: (0.23, 1.0, 1.)}	 # Sony IMX219
+
+class SensorNoiseModel():
+	"""
+	Per-pixel noise model of the raw sensor data, in counts (DN):
+		variance = gain * signal + read_noise^2 + gain^2 * dark_current * t
+	where signal is the dark-subtracted pixel value, and t the exposure time.
+	The first term is the photon shot noise, the last is the shot noise of the 
+	dark current, which remains after subtracting the dark frame.
+	"""
+	def __init__(self,gain,read_noise,dark_current):
+		self.gain = gain
+		self.read_noise = read_noise
+		self.dark_current = dark_current
+	
+	@classmethod
+	def for_sensor(cls,version):
+		""" Default model for camera version 1 or 2 """
+		return cls(*SENSOR_NOISE[version])
+		
+	def variance(self,signal,shutter_speed):
+		""" Variance (counts^2) of each pixel of the dark-subtracted image signal, at shutter_speed (microseconds) """
+		floor = self.read_noise**2 + self.gain**2 * self.dark_current * shutter_speed*1e-6
+		return self.gain*np.maximum(signal,0) + floor
+	
+	def calibrate(self,mean,variance):
+		""" 
+		Set gain and read noise from a photon transfer curve - a linear fit of the per-pixel 
+		variance against the mean (dark-subtracted) signal, e.g. from a stack of frames 
+		of a uniformly illuminated sensor. Returns (gain, read_noise)
+		"""
+		mean = np.ravel(mean)
+		variance = np.ravel(variance)
+		slope, intercept = np.polyfit(mean,variance,1)
+		self.gain = slope
+		self.read_noise = np.sqrt(max(intercept,0))
+		return self.gain, self.read_noise
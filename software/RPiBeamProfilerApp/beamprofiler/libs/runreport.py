@@ -0,0 +1,68 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+Machine-readable (JSON) report of how a scan ran - stage timings, dropped frames, 
+auto-exposure and fitting statistics, stage steps and memory use - written next 
+to the exported data, for tracking throughput across software versions and 
+across profilers.
+"""
+
+import json
+import time
+import socket
+import resource
+
+REPORT_FORMAT = 1
+
+def peak_rss_kb():
+	""" 
+	Peak resident set size (kB) of this process, and the largest of its finished 
+	child processes - ru_maxrss is in kB on Linux. Running children (e.g. the fitting 
+	workers) are not included until they have been reaped.
+	"""
+	own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+	return own, children
+
+def run_report(scan, software_version=None, startup=None):
+	""" 
+	Build the report (a dict). scan is a dict of the scan's own statistics (from 
+	the GUI, e.g. duration, positions, dropped frames, fit statistics), taken when the 
+	scan ended, including the PipelineTimers summary of the scan (stages) and, with 
+	a worker pool, the workers' peak memory use (workers_peak_rss_kb). startup is an 
+	optional PipelineTimers of the application start up (its stage totals are included).
+	"""
+	scan = dict(scan)
+	stages = scan.pop('stages', {})
+	own, children = peak_rss_kb()
+	workers = scan.pop('workers_peak_rss_kb', None)
+	return dict(
+		report_format = REPORT_FORMAT,
+		software_version = software_version,
+		host = socket.gethostname(),
+		created = time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+		scan = scan,
+		stages = stages,
+		stage_total_s = sum(stage['total'] for stage in stages.values()),
+		peak_rss_kb = dict(main=own, workers=workers if workers is not None else children),
+		startup_s = dict(startup.totals) if startup is not None else None,
+		)
+
+def write_run_report(report, filename):
+	""" Write the report as (indented) JSON """
+	with open(filename, 'w') as f:
+		json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,139 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+
+"""
+Camera and scan settings of the profiler, shared by the GUI dialogs, the command-line 
+runner and the remote control API. update() checks the values, so that a bad setting 
+from a config file or a remote client is rejected (ValueError) before it reaches the 
+camera or the stage.
+"""
+
+import copy
+
+import numpy as np
+
+COLOURS = ('Red', 'Green', 'Blue', 'Interpolated')
+ACQ_MODES = ('single', 'hdr', 'stack')
+FIT_ENGINES = ('accurate', 'fast')
+UNCERTAINTIES = ('covariance', 'bootstrap', 'jackknife')
+# full sensor area (mm) - [xmin, xmax, ymin, ymax]
+SENSOR_ROI = (0.0, 3.67, 0.0, 2.74)
+
+class ProfilerSettings():
+	"""
+	Settings, as attributes:
+		colour			Red, Green, Blue or Interpolated (Bayer colour plane)
+		acq_mode		single, hdr (exposure-bracketed) or stack (averaged)
+		fit_engine		accurate (least squares) or fast (log-parabola)
+		auto_exposure	True/False
+		exposure_ms		exposure time (ms), used when auto_exposure is off
+		roi				region of interest (mm) - [xmin, xmax, ymin, ymax]
+		set_pos			stage position for manual positioning (mm)
+		scan_start, scan_stop, step_size	scan range (mm)
+		save_each_image	pickle each image of a scan ...
+		image_prefix	... to <image_prefix><n>.pkl (the GUI asks for it if empty)
+		use_worker_pool	fit scan images in worker processes (GUI)
+		monitor_rate	captures per second in monitoring mode (libs/monitoring.py)
+		wavelength_nm	laser wavelength (nm), for M-squared (libs/beamquality.py)
+		uncertainty		covariance (of the caustic fits only), or also bootstrap or jackknife
+						confidence intervals (libs/bootstrap.py)
+	"""
+	DEFAULTS = dict(colour='Red', acq_mode='single', fit_engine='accurate', auto_exposure=True,
+					exposure_ms=20.0, roi=list(SENSOR_ROI), set_pos=12.5, scan_start=0.0, scan_stop=25.0,
+					step_size=0.15, save_each_image=False, image_prefix='', use_worker_pool=True, monitor_rate=1.0,
+					wavelength_nm=632.8, uncertainty='covariance')
+	
+	def __init__(self, **changes):
+		self.__dict__.update(copy.deepcopy(self.DEFAULTS))
+		self.update(**changes)
+		
+	def as_dict(self):
+		""" All the settings, as a (JSON-able) dict """
+		return dict((name, copy.copy(getattr(self, name))) for name in self.DEFAULTS)
+		
+	def update(self, **changes):
+		""" 
+		Change settings - either all of them are changed, or (if any is unknown or invalid) 
+		none are and ValueError is raised. Returns the names of the settings that changed.
+		"""
+		new = self.as_dict()
+		for name, value in changes.items():
+			if name not in self.DEFAULTS:
+				raise ValueError('Unknown setting: ' + str(name))
+			new[name] = _check(name, value)
+		if not new['roi'][0] < new['roi'][1] or not new['roi'][2] < new['roi'][3]:
+			raise ValueError('roi must be [xmin, xmax, ymin, ymax] with xmin < xmax and ymin < ymax')
+		if new['scan_stop'] < new['scan_start']:
+			raise ValueError('scan_stop must not be before scan_start')
+		changed = [name for name in changes if new[name] != getattr(self, name)]
+		self.__dict__.update(new)
+		return changed
+		
+	def apply_to_camera(self, camera):
+		""" Set the camera (MyCamera) attributes from the settings """
+		camera.col = self.colour
+		camera.acq_mode = self.acq_mode
+		camera.roi = list(self.roi)
+		if self.auto_exposure:
+			camera.auto_exp = 'auto'
+		else:
+			camera.auto_exp = 'off'
+			camera.shutter_speed = int(round(self.exposure_ms*1e3))
+			
+def _check(name, value):
+	""" value of setting name, converted to its type - ValueError if it isn't valid """
+	default = ProfilerSettings.DEFAULTS[name]
+	if name in ('colour', 'acq_mode', 'fit_engine', 'uncertainty'):
+		choices = dict(colour=COLOURS, acq_mode=ACQ_MODES, fit_engine=FIT_ENGINES, uncertainty=UNCERTAINTIES)[name]
+		if value not in choices:
+			raise ValueError('%s must be one of %s' % (name, ', '.join(choices)))
+		return str(value)
+	if isinstance(default, bool):
+		if value not in (True, False): # also 0 and 1
+			raise ValueError(name + ' must be true or false')
+		return bool(value)
+	if isinstance(default, float):
+		value = _number(name, value)
+		if name in ('exposure_ms', 'step_size', 'monitor_rate', 'wavelength_nm') and not value > 0:
+			raise ValueError(name + ' must be positive')
+		return value
+	if name == 'roi':
+		try:
+			roi = [_number(name, v) for v in value]
+		except TypeError:
+			roi = []
+		if len(roi) != 4:
+			raise ValueError('roi must be [xmin, xmax, ymin, ymax] (mm)')
+		# limit to the sensor area
+		return [max(roi[0], SENSOR_ROI[0]), min(roi[1], SENSOR_ROI[1]),
+				max(roi[2], SENSOR_ROI[2]), min(roi[3], SENSOR_ROI[3])]
+	if name == 'image_prefix':
+		if not isinstance(value, basestring):
+			raise ValueError(name + ' must be a string')
+		return value
+	raise ValueError('Unknown setting: ' + name)
+
+def _number(name, value):
+	if isinstance(value, bool):
+		raise ValueError(name + ' must be a number')
+	try:
+		value = float(value)
+	except (TypeError, ValueError):
+		raise ValueError(name + ' must be a number')
+	if not np.isfinite(value):
+		raise ValueError(name + ' must be finite')
+	return value
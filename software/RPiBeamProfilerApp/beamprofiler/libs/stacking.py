@@ -0,0 +1,93 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import numpy as np
+
+class FrameStack():
+	"""
+	Running per-pixel mean and variance of a stack of frames (Welford's algorithm), 
+	kept in preallocated float32 buffers that are reused for every frame and scan step.
+	
+	With clip_sigma set, once clip_min_frames frames have been added, pixel values 
+	more than clip_sigma standard deviations from the running mean are rejected 
+	(e.g. cosmic rays, dust drifting through the beam). The number of accepted 
+	values is kept for each pixel.
+	"""
+	def __init__(self,shape,clip_sigma=None,clip_min_frames=5,var_floor=1.):
+		self.shape = shape
+		self.clip_sigma = clip_sigma
+		self.clip_min_frames = clip_min_frames
+		# minimum variance used for clipping - raw counts are quantised
+		self.var_floor = var_floor
+		
+		self.mean = np.zeros(shape,dtype=np.float32)
+		self.m2 = np.zeros(shape,dtype=np.float32)
+		self.count = np.zeros(shape,dtype=np.uint16)
+		
+		# scratch buffers
+		self._delta = np.zeros(shape,dtype=np.float32)
+		self._accept = np.ones(shape,dtype=bool)
+		self._tmp = np.zeros(shape,dtype=np.float32)
+		
+		self.reset()
+		
+	def reset(self):
+		""" Empty the stack, keeping the buffers """
+		self.mean.fill(0)
+		self.m2.fill(0)
+		self.count.fill(0)
+		self.nframes = 0
+		self.rejected = 0
+		
+	def add(self,frame):
+		""" Add a frame to the running mean and variance """
+		delta = self._delta
+		np.subtract(frame,self.mean,out=delta,casting='unsafe')
+		
+		if self.clip_sigma is not None and self.nframes >= self.clip_min_frames:
+			# accept |delta| <= clip_sigma * std, i.e. delta^2 * (n-1) <= clip_sigma^2 * m2
+			tmp = self._tmp
+			np.maximum(self.m2, self.var_floor*(self.count-1.), out=tmp)
+			tmp *= self.clip_sigma**2
+			np.less_equal(delta*delta*(self.count-1.), tmp, out=self._accept)
+			self.rejected += self._accept.size - np.count_nonzero(self._accept)
+			delta *= self._accept
+			self.count += self._accept
+		else:
+			self.count += 1
+		
+		# mean += delta/n ; m2 += delta*(x - new mean)
+		np.divide(delta,np.maximum(self.count,1),out=self._tmp)
+		self.mean += self._tmp
+		np.subtract(frame,self.mean,out=self._tmp,casting='unsafe')
+		self._tmp *= delta
+		self.m2 += self._tmp
+		self.nframes += 1
+		
+	def consume(self,queue):
+		""" Add frames from a Queue until None is received - run in a separate thread """
+		while True:
+			frame = queue.get()
+			if frame is None:
+				break
+			self.add(frame)
+	
+	def variance(self):
+		""" Per-pixel sample variance of the frames """
+		return self.m2 / np.maximum(self.count-1.,1.)
+		
+	def variance_of_mean(self):
+		""" Per-pixel variance of the mean image """
+		return self.variance() / np.maximum(self.count,1)
@@ -13,7 +13,6 @@
 # limitations under the License.
 
 import time
-import wx
 
 import numpy as np
 
@@ -62,6 +61,8 @@ class StepMotorControl():
 		GPIO.setup(self.enable_btn,GPIO.OUT,initial=1)
 		
 		self.step_number = 0
+		# total number of step pulses sent to the motor, for run reports
+		self.steps_issued = 0
 		## self.step_amount = 1./400 * 149.4e-6 # one step = 1/400 of revolution * 149.4 micron per rev --- original thorlabs screw
 		self.step_amount = 1./400 * 500.e-6 # one step = 1/400 of revolution * 500 micron per rev --- new custom brass screw from the workshop
 		
@@ -87,6 +88,7 @@ class StepMotorControl():
 		else:
 			dir_sign = 1
 		self.step_number += n * dir_sign
+		self.steps_issued += n
 		GPIO.output(self.enable_btn,1) # disable
 
 	#translation stage init
@@ -114,12 +116,17 @@ class StepMotorControl():
 				GPIO.output(self.enable_btn,1) # disable
 				return False
 		
+		self.steps_issued += i
 		print '... Done' #after switch is triggered, reset the position counter
 		self.step_number = 0
 		GPIO.output(self.enable_btn,1) # disable
 		
 		return True
 		
+	def cleanup(self):
+		""" Release the GPIO pins """
+		GPIO.cleanup()
+	
 	def get_position(self):
 		""" Get position in milimetres from the zero-position"""
 		return self.step_number*self.step_amount*1e3
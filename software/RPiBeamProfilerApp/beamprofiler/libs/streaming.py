@@ -0,0 +1,275 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+
+"""
+Live beam metrics on the local network - a plain TCP server sending JSON lines, so 
+that any number of lab PCs can watch a profiler (nc, a few lines of Python, or 
+stream_client.py).
+
+The acquisition side calls publish(metrics, image) once per frame. This only stores 
+the latest record (and a strided, downsampled copy of the image if anyone is 
+connected) and wakes the client threads - nothing is encoded or sent on the 
+acquisition path. Each client has its own thread, which sends the newest frame at 
+up to the client's chosen rate; a slow client simply skips frames (the 'skipped' 
+count in each record) rather than queueing them, so it can't hold up acquisition 
+or the other clients.
+
+Protocol - one JSON object per line:
+	server -> client	{"type": "hello", "rate": 5.0, "thumbnails": true, ...} on connecting,
+						{"type": "frame", "seq": 12, "skipped": 0, "time": ..., "position": 3.45,
+						"x0": 1.8, "y0": 1.4, "wx": 210.3, "wx_err": 0.8, "wy": ..., "wy_err": ...,
+						"shutter_speed": 1000, "thumbnail": {...}} for each frame sent,
+						{"type": "settings", ...} after a change of settings, 
+						{"type": "error", "message": ...} for a bad command
+	client -> server	{"rate": 2} (frames per second), {"thumbnails": false}
+Thumbnails are 8-bit, scaled to their maximum ('scale' counts), zlib compressed 
+and base64 encoded - decode_thumbnail() turns one back into an array.
+"""
+
+import base64
+import json
+import select
+import socket
+import SocketServer
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from .timing import monotonic
+
+DEFAULT_PORT = 8765
+# frames per second sent to each client - default, and the limits a client can choose
+DEFAULT_RATE = 5.
+MIN_RATE, MAX_RATE = 0.1, 30.
+# thumbnail width (pixels) - the image is downsampled by an integer step to at most this
+THUMB_WIDTH = 160
+MAX_CLIENTS = 8
+# how often client threads check for commands and for the server stopping (s)
+POLL_INTERVAL = 0.1
+# a client that doesn't take a frame in this time (s) is disconnected
+SEND_TIMEOUT = 10.
+
+def downsample(image, width=THUMB_WIDTH):
+	""" Copy of image, downsampled by an integer step so that it is at most width pixels wide """
+	step = max(1, -(-image.shape[1] // width))
+	return np.array(image[::step, ::step])
+
+def encode_thumbnail(thumb):
+	""" 8-bit, zlib compressed, base64 encoded thumbnail (a dict, for the JSON records) """
+	scale = float(thumb.max())
+	if scale > 0:
+		thumb8 = np.clip(np.asarray(thumb, dtype=float) * (255. / scale), 0, 255).astype(np.uint8)
+	else:
+		thumb8 = np.zeros(thumb.shape, dtype=np.uint8)
+	return dict(shape=list(thumb8.shape), scale=scale, encoding='zlib+base64',
+				data=base64.b64encode(zlib.compress(thumb8.tostring())))
+	
+def decode_thumbnail(thumbnail):
+	""" Thumbnail array (float, in counts) from an encoded thumbnail """
+	thumb8 = np.frombuffer(zlib.decompress(base64.b64decode(thumbnail['data'])), dtype=np.uint8)
+	return thumb8.reshape(thumbnail['shape']) * (thumbnail['scale'] / 255.)
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	
+class _ClientHandler(SocketServer.BaseRequestHandler):
+	""" Streams frames to one client """
+	def handle(self):
+		publisher = self.server.publisher
+		self.request.settimeout(SEND_TIMEOUT)
+		if not publisher.add_client():
+			self.send(dict(type='error', message='Too many clients (%d)' % publisher.max_clients))
+			return
+		try:
+			self.stream(publisher)
+		except (socket.error, socket.timeout):
+			pass # client gone
+		finally:
+			publisher.remove_client()
+			
+	def send(self, record):
+		self.request.sendall(json.dumps(record, default=float) + '\n')
+		
+	def stream(self, publisher):
+		self.rate = DEFAULT_RATE
+		self.thumbnails = True
+		self.send(dict(type='hello', rate=self.rate, thumbnails=self.thumbnails, 
+						min_rate=MIN_RATE, max_rate=MAX_RATE))
+		received = ''
+		last_seq = None
+		last_sent = -np.inf
+		while publisher.running:
+			# commands from the client
+			if select.select([self.request], [], [], 0)[0]:
+				data = self.request.recv(4096)
+				if not data:
+					return # client closed the connection
+				received += data
+				while '\n' in received:
+					line, received = received.split('\n', 1)
+					if line.strip():
+						self.command(line)
+					
+			# newest frame, at no more than the client's rate
+			wait = last_sent + 1. / self.rate - monotonic()
+			if wait > 0:
+				time.sleep(min(wait, POLL_INTERVAL))
+				continue
+			frame = publisher.wait_frame(last_seq, POLL_INTERVAL)
+			if frame is None:
+				continue
+			seq, metrics, thumb = frame
+			record = dict(metrics, type='frame', seq=seq, skipped=seq - last_seq - 1 if last_seq else 0)
+			if self.thumbnails and thumb is not None:
+				record['thumbnail'] = publisher.thumbnail(seq, thumb)
+			self.send(record)
+			last_seq = seq
+			last_sent = monotonic()
+			
+	def command(self, line):
+		""" Apply a settings change from the client """
+		try:
+			settings = json.loads(line)
+			if not isinstance(settings, dict):
+				raise ValueError('expected a JSON object')
+			if 'rate' in settings:
+				self.rate = min(max(float(settings['rate']), MIN_RATE), MAX_RATE)
+			if 'thumbnails' in settings:
+				self.thumbnails = bool(settings['thumbnails'])
+		except (ValueError, TypeError) as e:
+			self.send(dict(type='error', message='Bad command %r: %s' % (line, e)))
+			return
+		self.send(dict(type='settings', rate=self.rate, thumbnails=self.thumbnails))
+
+class MetricsPublisher():
+	""" 
+	Serves the latest beam metrics (and image thumbnail) to clients on port. 
+	start() the server, publish() each frame, stop() when finished.
+	"""
+	def __init__(self, port=DEFAULT_PORT, host='', thumb_width=THUMB_WIDTH, max_clients=MAX_CLIENTS):
+		self.address = (host, port)
+		self.thumb_width = thumb_width
+		self.max_clients = max_clients
+		
+		self.condition = threading.Condition()
+		self.latest = None # (seq, metrics, thumbnail array)
+		self.seq = 0
+		self.clients = 0
+		self.running = False
+		self.server = None
+		self._encoded = (None, None) # (seq, encoded thumbnail) of the last thumbnail sent
+		
+	def start(self):
+		""" Start serving in a background thread - returns the (host, port) listened on """
+		self.server = _Server(self.address, _ClientHandler)
+		self.server.publisher = self
+		self.running = True
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self.server.server_address
+		
+	def stop(self):
+		""" Stop the server and disconnect the clients """
+		if self.server is None:
+			return
+		self.running = False
+		with self.condition:
+			self.condition.notify_all()
+		self.server.shutdown()
+		self.server.server_close()
+		self.server = None
+		
+	def publish(self, metrics, image=None):
+		""" 
+		Make metrics (a dict of JSON-able values) and image the latest frame. Cheap - 
+		the thumbnail is only made if a client is connected, and encoded when sent.
+		"""
+		thumb = downsample(image, self.thumb_width) if image is not None and self.clients else None
+		record = dict(metrics, time=time.time())
+		with self.condition:
+			self.seq += 1
+			self.latest = (self.seq, record, thumb)
+			self.condition.notify_all()
+			
+	def wait_frame(self, last_seq, timeout):
+		""" The latest frame if it is newer than last_seq, waiting up to timeout (s) for one - otherwise None """
+		with self.condition:
+			if self.latest is None or self.latest[0] == last_seq:
+				self.condition.wait(timeout)
+			if self.latest is None or self.latest[0] == last_seq:
+				return None
+			return self.latest
+			
+	def thumbnail(self, seq, thumb):
+		""" Encoded thumbnail of frame seq - encoded once, however many clients it is sent to """
+		with self.condition:
+			if self._encoded[0] == seq:
+				return self._encoded[1]
+		encoded = encode_thumbnail(thumb)
+		with self.condition:
+			self._encoded = (seq, encoded)
+		return encoded
+		
+	def add_client(self):
+		with self.condition:
+			if self.clients >= self.max_clients:
+				return False
+			self.clients += 1
+			return True
+			
+	def remove_client(self):
+		with self.condition:
+			self.clients -= 1
+
+class StreamClient():
+	""" Minimal client, e.g. for testing: for record in StreamClient(host).frames(): ... """
+	def __init__(self, host='localhost', port=DEFAULT_PORT, timeout=SEND_TIMEOUT):
+		self.sock = socket.create_connection((host, port), timeout)
+		self.rfile = self.sock.makefile('rb')
+		self.hello = self.read()
+		
+	def read(self):
+		""" Next record from the server (None if the connection has closed) """
+		line = self.rfile.readline()
+		return json.loads(line) if line else None
+		
+	def set(self, **settings):
+		""" Change the settings (rate=..., thumbnails=...) - returns the server's reply """
+		self.sock.sendall(json.dumps(settings) + '\n')
+		while True:
+			record = self.read()
+			if record is None or record['type'] in ('settings', 'error'):
+				return record
+		
+	def frames(self, count=None):
+		""" Generator of frame records, until count have been read or the server closes """
+		n = 0
+		while count is None or n < count:
+			record = self.read()
+			if record is None:
+				return
+			if record['type'] == 'frame':
+				n += 1
+				yield record
+				
+	def close(self):
+		self.rfile.close()
+		self.sock.close()
@@ -0,0 +1,118 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+Synthetic sensor data for benchmarks and accuracy tests: raw Bayer frames of a 
+Gaussian beam on the v1 (OmniVision OV5647) or v2 (Sony IMX219) camera, with 
+dark level, hot pixels and noise following the sensor noise model, and the 
+ground truth needed to check the analysis.
+"""
+
+import numpy as np
+
+from .noise_model import SensorNoiseModel
+from .fitting import focussed_gaussian
+
+# Raw (full resolution) sensor size (rows, columns), and the bayer pattern offsets 
+# ((ry, rx), (gy, gx), (Gy, Gx), (by, bx)) as used by PiBayerArray
+SENSORS = {1: dict(shape=(1944,2592), bayer_offsets=((1,0),(0,0),(1,1),(0,1))),
+			2: dict(shape=(2464,3280), bayer_offsets=((1,1),(0,1),(1,0),(0,0)))}
+
+# actual size of ccd in mm (same for both camera versions)
+CCD_XSIZE = 3.67
+CCD_YSIZE = 2.74
+
+# 10-bit raw data
+SATURATION = 1023
+
+def beam_image(shape,centre,width,amplitude,ccd_xsize=CCD_XSIZE,ccd_ysize=CCD_YSIZE):
+	""" 
+	Noise-free image (2d-array of floats) of an elliptical Gaussian beam on a sensor 
+	plane of shape (rows, columns). centre = (x, y) and width = (wx, wy) are in mm, 
+	widths being 1/e^2 radii; row 0 is the top of the sensor (y = ccd_ysize). Pixel 
+	positions are those used by the analysis (MyCamera.Xs, Ys for the full sensor).
+	"""
+	h, w = shape
+	x = np.linspace(0,ccd_xsize,w)
+	y = np.linspace(ccd_ysize,0,h)
+	profile_x = np.exp(-2*(x-centre[0])**2/width[0]**2)
+	profile_y = np.exp(-2*(y-centre[1])**2/width[1]**2)
+	return amplitude * np.outer(profile_y, profile_x)
+	
+def dark_frame(shape,level=16.,hot_fraction=1e-4,rng=np.random):
+	""" Dark (fixed-pattern) frame: a small per-pixel offset variation and a few hot pixels """
+	dark = level + 0.5*rng.standard_normal(shape)
+	nhot = int(hot_fraction*dark.size)
+	hot = rng.randint(0,dark.size,nhot)
+	dark.flat[hot] = rng.uniform(200,SATURATION,nhot)
+	return dark
+	
+def add_noise(signal,dark,noise_model,shutter_speed,rng=np.random):
+	""" 
+	Raw counts (uint16, clipped to 10 bits) for the noise-free signal (counts) on top of 
+	the dark frame, with shot noise, dark current and read noise from noise_model
+	"""
+	gain = noise_model.gain
+	electrons = np.maximum(signal,0)/gain + noise_model.dark_current*shutter_speed*1e-6
+	counts = gain*rng.poisson(electrons) + dark + noise_model.read_noise*rng.standard_normal(signal.shape)
+	return np.clip(np.round(counts),0,SATURATION).astype(np.uint16)
+	
+def synthetic_plane(version=2,centre=(1.8,1.4),width=(0.2,0.15),amplitude=800.,dark=None,
+					shutter_speed=1000,binned=True,rng=np.random):
+	""" 
+	Raw colour plane (uint16) as extracted from the Bayer data, i.e. half resolution if 
+	binned, else full resolution (as interpolated). Returns the plane and the dark frame.
+	"""
+	h, w = SENSORS[version]['shape']
+	shape = (h//2, w//2) if binned else (h, w)
+	if dark is None:
+		dark = dark_frame(shape,rng=rng)
+	noise_model = SensorNoiseModel.for_sensor(version)
+	signal = beam_image(shape,centre,width,amplitude)
+	return add_noise(signal,dark,noise_model,shutter_speed,rng), dark
+	
+def synthetic_bayer(version=2,col='Red',centre=(1.8,1.4),width=(0.2,0.15),amplitude=800.,
+					other_colours=0.3,shutter_speed=1000,rng=np.random):
+	""" 
+	Raw Bayer data in the form of PiBayerArray.array - a (rows, columns, 3) uint16 array
+	with each pixel's value in its own colour channel. The beam is in colour col, and 
+	appears in the other colours at other_colours of the amplitude.
+	Returns the array and the bayer offsets.
+	"""
+	h, w = SENSORS[version]['shape']
+	offsets = SENSORS[version]['bayer_offsets']
+	noise_model = SensorNoiseModel.for_sensor(version)
+	plane_shape = (h//2, w//2)
+	signal = beam_image(plane_shape,centre,width,amplitude)
+	
+	bayer = np.zeros((h,w,3),dtype=np.uint16)
+	colours = [('Red',0), ('Green',1), ('Green',1), ('Blue',2)]
+	for (dy, dx), (name, channel) in zip(offsets, colours):
+		scale = 1. if name == col else other_colours
+		dark = dark_frame(plane_shape,rng=rng)
+		bayer[dy::2, dx::2, channel] = add_noise(scale*signal,dark,noise_model,shutter_speed,rng)
+	return bayer, offsets
+	
+def caustic_widths(positions,w0,zr,z0,rel_noise=0.01,rng=np.random):
+	""" 
+	Beam widths (micron) at the stage positions (mm) for a focussed beam with waist w0 
+	(micron) at z0, Rayleigh range zr (mm), with relative noise rel_noise. 
+	Returns widths and their (1 sigma) errors.
+	"""
+	positions = np.asarray(positions,dtype=float)
+	w = focussed_gaussian(positions,zr,w0,z0)
+	werr = rel_noise * w
+	return w + werr*rng.standard_normal(w.shape), werr
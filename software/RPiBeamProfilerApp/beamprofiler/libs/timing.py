@@ -0,0 +1,145 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+Timing of the stages of the acquisition/analysis pipeline (stage move, settling, 
+capture, unpacking the raw data, background subtraction, projection, fitting, 
+saving and drawing), using a monotonic clock.
+
+The most recent durations of each stage are kept in a rolling window, for 
+histograms and for the summary shown in the main window's status bar. Use the 
+shared instance, timers:
+
+	with timers.stage('capture'):
+		...
+"""
+
+import os
+import time
+import ctypes
+import ctypes.util
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# Pipeline stages, in the order they happen during a scan
+STAGES = ('move', 'settle', 'capture', 'unpack', 'background', 'projection', 'fit', 'save', 'draw')
+# GUI start up stages - the window is shown after 'window', the rest happen in the background
+STARTUP_STAGES = ('imports', 'window', 'colormap', 'camera', 'stage', 'ready')
+
+def _clock_gettime_monotonic():
+	""" time.monotonic() for Python 2 - clock_gettime(CLOCK_MONOTONIC) through ctypes """
+	class timespec(ctypes.Structure):
+		_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+	
+	libname = ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+	clock_gettime = ctypes.CDLL(libname, use_errno=True).clock_gettime
+	clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+	CLOCK_MONOTONIC = 1
+	ts = timespec()
+	
+	def monotonic():
+		if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno))
+		return ts.tv_sec + ts.tv_nsec * 1e-9
+	monotonic()
+	return monotonic
+	
+try:
+	monotonic = time.monotonic
+except AttributeError:
+	try:
+		monotonic = _clock_gettime_monotonic()
+	except (OSError, AttributeError, TypeError):
+		# no monotonic clock available - fall back to wall-clock time
+		monotonic = time.time
+		
+class PipelineTimers():
+	""" 
+	Rolling record of the last window durations (s) of each pipeline stage, 
+	plus running totals since the last reset()
+	"""
+	def __init__(self,window=200,stages=STAGES):
+		self.window = window
+		self.stages = list(stages)
+		self.reset()
+		
+	def reset(self):
+		""" Forget all recorded durations """
+		self.durations = dict((name, deque(maxlen=self.window)) for name in self.stages)
+		self.totals = dict((name, 0.) for name in self.stages)
+		self.counts = dict((name, 0) for name in self.stages)
+		
+	def add(self,name,duration):
+		""" Record a duration (s) for stage name """
+		if name not in self.durations:
+			self.stages.append(name)
+			self.durations[name] = deque(maxlen=self.window)
+			self.totals[name] = 0.
+			self.counts[name] = 0
+		self.durations[name].append(duration)
+		self.totals[name] += duration
+		self.counts[name] += 1
+		
+	@contextmanager
+	def stage(self,name):
+		""" Context manager timing the enclosed block as stage name """
+		st = monotonic()
+		try:
+			yield
+		finally:
+			self.add(name, monotonic() - st)
+		
+	def histogram(self,name,bins=20):
+		""" Histogram (counts, bin edges in s) of the rolling window of durations for stage name """
+		return np.histogram(np.array(self.durations.get(name, [])), bins=bins)
+		
+	def summary(self):
+		""" 
+		Dict of stage name : dict of statistics of the rolling window (count, mean, 
+		median, p95, max in s) and the total time (s) since the last reset
+		"""
+		stats = {}
+		for name in self.stages:
+			d = np.array(self.durations[name])
+			if len(d) == 0:
+				continue
+			stats[name] = dict(count=self.counts[name], total=self.totals[name], mean=d.mean(),
+						median=np.median(d), p95=np.percentile(d, 95), max=d.max())
+		return stats
+		
+	def status_text(self):
+		""" One-line summary for the status bar: mean time per stage (ms) and share of the total """
+		total = sum(self.totals.values())
+		if total <= 0:
+			return 'No timings recorded'
+		stats = self.summary()
+		parts = ['%s %.0f ms (%.0f%%)' % (name, 1e3*stats[name]['mean'], 100*self.totals[name]/total)
+					for name in self.stages if name in stats]
+		return ' | '.join(parts)
+		
+	def report(self):
+		""" Multi-line table of the stage timings, for printing """
+		lines = ['%-12s %7s %9s %9s %9s %9s' % ('stage', 'count', 'mean/ms', 'p95/ms', 'max/ms', 'total/s')]
+		for name, st in sorted(self.summary().items(), key=lambda item: self.stages.index(item[0])):
+			lines.append('%-12s %7d %9.1f %9.1f %9.1f %9.2f' % (name, st['count'], 1e3*st['mean'],
+						1e3*st['p95'], 1e3*st['max'], st['total']))
+		return '\n'.join(lines)
+		
+# shared by the camera, the worker pool and the GUI
+timers = PipelineTimers()
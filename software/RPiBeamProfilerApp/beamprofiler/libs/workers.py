@@ -0,0 +1,222 @@
+# Copyright 2018 J. Keaveney
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Process pool for the image processing stage (dark-frame subtraction, crop, 
+projection and fitting), so it runs on the otherwise idle cores of the Pi 
+instead of in the GUI's main thread.
+
+Frames are held in a shared-memory FrameRing that is created before the worker 
+processes are started, so only a small task description goes to the workers 
+and only a small result record (widths, fit parameters and profiles) comes 
+back. Results are returned in the order the frames were submitted.
+"""
+
+import os
+import resource
+import multiprocessing
+from collections import deque
+
+import numpy as np
+
+from .imageproc import roi_slices, project
+from .darkframes import DarkFrameLibrary, DARKFRAME_FILE
+from .noise_model import SensorNoiseModel
+from .framering import FrameRing
+from .timing import monotonic
+
+# state of each worker process, set by _init_worker
+_worker = {}
+
+def _init_worker(frame_shape,nslots,buffers,darkframe_file):
+	""" Runs once in each worker process: attach to the shared frame ring """
+	_worker['ring'] = FrameRing.attach(frame_shape,nslots,buffers)
+	_worker['darkframes'] = DarkFrameLibrary(darkframe_file)
+	_worker['darkframe_mtime'] = None
+
+def _darkframes():
+	""" The dark frame library, reloaded if the file has changed since it was last read """
+	library = _worker['darkframes']
+	try:
+		mtime = os.path.getmtime(library.filename)
+	except OSError:
+		return library
+	if mtime != _worker['darkframe_mtime']:
+		library.load()
+		_worker['darkframe_mtime'] = mtime
+	return library
+	
+def process_frame(frame,task,darkframes=None):
+	""" 
+	Dark-frame subtraction, crop, projection and fit of one raw frame, as described 
+	by the task dict. Returns the result record (a dict), including the time
+	taken by each stage (timings) and the fit statistics (fit_stats).
+	"""
+	# fitting imports scipy - only needed in the worker processes
+	from .fitting import fit_profiles, fit_stats
+	
+	timings = {}
+	st = monotonic()
+	image = frame.astype(np.float32)
+	if task['bg_subtract'] and darkframes is not None:
+		dark, hot = darkframes.get(task['col'],task['shutter_speed'])
+		if dark is not None and dark.shape == image.shape:
+			image -= dark
+			if hot is not None:
+				image[hot] = 0
+	
+	timings['background'] = monotonic() - st
+	
+	st = monotonic()
+	roi = task['roi']
+	slices = roi_slices(image.shape,roi,task['ccd_xsize'],task['ccd_ysize'])
+	cropped = image[slices]
+	noise_model = SensorNoiseModel(*task['noise_model'])
+	imageX, imageY, varX, varY = project(cropped,noise_model.variance(cropped,task['shutter_speed']))
+	ch, cw = cropped.shape
+	Xs = np.linspace(roi[0],roi[1],cw)
+	Ys = np.linspace(roi[3],roi[2],ch)
+	
+	timings['projection'] = monotonic() - st
+	
+	st = monotonic()
+	stats_before = dict(fit_stats)
+	xpopt, xerrs, ypopt, yerrs = fit_profiles(Xs,imageX,Ys,imageY,varX,varY,task['engine'])
+	timings['fit'] = monotonic() - st
+	stats = dict((key, fit_stats[key] - stats_before.get(key,0)) for key in fit_stats)
+	
+	result = dict(task)
+	result.update(xparams=xpopt, xerrs=xerrs, yparams=ypopt, yerrs=yerrs,
+				imageX=imageX.astype(np.float32), imageY=imageY.astype(np.float32),
+				Xs=Xs, Ys=Ys, min=float(image.min()), max=float(image.max()), timings=timings, fit_stats=stats)
+	return result
+
+def _process_slot(task):
+	""" 
+	Worker process entry point - process the frame in ring slot task['slot']. 
+	Returns None if the slot no longer holds frame task['seq'].
+	"""
+	ring = _worker['ring']
+	slot, seq = task['slot'], task['seq']
+	if not ring.check_seq(slot,seq):
+		return None
+	task = dict(task,**ring.metadata(slot))
+	task['shutter_speed'] = task['exposure']
+	result = process_frame(ring.frames[slot],task,_darkframes())
+	# the frame must not have been overwritten while it was being processed
+	if not ring.check_seq(slot,seq):
+		return None
+	# the worker's own peak memory use - its parent can't see it until it exits
+	result.update(pid=os.getpid(), rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+	return result
+	
+class FitWorkerPool():
+	"""
+	Pool of worker processes for processing and fitting frames.
+	
+	Frames can be captured straight into the pool's ring: acquire_slot() leases a 
+	slot to write into, and submit_slot() queues it. submit() does both, copying 
+	a frame that is already in memory. results() returns the finished result 
+	records, in submission order. If all slots are in use, acquire_slot() waits 
+	for the oldest frame to finish.
+	"""
+	def __init__(self,frame_shape,nslots=8,processes=None,darkframe_file=DARKFRAME_FILE):
+		if processes is None:
+			# leave one core for acquisition and the GUI
+			processes = max(multiprocessing.cpu_count()-1,1)
+		self.frame_shape = tuple(frame_shape)
+		self.ring = FrameRing(self.frame_shape,nslots)
+		self.pool = multiprocessing.Pool(processes,initializer=_init_worker,
+								initargs=(self.frame_shape,nslots,self.ring.buffers,darkframe_file))
+		
+		self.pending = deque() # (seq, slot, AsyncResult), in submission order
+		self.finished = deque() # result records not yet returned by results()
+		self.failures = 0
+		self.worker_rss = {} # peak resident set size (kB) of each worker process, by pid
+		
+	def acquire_slot(self):
+		""" Lease a ring slot to capture a frame into - returns the slot index """
+		while self.ring.n_free == 0 and self.pending:
+			# wait for the oldest frame, and keep its result for results()
+			self._collect(wait=1)
+		slot = self.ring.acquire_write()
+		if slot is None:
+			raise RuntimeError('No free frame slots')
+		return slot
+		
+	def submit_slot(self,slot,task):
+		""" 
+		Queue the frame written into slot for processing; task is a dict of the settings 
+		for process_frame. Returns the frame's sequence number.
+		"""
+		seq = self.ring.commit(slot,exposure=task.get('shutter_speed',np.nan),
+								position=task.get('position',np.nan))
+		task = dict(task,slot=slot,seq=seq)
+		self.pending.append((seq,slot,self.pool.apply_async(_process_slot,(task,))))
+		return seq
+		
+	def submit(self,frame,task):
+		""" Copy a frame into the ring and queue it for processing """
+		slot = self.acquire_slot()
+		self.ring.frames[slot] = frame
+		return self.submit_slot(slot,task)
+	
+	def _collect(self,wait=0):
+		""" 
+		Move finished frames (in order) from pending to finished, freeing their slots.
+		Waits for the first wait pending frames (all of them if wait is None).
+		"""
+		n = 0
+		while self.pending and (wait is None or n < wait or self.pending[0][2].ready()):
+			seq, slot, async_result = self.pending.popleft()
+			try:
+				result = async_result.get()
+			except Exception as e:
+				print '!! Fitting worker failed on frame', seq, ':', e
+				self.failures += 1
+			else:
+				if result is None:
+					print '!! Frame', seq, 'was overwritten before it was processed'
+					self.ring.dropped += 1
+				else:
+					self.worker_rss[result['pid']] = max(result['rss_kb'], self.worker_rss.get(result['pid'],0))
+					self.finished.append(result)
+			self.ring.release(slot)
+			n += 1
+		
+	def results(self,block=False):
+		""" 
+		List of result records that are ready, in submission order. With block=True, 
+		wait for all pending frames.
+		"""
+		self._collect(wait=None if block else 0)
+		done = list(self.finished)
+		self.finished.clear()
+		return done
+	
+	def peak_rss_kb(self):
+		""" Largest peak resident set size (kB) reported by the workers (None before any results) """
+		return max(self.worker_rss.values()) if self.worker_rss else None
+		
+	def reset_counters(self):
+		""" Zero the frame, dropped-frame and failure counts - only when no frames are pending """
+		if not self.pending:
+			self.ring.reset()
+			self.failures = 0
+			
+	def close(self):
+		""" Stop the worker processes """
+		self.pool.terminate()
+		self.pool.join()
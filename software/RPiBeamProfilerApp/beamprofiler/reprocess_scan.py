@@ -0,0 +1,71 @@
+""" 
+Re-analyse the images saved during a scan (with 'Save each image?' ticked in the translation 
+settings). All the x and y profiles of the scan are fitted at once with the batched Gaussian 
+fitter, and the widths are written to a csv file in the same format as 'Export Data as csv'.
+
+Usage: python reprocess_scan.py <image file prefix> [output csv file]
+e.g. python reprocess_scan.py /media/bp_scan_images_ 
+for the files bp_scan_images_0.pkl, bp_scan_images_1.pkl, ...
+"""
+
+import numpy as np
+
+import glob, os, re, sys, time
+import cPickle as pickle
+
+from libs.batchfit import fit_gaussians
+
+# actual size of ccd in mm (same for both camera versions)
+ccd_xsize = 3.67
+ccd_ysize = 2.74
+
+def load_scan(prefix):
+	""" Read in the images of a scan, and their positions (mm) if they were recorded """
+	pattern = re.compile(re.escape(prefix)+r'(\d+)\.pkl$')
+	files = {}
+	for filename in glob.glob(prefix+'*.pkl'):
+		match = pattern.match(filename)
+		if match:
+			files[int(match.group(1))] = filename
+	indices = sorted(files)
+	images = [pickle.load(open(files[i],'rb')) for i in indices]
+	
+	positions = dict(zip(indices,indices))
+	posfile = prefix+'positions.csv'
+	if os.path.isfile(posfile):
+		for i, pos in np.loadtxt(posfile,delimiter=',',ndmin=2):
+			positions[int(i)] = pos
+	else:
+		print 'No positions file found - using image numbers instead of positions'
+		
+	return np.array([positions[i] for i in indices]), images
+
+def main(prefix,output_filename=None):
+	if output_filename is None:
+		output_filename = prefix+'reprocessed.csv'
+		
+	z, images = load_scan(prefix)
+	print 'Loaded', len(images), 'images'
+	
+	# projections of all images onto x and y, stacked (N x width, N x height)
+	imageX = np.array([img.mean(axis=0) for img in images],dtype=float)
+	imageY = np.array([img.mean(axis=1) for img in images],dtype=float)
+	h, w = images[0].shape
+	Xs = np.linspace(0,ccd_xsize,w)
+	Ys = np.linspace(ccd_ysize,0,h)
+	
+	st = time.time()
+	xpopt, xerrs, xconv, xiter = fit_gaussians(Xs,imageX)
+	ypopt, yerrs, yconv, yiter = fit_gaussians(Ys,imageY)
+	print 'Fitted', 2*len(images), 'profiles in', round(time.time()-st,3), 's'
+	if not (xconv.all() and yconv.all()):
+		print 'Fits not converged for images:', np.flatnonzero(~(xconv & yconv))
+	
+	# positions, widths and errors in microns - sorted by position
+	dataout = np.column_stack((z,xpopt[:,2]*1e3,xerrs[:,2]*1e3,ypopt[:,2]*1e3,yerrs[:,2]*1e3))
+	dataout = dataout[np.argsort(z)]
+	np.savetxt(output_filename,dataout,delimiter=',')
+	print 'Widths written to', output_filename
+	
+if __name__ == '__main__':
+	main(*sys.argv[1:3])
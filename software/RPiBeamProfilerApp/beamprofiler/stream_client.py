@@ -0,0 +1,98 @@
+"""
+Watch the live beam metrics streamed by a beam profiler (GUI 'Stream results on the 
+network', or stream_port in the command-line runner's config) - prints one line per 
+frame received.
+
+With --synthetic, a local stand-in server is started first, publishing synthetic 
+frames (libs/synthetic.py) of a slowly wandering beam at --fps, so that the 
+streaming can be tried without a profiler.
+
+Usage: python stream_client.py [host] [--port N] [--rate FPS] [--no-thumbnails] [--count N]
+       python stream_client.py --synthetic [--fps N] [--clients N] ...
+"""
+
+import numpy as np
+
+import argparse, sys, threading, time
+
+from libs.streaming import DEFAULT_PORT, MetricsPublisher, StreamClient, decode_thumbnail
+
+def synthetic_source(publisher, fps, stop):
+	""" Publish synthetic frames at fps until stop is set """
+	from libs.synthetic import synthetic_plane
+	rng = np.random.RandomState(1)
+	dark = None
+	position = 0.
+	while not stop.is_set():
+		st = time.time()
+		centre = (1.8 + 0.05*np.sin(0.3*st), 1.4 + 0.05*np.cos(0.2*st))
+		width = (0.2, 0.15)
+		frame, dark = synthetic_plane(2, centre, width, 800., dark, rng=rng)
+		position += 0.15
+		publisher.publish(dict(position=position, x0=centre[0], y0=centre[1], wx=width[0]*1e3, wx_err=0.5,
+								wy=width[1]*1e3, wy_err=0.5, shutter_speed=1000), frame)
+		stop.wait(max(0, 1./fps - (time.time() - st)))
+
+def watch(client, count, name=''):
+	""" Print the frames received by client """
+	for record in client.frames(count):
+		line = '%s#%-6d skipped %-4d z %7.3f mm  centre (%.3f, %.3f) mm  w (%.1f, %.1f) um' % (name, 
+				record['seq'], record['skipped'], record.get('position', np.nan), record.get('x0', np.nan), 
+				record.get('y0', np.nan), record.get('wx', np.nan), record.get('wy', np.nan))
+		if 'thumbnail' in record:
+			thumb = decode_thumbnail(record['thumbnail'])
+			line += '  thumbnail %dx%d (%d bytes)' % (thumb.shape[1], thumb.shape[0], len(record['thumbnail']['data']))
+		print line
+		sys.stdout.flush()
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Watch the live beam metrics from a beam profiler')
+	parser.add_argument('host', nargs='?', default='localhost', help='beam profiler host name or address')
+	parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+	parser.add_argument('--rate', type=float, help='frames per second to receive')
+	parser.add_argument('--no-thumbnails', action='store_true', help="don't send image thumbnails")
+	parser.add_argument('--count', type=int, help='stop after this many frames')
+	parser.add_argument('--synthetic', action='store_true', help='start a local server publishing synthetic frames')
+	parser.add_argument('--fps', type=float, default=10., help='frames per second published by --synthetic')
+	parser.add_argument('--clients', type=int, default=1, help='number of clients to connect')
+	args = parser.parse_args(argv)
+
+	stop = threading.Event()
+	publisher = None
+	if args.synthetic:
+		publisher = MetricsPublisher(args.port)
+		print 'Synthetic server on port', publisher.start()[1]
+		source = threading.Thread(target=synthetic_source, args=(publisher, args.fps, stop))
+		source.daemon = True
+		source.start()
+
+	try:
+		clients = []
+		for i in range(args.clients):
+			client = StreamClient(args.host, args.port)
+			print 'Connected:', client.hello
+			settings = {}
+			if args.rate is not None:
+				settings['rate'] = args.rate
+			if args.no_thumbnails:
+				settings['thumbnails'] = False
+			if settings:
+				print 'Settings:', client.set(**settings)
+			clients.append(client)
+		threads = [threading.Thread(target=watch, args=(client, args.count, '[%d] ' % i if args.clients > 1 else ''))
+					for i, client in enumerate(clients)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		while any(thread.is_alive() for thread in threads):
+			time.sleep(0.2)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		stop.set()
+		if publisher is not None:
+			publisher.stop()
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())